@@ -0,0 +1,185 @@
+import calendar
+import contextlib
+import logging
+import re
+import time
+
+ARTICLE = 'article'
+ARCHIVE_PREFIX = 'article_archive_'
+ARCHIVE_TABLE_REGEX = re.compile(r'^article_archive_(\d{4})_(\d{2})$')
+# Compact the database once this fraction of its pages is unused
+COMPACT_FREE_RATIO = 0.2
+DAY = 24 * 3600
+# Trigger which removes deleted articles from the full-text search index
+SEARCH_DELETE_TRIGGER = 'article_fts_delete'
+
+
+def archive_table(timestamp):
+    """
+    Returns the name of the archive table of the month of a UNIX timestamp, e.g. "article_archive_2024_01".
+    """
+    date = time.gmtime(timestamp)
+    return f'{ARCHIVE_PREFIX}{date.tm_year:04d}_{date.tm_mon:02d}'
+
+
+def month_range(year, month):
+    """
+    Returns the UNIX timestamps of the start of a month and of the following month.
+    """
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    end = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    return start, end
+
+
+def archive_tables(cursor):
+    """
+    Returns (table, start, end) tuples of all archive tables, newest month first. Each table only holds articles
+    published between start (inclusive) and end (exclusive).
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'article\\_archive\\_%' ESCAPE '\\'")
+    tables = []
+    for table, in cursor.fetchall():
+        match = ARCHIVE_TABLE_REGEX.match(table)
+        if match is not None:
+            tables.append((table, *month_range(int(match.group(1)), int(match.group(2)))))
+    return sorted(tables, key=lambda table: table[1], reverse=True)
+
+
+def table_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in cursor.fetchall()]
+
+
+def create_archive_table(cursor, table):
+    """
+    Creates an archive table with the schema and indexes of the article table.
+    """
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (ARTICLE,))
+    sql, = cursor.fetchone()
+    logging.info(f'{table} table not created yet. Creating {table} table.')
+    cursor.execute(sql.replace(f'CREATE TABLE {ARTICLE}', f'CREATE TABLE {table}', 1))
+    cursor.execute(f'CREATE UNIQUE INDEX idx_{table}_site_original ON {table} (site_id, original_id)')
+    cursor.execute(f'CREATE INDEX idx_{table}_published ON {table} (published)')
+    cursor.execute(f'CREATE INDEX idx_{table}_site_published ON {table} (site_id, published)')
+    cursor.execute(f'CREATE INDEX idx_{table}_duplicate_of ON {table} (duplicate_of) WHERE duplicate_of IS NOT NULL')
+
+
+@contextlib.contextmanager
+def keeping_search_index(cursor):
+    """
+    Drops the trigger which removes deleted articles from the full-text search index and creates it again afterwards,
+    so that articles moved into an archive table keep their index entries. Has to be used inside a transaction, so
+    that no other connection sees the article table without the trigger.
+    """
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (SEARCH_DELETE_TRIGGER,))
+    result = cursor.fetchone()
+    if result is not None:
+        cursor.execute(f'DROP TRIGGER {SEARCH_DELETE_TRIGGER}')
+    try:
+        yield
+    finally:
+        if result is not None:
+            cursor.execute(result[0])
+
+
+def remove_from_search_index(cursor, table, where='', values=()):
+    """
+    Removes the articles of a table matching the given WHERE clause from the full-text search index. The index does
+    not store the text itself, so the text of the articles is passed along to find their entries.
+    """
+    cursor.execute("INSERT INTO article_fts (article_fts, rowid, title, summary, author) "
+                   f"SELECT 'delete', id, title, summary, author FROM {table} {where}", values)
+
+
+def add_to_search_index(cursor, table):
+    """
+    Adds the articles of an archive table to the full-text search index, e.g. after rebuilding the index from the
+    article table.
+    """
+    cursor.execute('INSERT INTO article_fts (rowid, title, summary, author) '
+                   f'SELECT id, title, summary, author FROM {table}')
+
+
+def archive_articles(db_connection, age_days):
+    """
+    Moves the articles published more than the given number of days ago into per-month archive tables, where they stay
+    in the full-text search index. Returns the number of moved articles.
+    """
+    cutoff = int(time.time()) - int(age_days * DAY)
+    cursor = db_connection.cursor()
+    # Keep the newest article, so that its ID is not reused by the next inserted article
+    cursor.execute('SELECT MAX(id) FROM article')
+    max_id, = cursor.fetchone()
+    cursor.execute("SELECT DISTINCT CAST(strftime('%Y', published, 'unixepoch') AS INTEGER), "
+                   "CAST(strftime('%m', published, 'unixepoch') AS INTEGER) "
+                   "FROM article WHERE published < ?", (cutoff,))
+    months = cursor.fetchall()
+
+    existing = {table for table, _, _ in archive_tables(cursor)}
+    moved = 0
+    for year, month in months:
+        start, end = month_range(year, month)
+        table = archive_table(start)
+        if table not in existing:
+            create_archive_table(cursor, table)
+        columns = ', '.join(column for column in table_columns(cursor, ARTICLE)
+                            if column in table_columns(cursor, table))
+        where = 'WHERE published >= ? AND published < ? AND id < ?'
+        values = (start, min(end, cutoff), max_id)
+        cursor.execute(f'INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM article {where}', values)
+        # Articles which were archived before under another ID are not moved and leave the index
+        remove_from_search_index(cursor, ARTICLE, f'{where} AND id NOT IN (SELECT id FROM {table})', values)
+        with keeping_search_index(cursor):
+            cursor.execute(f'DELETE FROM article {where}', values)
+            moved += cursor.rowcount
+        cursor.execute(f'ANALYZE {table}')
+    db_connection.commit()
+
+    if moved:
+        logging.info(f'Archived {moved} articles published before {time.strftime("%Y-%m-%d", time.gmtime(cutoff))}.')
+    return moved
+
+
+def remove_expired_articles(db_connection, retention_days):
+    """
+    Deletes the articles published more than the given number of days ago from the article and archive tables.
+    Returns the number of deleted articles.
+    """
+    cutoff = int(time.time()) - int(retention_days * DAY)
+    cursor = db_connection.cursor()
+    deleted = 0
+    for table, start, end in archive_tables(cursor):
+        if end <= cutoff:
+            deleted += cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            remove_from_search_index(cursor, table)
+            cursor.execute(f'DROP TABLE {table}')
+        elif start < cutoff:
+            remove_from_search_index(cursor, table, 'WHERE published < ?', (cutoff,))
+            cursor.execute(f'DELETE FROM {table} WHERE published < ?', (cutoff,))
+            deleted += cursor.rowcount
+    cursor.execute('SELECT MAX(id) FROM article')
+    max_id, = cursor.fetchone()
+    cursor.execute('DELETE FROM article WHERE published < ? AND id < ?', (cutoff, max_id))
+    deleted += cursor.rowcount
+    db_connection.commit()
+
+    if deleted:
+        logging.info(f'Deleted {deleted} articles published before {time.strftime("%Y-%m-%d", time.gmtime(cutoff))}.')
+    return deleted
+
+
+def compact(db_connection):
+    """
+    Updates the query planner statistics of the article table and rebuilds the database file once enough of it is
+    unused after moving and deleting articles.
+    """
+    start = time.perf_counter()
+    db_connection.execute(f'ANALYZE {ARTICLE}')
+    page_count, = db_connection.execute('PRAGMA page_count').fetchone()
+    free_pages, = db_connection.execute('PRAGMA freelist_count').fetchone()
+    if page_count and free_pages / page_count >= COMPACT_FREE_RATIO:
+        db_connection.commit()
+        db_connection.execute('VACUUM')
+        logging.info(f'Compacting database freed {free_pages} of {page_count} pages after '
+                     f'{time.perf_counter() - start:.1f}s.')
+    db_connection.commit()
@@ -0,0 +1,121 @@
+"""
+Compares the summary cleaning pipeline against the original implementation, both in speed and output.
+
+By default a synthetic corpus modelled on the summaries of the feeds in feeds.csv is used. Saved feed documents can be
+given instead to benchmark real summaries, e.g. obtained with: curl -o feeds/polygon.xml <feed URL>
+
+Run from the repository root with: python -m benchmarks.cleaning [feed files...]
+"""
+import argparse
+import html
+import random
+import re
+import time
+
+import feedparser
+
+from cleaning import SUMMARY_CACHE_SIZE, TRAILING_REPLACEMENTS, clean_summary, remove_extra_spaces, \
+    remove_html_tags, remove_trailing_message
+
+LEGACY_FIGURE_REGEX = re.compile(r'<figure>[\s\S]*?</figure>')
+LEGACY_P_REGEX = re.compile(r'</p><p>')
+LEGACY_TAG_REGEX = re.compile(r'<.*?>')
+LEGACY_SPACE_REGEX = re.compile(r' +')
+
+TRAILING_MESSAGES = [' Read the full article on nintendolife.com', ' Continue reading…', 'Read this article on TechRaptor',
+                     ' View the full site RELATED LINKS: Some link', ' Continue reading "Title"', ' Read more',
+                     ' The post Title appeared first on Nintendojo.', ' […]', 'Read article >',
+                     '. Read the full article on GamingOnLinux.', '']
+WORDS = ['game', 'the', 'Nintendo', 'release', 'update', 'and', 'new', 'player', '&amp;', '&quot;quoted&quot;', 'it’s',
+         'trailer', 'of', '&#8217;', 'season', 'with', 'in', 'Switch', 'PC', '&nbsp;']
+
+
+def legacy_clean_summary(text):
+    """
+    The original cleaning pipeline, which the current implementation must match byte for byte.
+    """
+    if not LEGACY_TAG_REGEX.search(text):
+        text = html.unescape(text)
+    text = LEGACY_FIGURE_REGEX.sub('', text)
+    text = LEGACY_P_REGEX.sub(' ', text)
+    text = LEGACY_TAG_REGEX.sub('', text)
+    text = html.unescape(text)
+    text = text.replace('\n', ' ')
+    text = text.replace('\t', ' ')
+    text = LEGACY_SPACE_REGEX.sub(' ', text)
+    text = text.strip()
+    for regex, replacement in TRAILING_REPLACEMENTS:
+        text = regex.sub(replacement, text)
+    return text
+
+
+def synthetic_summary(rng):
+    paragraphs = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 80))) for _ in range(rng.randint(1, 6))]
+    style = rng.random()
+    if style < 0.5:
+        text = ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs)
+        if rng.random() < 0.3:
+            text = '<figure><img src="https://example.com/image.jpg" alt="">\n<figcaption>Caption</figcaption>' \
+                   '</figure>' + text
+        if rng.random() < 0.3:
+            text += '\n\t<a href="https://example.com">link</a>'
+    elif style < 0.7:
+        # HTML escaped markup
+        text = html.escape(''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs))
+    else:
+        text = '\n\n'.join(paragraphs)
+    return text + rng.choice(TRAILING_MESSAGES)
+
+
+def load_corpus(files, size, seed=0):
+    if not files:
+        rng = random.Random(seed)
+        return [synthetic_summary(rng) for _ in range(size)]
+
+    summaries = []
+    for file in files:
+        summaries += [entry.summary for entry in feedparser.parse(file).entries if 'summary' in entry]
+    return summaries
+
+
+def measure(function, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for summary in corpus:
+            function(summary)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def uncached_clean_summary(text):
+    return remove_trailing_message(remove_extra_spaces(remove_html_tags(text)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=20000, help='Number of synthetic summaries.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('files', nargs='*', help='Saved feed documents to take summaries from.')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.files, args.size)
+    print(f'{len(corpus)} summaries, {sum(len(summary) for summary in corpus) / 1024 / 1024:.1f} MiB')
+
+    mismatches = [summary for summary in corpus if uncached_clean_summary(summary) != legacy_clean_summary(summary)]
+    print(f'{len(mismatches)} summaries cleaned differently than by the original implementation')
+
+    legacy = measure(legacy_clean_summary, corpus, args.repeat)
+    current = measure(uncached_clean_summary, corpus, args.repeat)
+    for name, seconds in [('original', legacy), ('current', current)]:
+        print(f'{name:<16} {seconds * 1000:8.1f} ms {len(corpus) / seconds:10.0f} summaries/s')
+
+    # Summaries seen before, e.g. when a feed is parsed again, are served from the cache
+    repeated = corpus[:SUMMARY_CACHE_SIZE]
+    clean_summary.cache_clear()
+    cached = measure(clean_summary, repeated, args.repeat)
+    print(f'{"current, cached":<16} {cached * 1000:8.1f} ms {len(repeated) / cached:10.0f} summaries/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Measures requests per second of the HTML feed pages against a synthetic database.
+
+Run from the repository root with: python -m benchmarks.feed_rendering
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.fixtures import create_database
+from plate import create_app
+
+
+def measure(client, url, duration):
+    client.get(url)
+    n_requests = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+        n_requests += 1
+    return n_requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--duration', type=float, default=5., help='Seconds to measure each URL for.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'articles.db')
+        create_database(path, args.sites, args.articles)
+        client = create_app({'DATABASE': path}).test_client()
+
+        for url in ['/', '/text', '/all/100']:
+            print(f'{url:<10} {measure(client, url, args.duration):8.1f} requests/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Synthetic feeds, a local HTTP server for them and synthetic databases, shared by the benchmarks.
+"""
+import email.utils
+import hashlib
+import http.server
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from main import create_tables, insert_articles
+
+AUTHORS = ['jane@example.com (Jane Doe)', 'John Smith', None]
+WORDS = ['game', 'the', 'Nintendo', 'release', 'update', 'and', 'new', 'player', '&amp;', 'it’s', 'trailer', 'of',
+         'season', 'with', 'in', 'Switch', 'PC']
+# Publication time of the first synthetic entry, later entries are published a minute apart
+EPOCH = 1700000000
+INSERT_CHUNK_SIZE = 50000
+
+
+def entry_text(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def rss_entry(site, i, rng, malformed):
+    published = email.utils.formatdate(EPOCH + i * 60, usegmt=True)
+    title = f'{site} article {i} {entry_text(rng, 6)}'
+    if malformed:
+        # An unescaped ampersand makes the document ill-formed, which forces feedparser onto its lenient parser, and
+        # a non-RFC 822 date is left to dateutil
+        title += ' & more'
+        published = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(EPOCH + i * 60))
+    summary = ''.join(f'&lt;p&gt;{entry_text(rng, 40)}&lt;/p&gt;' for _ in range(3))
+    return (f'<item><guid>{site}-{i}</guid><title>{title}</title><link>https://example.com/{site}/{i}</link>'
+            f'<description>{summary} Read more</description><pubDate>{published}</pubDate>'
+            f'<author>{site}@example.com (Author {i % 7})</author>'
+            f'<enclosure url="https://example.com/{site}/{i}.jpg" type="image/jpeg"/></item>')
+
+
+def atom_entry(site, i, rng, malformed):
+    updated = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(EPOCH + i * 60))
+    title = f'{site} article {i} {entry_text(rng, 6)}'
+    if malformed:
+        title += ' & more'
+    summary = ''.join(f'<p>{entry_text(rng, 40)}</p>' for _ in range(3))
+    return (f'<entry><id>urn:{site}:{i}</id><title>{title}</title>'
+            f'<link rel="alternate" href="https://example.com/{site}/{i}"/><updated>{updated}</updated>'
+            f'<author><name>Author {i % 7}</name></author>'
+            f'<summary type="html"><![CDATA[{summary}]]></summary></entry>')
+
+
+def generate_feed(site, n_entries, first=0, format_='rss', malformed=0., seed=0):
+    """
+    Returns a synthetic RSS 2.0 or Atom document with the newest n_entries entries up to entry first + n_entries - 1.
+    A fraction of malformed entries makes the document ill-formed.
+    """
+    rng = random.Random(f'{site}-{seed}')
+    entry = rss_entry if format_ == 'rss' else atom_entry
+    entries = ''.join(entry(site, i, rng, rng.random() < malformed)
+                      for i in reversed(range(first, first + n_entries)))
+    if format_ == 'rss':
+        document = (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>{site}</title>'
+                    f'<link>https://example.com/{site}</link><ttl>60</ttl>{entries}</channel></rss>')
+    else:
+        document = (f'<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                    f'<title>{site}</title><id>urn:{site}</id><updated>{time.strftime("%Y-%m-%dT%H:%M:%SZ")}</updated>'
+                    f'{entries}</feed>')
+    return document.encode()
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves synthetic feeds at /<rss|atom>/<site>/<n_entries> with the query parameters:
+    - first: number of the oldest entry, to simulate new articles
+    - malformed: fraction of malformed entries
+    - delay: seconds to wait before responding
+    - etag: if 1, send an ETag and answer matching If-None-Match headers with 304 Not Modified
+    - status: respond with this status and no body instead
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            format_, site, n_entries = url.path.strip('/').split('/')
+            n_entries = int(n_entries)
+        except ValueError:
+            return self.respond(404)
+
+        time.sleep(float(query.get('delay', 0)))
+        if 'status' in query:
+            return self.respond(int(query['status']))
+
+        body = self.server.feed(site, n_entries, int(query.get('first', 0)), format_,
+                                float(query.get('malformed', 0)))
+        headers = {'Content-Type': f'application/{format_}+xml'}
+        if query.get('etag') == '1':
+            headers['ETag'] = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                return self.respond(304, headers={'ETag': headers['ETag']})
+        self.respond(200, body, headers)
+
+    def respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+class FeedServer(http.server.ThreadingHTTPServer):
+    """
+    Local stand-in for feed publishers, running on a background thread while used as a context manager.
+    Generated documents are cached, so that the server does not dominate the measurements.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), FeedHandler)
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.requests = 0
+
+    def feed(self, *key):
+        with self.lock:
+            self.requests += 1
+            if key not in self.documents:
+                self.documents[key] = generate_feed(*key)
+            return self.documents[key]
+
+    def url(self, site, n_entries, format_='rss', **query):
+        host, port = self.server_address[:2]
+        query = f'?{urllib.parse.urlencode(query)}' if query else ''
+        return f'http://{host}:{port}/{format_}/{site}/{n_entries}{query}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name='feed-server', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def create_database(path, n_sites, n_articles, seed=0, max_age=30 * 24 * 60 * 60):
+    """
+    Creates a database with n_sites sites and n_articles articles published within max_age seconds, inserted in
+    chunks so that large databases do not have to fit into memory.
+    """
+    rng = random.Random(seed)
+    db_connection = sqlite3.connect(path)
+    create_tables(db_connection)
+    cursor = db_connection.cursor()
+    cursor.executemany('INSERT INTO site (name, feed, icon) VALUES (?, ?, ?)',
+                       [(f'Site {i}', f'https://site{i}.example.com/feed', f'https://site{i}.example.com/icon.png')
+                        for i in range(n_sites)])
+    now = int(time.time())
+    for start in range(0, n_articles, INSERT_CHUNK_SIZE):
+        insert_articles(cursor, [
+            (f'article-{i}', rng.randint(1, n_sites), f'Title of article {i} {entry_text(rng, 5)}',
+             entry_text(rng, 60), f'https://example.com/{i}', f'https://example.com/{i}.jpg',
+             now - rng.randint(0, max_age), rng.choice(AUTHORS), None)
+            for i in range(start, min(start + INSERT_CHUNK_SIZE, n_articles))
+        ])
+        db_connection.commit()
+    cursor.execute('INSERT INTO system (update_time, success) VALUES (?, ?)', (now, True))
+    db_connection.commit()
+    db_connection.close()
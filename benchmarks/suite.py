@@ -0,0 +1,300 @@
+"""
+Measures feed ingest throughput, the latency of every API endpoint on databases of increasing size and memory use, and
+writes the results as JSON so that runs can be compared.
+
+Ingest feeds are served by a local HTTP server and include Atom feeds, feeds answering with 304 Not Modified, slow
+feeds, feeds with malformed entries and a failing feed. Endpoint latencies are measured on pages at random positions,
+which mostly miss the response caches, and on a fixed page, which mostly hits them.
+
+Run from the repository root with: python -m benchmarks.suite --output results.json
+Databases with 1M or 10M articles take minutes to hours to fill, e.g. --sizes 10000,1000000,10000000
+Compare two runs with: python -m benchmarks.suite --compare baseline.json results.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+import database
+from benchmarks.fixtures import WORDS, FeedServer, create_database
+from main import create_tables, sync_sites, update_feeds, worker_pool
+from plate import create_app
+
+DEFAULT_SIZES = '10000,100000'
+PERCENTILES = [50, 90, 99]
+# Pages at random positions are reached through (published, id) cursors of random articles
+N_CURSORS = 1000
+
+
+def memory_usage():
+    """
+    Returns the current and peak resident set size of the process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        peak //= 1024
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        current = None
+    return {'rss_kib': current, 'max_rss_kib': peak}
+
+
+def database_size(path):
+    return sum(os.path.getsize(file) for file in (path, path + '-wal') if os.path.exists(file))
+
+
+def ingest_feeds(server, n_feeds, n_entries, delay):
+    """
+    Returns a dict of site name to (feed URL, URL of the same feed with new entries) of a mix of feed kinds.
+    """
+    feeds = {}
+    for i in range(n_feeds):
+        kind = ['rss', 'atom', 'etag', 'slow', 'malformed'][i % 5]
+        format_ = 'atom' if kind == 'atom' else 'rss'
+        query = {'etag': 1} if kind == 'etag' else {'delay': delay} if kind == 'slow' else \
+            {'malformed': 0.05} if kind == 'malformed' else {}
+        site = f'{kind}{i}'
+        feeds[site] = (server.url(site, n_entries, format_, **query),
+                       server.url(site, n_entries, format_, first=n_entries // 10, **query))
+    feeds['failing'] = (server.url('failing', n_entries, status=500),) * 2
+    return feeds
+
+
+def count_articles(db_connection):
+    return db_connection.execute('SELECT count(*) FROM article').fetchone()[0]
+
+
+def run_ingest(args, directory):
+    """
+    Updates all feeds three times: into an empty database, unchanged and with a tenth of the entries replaced by new
+    ones. Worker processes are started before the first update and kept, as in the collector.
+    """
+    path = os.path.join(directory, 'ingest.db')
+    db_connection = database.connect(path)
+    create_tables(db_connection)
+
+    results = []
+    executor = worker_pool(args.workers) if args.workers > 0 else contextlib.nullcontext()
+    with FeedServer() as server, executor:
+        feeds = ingest_feeds(server, args.feeds, args.entries, args.delay)
+        sites = sync_sites(db_connection, [(name, urls[0], None) for name, urls in feeds.items()])
+
+        for run in ['initial', 'unchanged', 'new entries']:
+            if run == 'new entries':
+                db_connection.executemany('UPDATE site SET feed=? WHERE id=?',
+                                          [(urls[1], sites[name]) for name, urls in feeds.items()])
+                db_connection.commit()
+
+            before = count_articles(db_connection)
+            start = time.perf_counter()
+            # All feeds are served by the same local host, which needs no protection
+            update_feeds(db_connection, sites, args.concurrency, workers=args.workers, host_interval=0,
+                         executor=executor if args.workers > 0 else None)
+            seconds = time.perf_counter() - start
+            new_articles = count_articles(db_connection) - before
+
+            results.append({
+                'run': run,
+                'feeds': len(sites),
+                'seconds': seconds,
+                'feeds_per_second': len(sites) / seconds,
+                'new_articles': new_articles,
+                'articles_per_second': new_articles / seconds,
+                'database_bytes': database_size(path),
+                'memory': memory_usage(),
+            })
+
+    db_connection.close()
+    return results
+
+
+def random_cursors(db_connection, n_cursors, seed=0):
+    rng = random.Random(seed)
+    max_id = db_connection.execute('SELECT max(id) FROM article').fetchone()[0]
+    ids = [rng.randint(1, max_id) for _ in range(n_cursors)]
+    qs = ', '.join(['?' for _ in ids])
+    return db_connection.execute(f'SELECT published, id FROM article WHERE id IN ({qs})', ids).fetchall()
+
+
+def endpoint_urls(n_sites, cursors):
+    """
+    Returns endpoint names with a function returning a URL of the endpoint for a random number generator.
+    """
+    def sites(rng):
+        return ','.join(str(site_id) for site_id in rng.sample(range(1, n_sites + 1), min(3, n_sites)))
+
+    def page(prefix):
+        return lambda rng: prefix + '/all/35/{}/{}'.format(*rng.choice(cursors))
+
+    return {
+        'sites': lambda rng: '/sites/',
+        'system_status': lambda rng: '/system/status',
+        'system_metrics': lambda rng: '/system/metrics',
+        'articles': lambda rng: '/articles/all/35',
+        'articles_sites': lambda rng: f'/articles/{sites(rng)}/35',
+        'articles_page': page('/articles'),
+        'feed': lambda rng: '/',
+        'feed_sites': lambda rng: f'/{sites(rng)}',
+        'feed_page': page(''),
+        'text_feed_page': page('/text'),
+        'search': lambda rng: f'/search/{rng.choice(WORDS[:8])}',
+        'search_sites': lambda rng: f'/search/{rng.choice(WORDS[:8])}/{sites(rng)}/35',
+    }
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    result = {f'p{p}_ms': latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000 for p in PERCENTILES}
+    result['mean_ms'] = statistics.fmean(latencies) * 1000
+    result['max_ms'] = latencies[-1] * 1000
+    return result
+
+
+def measure_endpoint(client, url, n_requests, rng):
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        response = client.get(url(rng))
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    return percentiles(latencies)
+
+
+def run_queries(args, directory, n_articles):
+    path = os.path.join(directory, f'articles-{n_articles}.db')
+    start = time.perf_counter()
+    create_database(path, args.sites, n_articles)
+    fill_seconds = time.perf_counter() - start
+
+    db_connection = sqlite3.connect(path)
+    cursors = random_cursors(db_connection, N_CURSORS)
+    db_connection.close()
+
+    client = create_app({'DATABASE': path}).test_client()
+    endpoints = {}
+    for name, url in endpoint_urls(args.sites, cursors).items():
+        rng = random.Random(name)
+        first_url = url(random.Random(name))
+        endpoints[name] = {
+            'random': measure_endpoint(client, url, args.requests, rng),
+            'repeated': measure_endpoint(client, lambda _: first_url, args.requests, rng),
+        }
+
+    return {
+        'articles': n_articles,
+        'fill_seconds': fill_seconds,
+        'fill_articles_per_second': n_articles / fill_seconds,
+        'database_bytes': database_size(path),
+        'endpoints': endpoints,
+        'memory': memory_usage(),
+    }
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': int(time.time()),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'arguments': vars(args),
+    }
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = {}
+        for key, item in value.items():
+            items.update(flatten(item, f'{prefix}.{key}' if prefix else str(key)))
+        return items
+    if isinstance(value, list):
+        items = {}
+        for item in value:
+            # Lists hold results identified by their first value, e.g. the run or number of articles
+            key = next(iter(item.values()))
+            items.update(flatten(item, f'{prefix}[{key}]'))
+        return items
+    return {prefix: value}
+
+
+def compare(baseline_file, results_file):
+    with open(baseline_file) as f:
+        baseline = flatten({key: value for key, value in json.load(f).items() if key != 'metadata'})
+    with open(results_file) as f:
+        results = flatten({key: value for key, value in json.load(f).items() if key != 'metadata'})
+
+    for key, value in results.items():
+        old = baseline.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = f'{(value - old) / old * 100:+7.1f}%' if old else '       '
+        print(f'{key:<70} {old:12.3f} {value:12.3f} {change}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated numbers of articles per database.')
+    parser.add_argument('--sites', type=int, default=50, help='Number of sites per database.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and access pattern.')
+    parser.add_argument('--feeds', type=int, default=40, help='Number of feeds to ingest.')
+    parser.add_argument('--entries', type=int, default=100, help='Entries per ingested feed.')
+    parser.add_argument('--delay', type=float, default=0.5, help='Response delay of slow feeds in seconds.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--skip-ingest', action='store_true')
+    parser.add_argument('-o', '--output', help='File to write the results to as JSON instead of standard output.')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'),
+                        help='Compare two result files instead of running the benchmarks.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # The failing feed and malformed entries are expected
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {'metadata': metadata(args)}
+    with tempfile.TemporaryDirectory() as directory:
+        if not args.skip_ingest:
+            results['ingest'] = run_ingest(args, directory)
+            for run in results['ingest']:
+                print(f'ingest {run["run"]:<12} {run["seconds"]:7.2f}s {run["feeds_per_second"]:8.1f} feeds/s '
+                      f'{run["articles_per_second"]:10.1f} articles/s', flush=True)
+
+        results['databases'] = []
+        for n_articles in [int(size) for size in args.sizes.split(',')]:
+            result = run_queries(args, directory, n_articles)
+            results['databases'].append(result)
+            print(f'{n_articles} articles filled at {result["fill_articles_per_second"]:.0f} articles/s, '
+                  f'max RSS {result["memory"]["max_rss_kib"] / 1024:.0f} MiB', flush=True)
+            for name, patterns in result['endpoints'].items():
+                print(f'  {name:<16}' + ''.join(f' {pattern} p50 {latencies["p50_ms"]:6.2f} ms '
+                                                f'p99 {latencies["p99_ms"]:6.2f} ms'
+                                                for pattern, latencies in patterns.items()), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import logging
+import time
+
+# Consecutive failed updates after which a site is no longer fetched for a while
+FAILURE_THRESHOLD = 5
+# Seconds for which a site is not fetched once its circuit opens, doubling with each further failure
+OPEN_TIME = 30 * 60
+MAX_OPEN_TIME = 24 * 60 * 60
+MAX_OPEN_EXPONENT = 10
+
+
+def failed(feed, error):
+    """
+    Returns whether fetching a feed failed because its site could not be reached or answered with an error status, as
+    opposed to a feed which was fetched but could not be read.
+    """
+    if error is not None and not isinstance(error, (AttributeError, ValueError)):
+        return True
+    return feed is not None and (feed.get('status') or 200) >= 400
+
+
+def open_circuits(cursor, now=None):
+    """
+    Returns a dict of the IDs of the sites which must not be fetched to the time until which their circuit is open.
+    Once that time has passed, the next update decides whether the circuit closes or opens again.
+    """
+    now = time.time() if now is None else now
+    cursor.execute('SELECT id, circuit_open_until FROM site WHERE circuit_open_until > ?', (int(now),))
+    return dict(cursor.fetchall())
+
+
+def record_update(cursor, name, site_id, failure, now=None):
+    """
+    Counts consecutive failed updates of a site in the site table and opens its circuit once there are too many.
+    A successful update closes the circuit.
+    """
+    if not failure:
+        cursor.execute('UPDATE site SET circuit_failures=0, circuit_open_until=NULL '
+                       'WHERE id=? AND circuit_failures > 0', (site_id,))
+        return
+
+    now = time.time() if now is None else now
+    cursor.execute('SELECT circuit_failures FROM site WHERE id=?', (site_id,))
+    failures = cursor.fetchone()[0] + 1
+    open_until = None
+    if failures >= FAILURE_THRESHOLD:
+        open_time = min(MAX_OPEN_TIME, OPEN_TIME * 2 ** min(failures - FAILURE_THRESHOLD, MAX_OPEN_EXPONENT))
+        open_until = int(now + open_time)
+        logging.warning(f'"{name}" failed {failures} times in a row, not fetching it for {open_time / 60:.0f} minutes.')
+    cursor.execute('UPDATE site SET circuit_failures=?, circuit_open_until=? WHERE id=?',
+                   (failures, open_until, site_id))
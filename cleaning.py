@@ -0,0 +1,77 @@
+import functools
+import html
+import re
+
+HTML_FIGURE_REGEX = re.compile(r'<figure>[\s\S]*?</figure>')
+# Equivalent to <.*?>, but without backtracking
+HTML_TAG_REGEX = re.compile(r'<[^>\n]*>')
+# Single spaces do not need to be replaced
+EXTRA_SPACE_REGEX = re.compile(r'  +')
+TRAILING_REPLACEMENTS = [
+    (re.compile(r' Read the full article on nintendolife\.com$'), ''),  # Nintendo Life
+    (re.compile(r' Continue reading…$'), '.'),
+    (re.compile(r'Read this article on TechRaptor$'), ''),  # TechRaptor
+    (re.compile(r' View the full site RELATED LINKS:.*$'), ''),
+    (re.compile(r' Continue reading .*$'), ''),
+    (re.compile(r' Read more$'), ''),
+    (re.compile(r' The post .* appeared first on Nintendojo\.$'), ''),  # Nintendojo
+    (re.compile(r' \[…]$'), '...'),
+    (re.compile(r'Read article >$'), '...'),  # NVIDIA Blog
+    (re.compile(r'\. Read the full article on GamingOnLinux\.$'), ''),  # GamingOnLinux
+]
+SUMMARY_CACHE_SIZE = 8192
+
+
+def remove_html_tags(text):
+    # If there are no HTML tags in the original text, it is possible that the tags are HTML escaped
+    if not HTML_TAG_REGEX.search(text):
+        # Unescape HTML before any substitutions
+        text = html.unescape(text)
+    # Remove figure tags
+    if '<figure>' in text:
+        text = HTML_FIGURE_REGEX.sub('', text)
+    # Replace change of p environment with space
+    text = text.replace('</p><p>', ' ')
+    # Remove remaining tags
+    text = HTML_TAG_REGEX.sub('', text)
+    return html.unescape(text)
+
+
+def remove_extra_spaces(text):
+    # Remove newlines
+    text = text.replace('\n', ' ')
+    # Remove tabs
+    text = text.replace('\t', ' ')
+    # Remove duplicate spaces
+    if '  ' in text:
+        text = EXTRA_SPACE_REGEX.sub(' ', text)
+    # Remove leading and trailing spaces
+    return text.strip()
+
+
+def remove_trailing_message(text: str):
+    """
+    Removes unrelated trailing messages.
+    """
+    # Replacements are applied in order, as one replacement may reveal the trailing message of another
+    for regex, replacement in TRAILING_REPLACEMENTS:
+        text = regex.sub(replacement, text)
+
+    return text
+
+
+@functools.lru_cache(maxsize=SUMMARY_CACHE_SIZE)
+def clean_summary(summary):
+    """
+    Converts an HTML summary into plain text without unrelated trailing messages.
+    Results are cached, as feeds repeat the same summaries on every update.
+    """
+    return remove_trailing_message(remove_extra_spaces(remove_html_tags(summary)))
+
+
+def reclean_summary(summary):
+    """
+    Applies the cleaning rules which work on plain text to a summary cleaned before, e.g. after trailing messages were
+    added. The HTML was already removed from stored summaries, so it is not removed again.
+    """
+    return remove_trailing_message(remove_extra_spaces(summary))
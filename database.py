@@ -0,0 +1,136 @@
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+BUSY_TIMEOUT = 10 * 1000  # Milliseconds
+CACHE_SIZE = 64 * 1024  # KiB
+MMAP_SIZE = 256 * 1024 * 1024  # Bytes
+CACHED_STATEMENTS = 256
+POOL_SIZE = 8
+MAINTENANCE_INTERVAL = 60 * 60  # Seconds
+BULK_CACHE_SIZE = 512 * 1024  # KiB
+# WAL size in pages at which bulk writes checkpoint, fewer checkpoints mean fewer pauses of large transactions
+BULK_WAL_AUTOCHECKPOINT = 16 * 1024
+WAL_AUTOCHECKPOINT = 1000  # Pages, the default of SQLite
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+MAX_QUERY_PARAMETERS = 500
+
+
+def configure(connection):
+    connection.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT}')
+    connection.execute(f'PRAGMA cache_size=-{CACHE_SIZE}')
+    connection.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    return connection
+
+
+def connect(path):
+    """
+    Opens a read-write connection in WAL mode, so that readers and the writer do not block each other.
+    """
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT / 1000, cached_statements=CACHED_STATEMENTS)
+    configure(connection)
+    journal_mode, = connection.execute('PRAGMA journal_mode=WAL').fetchone()
+    if journal_mode.lower() != 'wal':
+        logging.warning(f'Could not enable WAL mode for "{path}", using journal mode "{journal_mode}".')
+    # Durable across application crashes, only the last transactions may be lost on power failure in WAL mode
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+@contextlib.contextmanager
+def bulk_writes(connection):
+    """
+    Relaxes durability and enlarges the page cache while a bulk job writes large transactions. Commits are no longer
+    synced to disk, so they survive a crash of the process but the database may be corrupted on power failure or an
+    operating system crash. The settings of connect are restored afterwards.
+    """
+    connection.execute('PRAGMA synchronous=OFF')
+    connection.execute(f'PRAGMA cache_size=-{BULK_CACHE_SIZE}')
+    connection.execute(f'PRAGMA wal_autocheckpoint={BULK_WAL_AUTOCHECKPOINT}')
+    try:
+        yield connection
+    finally:
+        # Writes which were not committed when the job failed are discarded
+        if connection.in_transaction:
+            connection.rollback()
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(f'PRAGMA cache_size=-{CACHE_SIZE}')
+        connection.execute(f'PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT}')
+
+
+def query_in_chunks(cursor, sql, values, parameters=()):
+    """
+    Yields the rows of a query matching any of the given values, which may be more than a query can take. The query
+    ends with the expression the values are matched against, to which an IN clause is appended, and is run once per
+    chunk of values with the given parameters followed by the chunk.
+    """
+    values = list(values)
+    for i in range(0, len(values), MAX_QUERY_PARAMETERS):
+        chunk = values[i:i + MAX_QUERY_PARAMETERS]
+        qs = ', '.join(['?' for _ in chunk])
+        cursor.execute(f'{sql} IN ({qs})', (*parameters, *chunk))
+        yield from cursor.fetchall()
+
+
+def connect_read_only(path):
+    uri = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+    connection = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT / 1000, cached_statements=CACHED_STATEMENTS,
+                                 check_same_thread=False)
+    return configure(connection)
+
+
+def maintain(connection):
+    """
+    Lets SQLite update its query planner statistics and moves committed WAL content back into the database file.
+    """
+    start = time.perf_counter()
+    connection.execute('PRAGMA optimize')
+    busy, wal_pages, checkpointed_pages = connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    logging.info(f'Database maintenance took {time.perf_counter() - start:.2f}s, checkpointed {checkpointed_pages} '
+                 f'of {wal_pages} WAL pages.')
+
+
+class ConnectionPool:
+    """
+    Per-process pool of read-only connections. Keeping connections open lets them reuse their page cache, memory map
+    and prepared statements across requests.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.pid = os.getpid()
+        self.connections = queue.LifoQueue(size)
+
+    def acquire(self):
+        # Connections must not be shared with forked worker processes
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.connections = queue.LifoQueue(self.connections.maxsize)
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            return connect_read_only(self.path)
+
+    def release(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        try:
+            self.connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path):
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import re
+import time
+
+import database
+
+SIGNATURE_BITS = 64
+SIGNATURE_MASK = (1 << SIGNATURE_BITS) - 1
+# Signatures are split into bands for locality-sensitive hashing. Articles whose signatures differ in at most
+# MAX_DISTANCE bits share at least one band, as long as MAX_DISTANCE is smaller than the number of bands
+BANDS = 6
+BAND_OFFSETS = [SIGNATURE_BITS * band // BANDS for band in range(BANDS + 1)]
+MAX_DISTANCE = 5
+# Articles with fewer features are too short to tell apart from unrelated articles
+MIN_FEATURES = 8
+# Seconds for which new articles are compared against an article
+WINDOW = 3 * 24 * 3600
+# Counters of the bits of all feature hashes are kept side by side in lanes of one integer, so that a feature is added
+# with one table lookup per byte instead of one addition per bit
+LANE_BITS = 16
+LANE_MASK = (1 << LANE_BITS) - 1
+BYTE_LANES = [[sum(1 << (LANE_BITS * (8 * position + bit)) for bit in range(8) if byte >> bit & 1)
+               for byte in range(256)] for position in range(SIGNATURE_BITS // 8)]
+
+WORD_REGEX = re.compile(r'\w+')
+
+
+def features(title, summary):
+    """
+    Returns the word pairs of the title and summary of an article.
+    """
+    words = WORD_REGEX.findall(f'{title} {summary}'.lower())
+    return {f'{first} {second}' for first, second in zip(words, words[1:])}
+
+
+def simhash(title, summary):
+    """
+    Returns the 64 bit SimHash of the title and summary of an article as a signed integer, as stored by SQLite, or None
+    if the article is too short.
+    """
+    article_features = features(title, summary)
+    if len(article_features) < MIN_FEATURES:
+        return None
+    # Counters are limited to 16 bits
+    article_features = list(article_features)[:LANE_MASK]
+
+    b0, b1, b2, b3, b4, b5, b6, b7 = BYTE_LANES
+    lanes = 0
+    for feature in article_features:
+        d0, d1, d2, d3, d4, d5, d6, d7 = hashlib.blake2b(feature.encode(), digest_size=SIGNATURE_BITS // 8).digest()
+        lanes += b0[d0] + b1[d1] + b2[d2] + b3[d3] + b4[d4] + b5[d5] + b6[d6] + b7[d7]
+
+    # A bit is set if it is set in the majority of the feature hashes
+    half = len(article_features) // 2
+    signature = 0
+    for bit in range(SIGNATURE_BITS):
+        if (lanes >> (LANE_BITS * bit)) & LANE_MASK > half:
+            signature |= 1 << bit
+    return signature - (1 << SIGNATURE_BITS) if signature >> (SIGNATURE_BITS - 1) else signature
+
+
+def band_keys(signature):
+    """
+    Returns the LSH bucket of each band of a signature, which combines the band number with its bits.
+    """
+    signature &= SIGNATURE_MASK
+    return [(band << SIGNATURE_BITS // 4) | (signature >> start) & ((1 << (end - start)) - 1)
+            for band, (start, end) in enumerate(zip(BAND_OFFSETS, BAND_OFFSETS[1:]))]
+
+
+def distance(first, second):
+    return bin((first ^ second) & SIGNATURE_MASK).count('1')
+
+
+def candidates(cursor, keys, since):
+    """
+    Returns a dict of the IDs of recent articles in any of the given LSH buckets to (site ID, signature, group).
+    """
+    rows = database.query_in_chunks(cursor, 'SELECT DISTINCT s.article_id, s.site_id, s.simhash, a.duplicate_of '
+                                    'FROM article_lsh l JOIN article_signature s ON s.article_id = l.article_id '
+                                    'JOIN article a ON a.id = s.article_id '
+                                    'WHERE s.created >= ? AND l.band_key', keys, (since,))
+    return {article_id: (site_id, signature, group) for article_id, site_id, signature, group in rows}
+
+
+def detect_duplicates(cursor, site_id, articles):
+    """
+    Computes the signatures of the given new or changed ArticleRecords of a site, indexes them and marks those which
+    are near-duplicates of a recent article of another site with the ID of the oldest article of its group.
+    Returns the number of detected duplicates.
+    """
+    ids = dict(database.query_in_chunks(cursor, 'SELECT original_id, id FROM article WHERE site_id=? '
+                                       'AND id NOT IN (SELECT article_id FROM article_signature) AND original_id',
+                                       [article.original_id for article in articles], (site_id,)))
+
+    signatures = {}
+    for article in articles:
+        if article.original_id in ids:
+            signature = simhash(article.title, article.summary)
+            if signature is not None:
+                signatures[ids[article.original_id]] = signature
+    if not signatures:
+        return 0
+
+    now = int(time.time())
+    found = candidates(cursor, {key for signature in signatures.values() for key in band_keys(signature)},
+                       now - WINDOW)
+    groups = []
+    for article_id, signature in signatures.items():
+        matches = [group or candidate_id for candidate_id, (candidate_site, candidate_signature, group) in found.items()
+                   if candidate_site != site_id and distance(signature, candidate_signature) <= MAX_DISTANCE]
+        if matches:
+            groups.append((min(matches), article_id))
+
+    cursor.executemany('INSERT INTO article_signature (article_id, site_id, simhash, created) VALUES (?, ?, ?, ?)',
+                       [(article_id, site_id, signature, now) for article_id, signature in signatures.items()])
+    cursor.executemany('INSERT INTO article_lsh (band_key, article_id) VALUES (?, ?)',
+                       [(key, article_id) for article_id, signature in signatures.items()
+                        for key in band_keys(signature)])
+    cursor.executemany('UPDATE article SET duplicate_of=? WHERE id=?', groups)
+    return len(groups)
+
+
+def remove_old_signatures(db_connection):
+    """
+    Removes the signatures of articles which are too old to be compared against new articles.
+    """
+    since = int(time.time()) - WINDOW
+    db_connection.execute('DELETE FROM article_lsh WHERE article_id IN '
+                          '(SELECT article_id FROM article_signature WHERE created < ?)', (since,))
+    cursor = db_connection.execute('DELETE FROM article_signature WHERE created < ?', (since,))
+    db_connection.commit()
+    logging.debug(f'Removed {cursor.rowcount} old article signatures.')
@@ -0,0 +1,358 @@
+import contextlib
+import hashlib
+import http.client
+import io
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import urllib.response
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import feedparser
+import feedparser.http
+
+from records import parse_body
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PER_HOST = 2
+DEFAULT_TIMEOUT = 30
+# Minimum seconds between the starts of requests to the same host
+DEFAULT_HOST_INTERVAL = 0.5
+BODY_HASH_SIZE = 16
+READ_CHUNK_SIZE = 64 * 1024
+# Retries of failed requests, waiting a random time of up to RETRY_DELAY * 2 ** retry seconds before each
+MAX_RETRIES = 2
+RETRY_DELAY = 1.0
+RETRY_STATUSES = {500, 502, 503, 504}
+# Errors after which a request is retried, HTTPError and URLError are OSErrors
+RETRY_ERRORS = (OSError, http.client.HTTPException)
+
+
+class TimeoutHandler(urllib.request.BaseHandler):
+    """
+    Sets a socket timeout on every request opened by feedparser, which otherwise waits forever on a hanging server.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def http_request(self, request):
+        request.timeout = self.timeout
+        return request
+
+    https_request = http_request
+
+
+class ConnectionPool:
+    """
+    Keeps the connections of finished requests open, so that further requests to the same host skip the TCP and TLS
+    handshakes. Requests through a proxy are not pooled.
+    """
+
+    def __init__(self, max_idle=DEFAULT_PER_HOST):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def handlers(self):
+        """
+        Returns urllib handlers which open HTTP and HTTPS requests on pooled connections.
+        """
+        return [KeepAliveHTTPHandler(self), KeepAliveHTTPSHandler(self)]
+
+    def _take(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            return connections.pop() if connections else None
+
+    def _give_back(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def open(self, connection_class, request, **kwargs):
+        """
+        Sends a request on an idle or new connection and reads the whole response within the request's timeout.
+        Returns the response in the form urllib handlers return it.
+        """
+        key = (connection_class, request.host)
+        headers = {name.title(): value for name, value in {**request.headers, **request.unredirected_hdrs}.items()}
+        headers['Connection'] = 'keep-alive'
+        deadline = time.monotonic() + request.timeout
+
+        connection = self._take(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = connection_class(request.host, timeout=request.timeout, **kwargs)
+            try:
+                connection.request(request.get_method(), request.selector, request.data, headers)
+                sock = connection.sock
+                response = connection.getresponse()
+            except (ConnectionError, http.client.BadStatusLine) as e:
+                connection.close()
+                if reused:
+                    # The server closed the idle connection
+                    connection, reused = None, False
+                    continue
+                raise urllib.error.URLError(e)
+            except OSError as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            break
+
+        chunks = []
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'Response of "{request.full_url}" took longer than {request.timeout}s')
+                # Also applies after the connection closed itself, as the response still reads from the socket
+                sock.settimeout(remaining)
+                chunk = response.read1(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BaseException:
+            connection.close()
+            raise
+        # Lets the connection send the next request
+        response.close()
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._give_back(key, connection)
+
+        return PooledResponse(b''.join(chunks), response.msg, request.full_url, response.status, response.reason)
+
+
+class PooledResponse(urllib.response.addinfourl):
+    """
+    Response which was read completely from a pooled connection. Unlike that of addinfourl, its status can be set, as
+    feedparser does for error responses.
+    """
+    status = None
+
+    def __init__(self, data, headers, url, status, reason):
+        super().__init__(io.BytesIO(data), headers, url, status)
+        self.status = status
+        self.msg = reason
+
+
+class KeepAliveHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def http_open(self, request):
+        if request.has_proxy():
+            return super().http_open(request)
+        return self.pool.open(http.client.HTTPConnection, request)
+
+
+class KeepAliveHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def https_open(self, request):
+        if request.has_proxy():
+            return super().https_open(request)
+        return self.pool.open(http.client.HTTPSConnection, request, context=self._context)
+
+
+class HostLimiter:
+    """
+    Limits the number of simultaneous requests to the same host and spaces out the starts of requests to it.
+    """
+
+    def __init__(self, per_host=DEFAULT_PER_HOST, interval=DEFAULT_HOST_INTERVAL):
+        self.per_host = per_host
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.next_starts = {}
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+    @contextlib.contextmanager
+    def limit(self, host):
+        """
+        Waits until a request to the host may start and holds one of its slots while the block runs.
+        """
+        with self.get(host):
+            with self.lock:
+                start = max(time.monotonic(), self.next_starts.get(host, 0.))
+                self.next_starts[host] = start + self.interval
+            time.sleep(max(0., start - time.monotonic()))
+            yield
+
+
+def feed_url(feed):
+    """
+    Returns the HTTP URL of a feed given with the "feed:" URI scheme, or the feed itself otherwise.
+    """
+    if feed.startswith('feed:http'):
+        return feed[5:]
+    elif feed.startswith('feed:'):
+        return 'http:' + feed[5:]
+    return feed
+
+
+def feed_host(feed):
+    """
+    Returns the host name of a feed URL, taking the "feed:" URI scheme into account.
+    """
+    return urllib.parse.urlsplit(feed_url(feed)).hostname
+
+
+def shard_jobs(jobs, n_shards):
+    """
+    Splits fetch jobs given as (key, feed, ...) tuples into at most n_shards lists of similar size, keeping
+    all feeds of a host in the same shard so that per-host limits still apply.
+    """
+    by_host = {}
+    for job in jobs:
+        by_host.setdefault(feed_host(job[1]), []).append(job)
+
+    shards = [[] for _ in range(max(1, n_shards))]
+    for host_jobs in sorted(by_host.values(), key=len, reverse=True):
+        min(shards, key=len).extend(host_jobs)
+
+    return [shard for shard in shards if shard]
+
+
+def hash_body(data):
+    return hashlib.blake2b(data, digest_size=BODY_HASH_SIZE).hexdigest()
+
+
+def parse_raw(body, headers):
+    """
+    Returns a FeedStream of a compressed body stored from the "raw" key of a fetch_feed result.
+    """
+    return parse_body(zlib.decompress(body), headers)
+
+
+def fetch_feed(feed, etag: str = None, modified=None, timeout: float = DEFAULT_TIMEOUT, body_hash: str = None,
+               pool: ConnectionPool = None):
+    """
+    Downloads a feed like feedparser.parse, but raises connection errors and records the number of bytes received as
+    well as the time spent downloading and parsing in the "metrics" key of the result.
+    Each response has to arrive within the timeout, and connections are reused through the pool if one is given.
+
+    Instead of entries, the "records" key holds a FeedStream which parses them while it is iterated, and the "feed" key
+    holds the channel elements before the first entry.
+    If the body has the given hash, it is not parsed again and the result has no records and "unchanged" set.
+    Otherwise, the "raw" key holds the hash, the compressed body and the headers needed to parse it again.
+    """
+    start = time.perf_counter()
+    response = feedparser.FeedParserDict(headers={})
+    handlers = [TimeoutHandler(timeout)] + (pool.handlers() if pool is not None else [])
+    data = feedparser.http.get(feed, etag, modified, handlers=handlers, result=response)
+    fetched = time.perf_counter()
+
+    # Resolve relative URIs against the feed location, as feedparser does when it downloads the feed itself
+    headers = dict(response['headers'])
+    headers.setdefault('content-location', response.get('href', ''))
+    digest = hash_body(data) if data else None
+    if digest is not None and digest == body_hash:
+        result = feedparser.FeedParserDict(feed={}, records=[], unchanged=True)
+    else:
+        records = parse_body(data, headers)
+        result = feedparser.FeedParserDict(feed=records.channel, records=records)
+        if digest is not None:
+            result['raw'] = {'hash': digest, 'body': zlib.compress(data), 'headers': headers}
+    result.update(response)
+    parsed = time.perf_counter()
+
+    result['metrics'] = {
+        'status': result.get('status'),
+        'bytes': len(data) if data else 0,
+        'fetch_time': fetched - start,
+        'parse_time': parsed - fetched,
+    }
+    return result
+
+
+def should_retry(result):
+    """
+    Returns whether a fetch result is a server error worth retrying right away, which it is not if the server asked
+    for a later retry.
+    """
+    return result.get('status') in RETRY_STATUSES and 'retry-after' not in result.get('headers', {})
+
+
+class FetchEngine:
+    """
+    Fetches and parses feeds on a bounded thread pool, reusing connections to the same host.
+    Requests which fail with connection errors, timeouts or server errors are retried a few times.
+    Results are handed back to the calling thread so that all database writes happen in one place.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                 host_interval=DEFAULT_HOST_INTERVAL, retries=MAX_RETRIES):
+        self.concurrency = max(1, concurrency)
+        self.limiter = HostLimiter(per_host, host_interval)
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = ConnectionPool(per_host)
+
+    def _fetch(self, feed, etag, modified, body_hash):
+        host = feed_host(feed)
+        for retry in range(self.retries + 1):
+            if retry > 0:
+                # Random delays keep retries of feeds which failed together from hitting the host together again
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** (retry - 1)))
+            try:
+                with self.limiter.limit(host):
+                    result = fetch_feed(feed, etag, modified, self.timeout, body_hash, self.pool)
+            except RETRY_ERRORS as e:
+                if retry == self.retries:
+                    raise
+                logging.info(f'Fetching "{feed}" failed, retrying: {e!r}')
+                continue
+            if retry == self.retries or not should_retry(result):
+                result['metrics']['retries'] = retry
+                return result
+            logging.info(f'Fetching "{feed}" failed with status {result["status"]}, retrying.')
+
+    def fetch_all(self, jobs):
+        """
+        Fetches all jobs given as (key, feed, etag, modified, body_hash) tuples.
+        Yields (key, result, error) tuples in order of completion, where exactly one of result and error is None.
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetch') as executor:
+                futures = {}
+                for key, feed, etag, modified, body_hash in jobs:
+                    futures[executor.submit(self._fetch, feed, etag, modified, body_hash)] = key
+
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        yield key, future.result(), None
+                    except Exception as e:
+                        logging.debug(f'Fetching "{key}" failed: {e!r}')
+                        yield key, None, e
+        finally:
+            self.pool.close()
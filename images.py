@@ -0,0 +1,274 @@
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024  # Bytes
+# Cached images are deleted down to this fraction of the maximum size once it is exceeded
+EVICTION_TARGET = 0.9
+FETCH_TIMEOUT = 10
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Bytes
+# Seconds after which an image which could not be fetched is tried again
+FAILURE_TTL = 60 * 60
+# Seconds between updates of the access time of a cached image
+TOUCH_INTERVAL = 60 * 60
+PREFETCH_WORKERS = 4
+USER_AGENT = 'NewsFeeder image cache'
+# Maximum dimensions, format and encoder options of each variant
+VARIANTS = {
+    'thumbnail': ((720, 720), 'JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+    'icon': ((64, 64), 'PNG', {'optimize': True}),
+}
+MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+MAGIC_NUMBERS = [
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+]
+# Reason recorded for URLs which returned something other than an image
+REJECTED = 'rejected'
+
+
+class NotAnImageError(ValueError):
+    """
+    Raised for URLs which returned something other than an image, which is never cached or served.
+    """
+
+
+def url_key(url):
+    """
+    Returns a short hash of an image URL, which identifies the URL in proxied image links.
+    """
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+
+def sniff_mimetype(data):
+    """
+    Returns the image mimetype of data by its magic number, or None if it is not a supported image. SVG images are
+    not supported, as they may contain scripts, which would run with the origin of the API.
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for magic, mimetype in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mimetype
+    return None
+
+
+def mimetype(path):
+    with open(path, 'rb') as f:
+        return sniff_mimetype(f.read(16))
+
+
+def download(url, timeout=FETCH_TIMEOUT):
+    if not url.startswith(('http:', 'https:')):
+        raise ValueError(f'Unsupported image URL: "{url}"')
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = response.read(MAX_IMAGE_SIZE + 1)
+    if len(data) > MAX_IMAGE_SIZE:
+        raise ValueError(f'Image larger than {MAX_IMAGE_SIZE} bytes: "{url}"')
+    return data
+
+
+def convert(data, variant):
+    """
+    Returns an image resized to fit the maximum dimensions of the variant and recompressed in its format.
+    Without Pillow, or if the image cannot be decoded by it, the original image is returned.
+    """
+    if Image is None:
+        return data
+    size, format_, options = VARIANTS[variant]
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail(size)
+            if format_ == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            output = io.BytesIO()
+            image.save(output, format_, **options)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.debug(f'Could not convert image: {e!r}')
+        return data
+    # Keep the original if it was already smaller
+    return output.getvalue() if output.tell() < len(data) else data
+
+
+class ImageCache:
+    """
+    Content-addressed disk cache of resized images, shared by the collector and all API processes.
+
+    For each URL, a small index file holds the hash of the image content, whose variants are stored under that hash,
+    so that the same image under different URLs is stored once. The least recently used images are deleted once the
+    cache grows beyond its maximum size.
+    """
+
+    def __init__(self, root, max_size=DEFAULT_CACHE_SIZE, timeout=FETCH_TIMEOUT):
+        self.root = root
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Estimated size of the stored images, None until the cache directory is scanned
+        self.size = None
+
+    def _url_path(self, url):
+        key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.root, 'urls', key[:2], key)
+
+    def _object_path(self, digest, variant):
+        return os.path.join(self.root, 'objects', digest[:2], f'{digest}.{variant}')
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _fail(self, url, reason=''):
+        self._write(self._url_path(url), f'!{time.time()} {reason}'.encode())
+
+    def lookup(self, url, variant):
+        """
+        Returns the path of a cached image variant, '' if fetching the image recently failed, or None if it is not
+        cached. Raises NotAnImageError if the URL recently returned something other than an image.
+        """
+        try:
+            with open(self._url_path(url)) as f:
+                digest = f.read()
+        except OSError:
+            return None
+
+        if digest.startswith('!'):
+            failed, _, reason = digest[1:].partition(' ')
+            if time.time() - float(failed) >= FAILURE_TTL:
+                return None
+            if reason == REJECTED:
+                raise NotAnImageError(f'Not an image: "{url}"')
+            return ''
+
+        path = self._object_path(digest, variant)
+        try:
+            if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def fetch(self, url, variant):
+        """
+        Returns the path of an image variant, downloading and converting the image if it is not cached, or None if it
+        cannot be fetched. Raises NotAnImageError if the URL returns something other than an image, which is recorded
+        like a failed fetch and never stored.
+        """
+        path = self.lookup(url, variant)
+        if path is not None:
+            return path or None
+
+        try:
+            data = download(url, self.timeout)
+        except (OSError, ValueError) as e:
+            logging.debug(f'Could not fetch image "{url}": {e!r}')
+            self._fail(url)
+            return None
+
+        image_type = sniff_mimetype(data)
+        if image_type is None or not image_type.startswith('image/'):
+            logging.debug(f'Rejecting image "{url}", which is not an image')
+            self._fail(url, REJECTED)
+            raise NotAnImageError(f'Not an image: "{url}"')
+
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        path = self._object_path(digest, variant)
+        if not os.path.exists(path):
+            converted = convert(data, variant)
+            self._write(path, converted)
+            self._add_size(len(converted))
+        self._write(self._url_path(url), digest.encode())
+        return path
+
+    def _files(self):
+        for directory, _, files in os.walk(os.path.join(self.root, 'objects')):
+            for file in files:
+                path = os.path.join(directory, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _add_size(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._files())
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used images until the cache is below its target size.
+        Index files of deleted images are left behind and lead to the image being fetched again.
+        """
+        files = sorted(self._files())
+        self.size = sum(size for _, size, _ in files)
+        target = self.max_size * EVICTION_TARGET
+        removed = 0
+        for _, size, path in files:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            removed += 1
+        logging.info(f'Evicted {removed} images from the image cache.')
+
+
+class ImagePrefetcher:
+    """
+    Fetches images into an ImageCache on background threads, e.g. the thumbnails of newly stored articles, so that
+    they are cached before they are first requested.
+    """
+
+    def __init__(self, cache, workers=PREFETCH_WORKERS):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def _fetch(self, url, variant):
+        try:
+            self.cache.fetch(url, variant)
+        except NotAnImageError:
+            pass
+        except Exception as e:
+            logging.warning(f'Prefetching image "{url}" failed: {e!r}')
+        finally:
+            with self.lock:
+                self.pending.discard((url, variant))
+
+    def prefetch(self, url, variant):
+        with self.lock:
+            if (url, variant) in self.pending:
+                return
+            self.pending.add((url, variant))
+        self.executor.submit(self._fetch, url, variant)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
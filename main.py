@@ -1,64 +1,150 @@
 import argparse
-import calendar
 import csv
+import gzip
 import html
+import itertools
+import json
 import logging
-import re
-import sqlite3
+import multiprocessing
+import os
 import threading
 import time
-from datetime import timedelta
-from http.client import RemoteDisconnected
-
-import feedparser
-from dateutil import parser as dateparser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import archive
+import circuit
+import database
+import duplicates
+import images
+import timeline
+from cleaning import clean_summary, reclean_summary
+from fetcher import DEFAULT_CONCURRENCY, DEFAULT_HOST_INTERVAL, FetchEngine, parse_raw, shard_jobs
+from records import parse_body
+from scheduler import Scheduler
 
 SITE = 'site'
 ARTICLE = 'article'
 SYSTEM = 'system'
+FEED_BODY = 'feed_body'
+FEED_RUN = 'feed_run'
+FEED_RUN_INDEX = 'idx_feed_run_site_time'
+FEED_RUN_TIME_INDEX = 'idx_feed_run_time'
+# Seconds for which the history of feed updates is kept
+FEED_RUN_RETENTION = 7 * 24 * 3600
+ARTICLE_SIGNATURE = 'article_signature'
+ARTICLE_SIGNATURE_INDEX = 'idx_article_signature_created'
+ARTICLE_LSH = 'article_lsh'
+ARTICLE_LSH_INDEX = 'idx_article_lsh_band'
+ARTICLE_LSH_ARTICLE_INDEX = 'idx_article_lsh_article'
+ARTICLE_SEARCH = 'article_fts'
 ARTICLE_INDEX = 'idx_article_published'
-
-IMAGE_URL_REGEX = re.compile(r'"(https?://[^"]*\.(?:png|jpg))"', re.IGNORECASE)
-HTML_FIGURE_REGEX = re.compile(r'<figure>[\s\S]*?</figure>')
-HTML_P_REGEX = re.compile(r'</p><p>')
-HTML_TAG_REGEX = re.compile(r'<.*?>')
-EXTRA_SPACE_REGEX = re.compile(r' +')
-TRAILING_REPLACEMENTS = [
-    (re.compile(r' Read the full article on nintendolife\.com$'), ''),  # Nintendo Life
-    (re.compile(r' Continue reading…$'), '.'),
-    (re.compile(r'Read this article on TechRaptor$'), ''),  # TechRaptor
-    (re.compile(r' View the full site RELATED LINKS:.*$'), ''),
-    (re.compile(r' Continue reading .*$'), ''),
-    (re.compile(r' Read more$'), ''),
-    (re.compile(r' The post .* appeared first on Nintendojo\.$'), ''),  # Nintendojo
-    (re.compile(r' \[…]$'), '...'),
-    (re.compile(r'Read article >$'), '...'),  # NVIDIA Blog
-    (re.compile(r'\. Read the full article on GamingOnLinux\.$'), ''),  # GamingOnLinux
+# Weights of title, summary and author when ranking search results
+ARTICLE_SEARCH_RANK = 'bm25(10.0, 1.0, 2.0)'
+ARTICLE_SEARCH_TRIGGERS = {
+    'article_fts_insert': 'AFTER INSERT ON article BEGIN '
+                          'INSERT INTO article_fts (rowid, title, summary, author) '
+                          'VALUES (new.id, new.title, new.summary, new.author); '
+                          'END',
+    'article_fts_delete': 'AFTER DELETE ON article BEGIN '
+                          "INSERT INTO article_fts (article_fts, rowid, title, summary, author) "
+                          "VALUES ('delete', old.id, old.title, old.summary, old.author); "
+                          'END',
+    'article_fts_update': 'AFTER UPDATE OF title, summary, author ON article BEGIN '
+                          "INSERT INTO article_fts (article_fts, rowid, title, summary, author) "
+                          "VALUES ('delete', old.id, old.title, old.summary, old.author); "
+                          'INSERT INTO article_fts (rowid, title, summary, author) '
+                          'VALUES (new.id, new.title, new.summary, new.author); '
+                          'END',
+}
+# Feed elements used by the scheduler
+FEED_SCHEDULE_KEYS = ['ttl', 'sy_updateperiod', 'sy_updatefrequency']
+SHARDS_PER_WORKER = 4
+SITE_SCHEDULE_COLUMNS = [
+    ('update_interval', 'REAL'),
+    ('next_update', 'INTEGER'),
+    ('last_update', 'INTEGER'),
+    ('update_errors', 'INTEGER NOT NULL DEFAULT 0'),
 ]
+ARTICLE_ORIGINAL_INDEX = 'idx_article_site_original'
+ARTICLE_SITE_INDEX = 'idx_article_site_published'
+SITE_NAME_INDEX = 'idx_site_name'
+# Records read from a feed before looking up which of them are already stored
+RECORD_CHUNK_SIZE = 10
+# Number of consecutive stored and unchanged records after which the rest of a feed is not read
+KNOWN_RECORDS_BEFORE_STOP = 3
+# Maximum seconds between checks of the feeds file for changes
+FEEDS_RELOAD_INTERVAL = 30
+# Seconds after which feeds whose update was aborted by a failed worker process are due again
+WORKER_RESTART_DELAY = 60
+BULK_CHECKPOINT = 'bulk_checkpoint'
+# Articles written per transaction by bulk jobs
+BULK_TRANSACTION_SIZE = 50000
+# Stored articles read per query when re-cleaning them
+RECLEAN_BATCH_SIZE = 10000
+# Files parsed ahead per worker process during bulk imports, which bounds the memory held by parsed articles
+IMPORT_FILES_AHEAD = 2
+# Seconds between progress messages of bulk jobs
+PROGRESS_INTERVAL = 10
+GZIP_MAGIC = b'\x1f\x8b'
 
 
 def main():
-    database_path, feeds_file, update_interval, single_run = parse_arguments()
+    (database_path, feeds_file, update_interval, single_run, concurrency, workers, rebuild_search, reingest,
+     archive_after, retention, image_cache, host_interval, bulk_import_paths, site, reclean) = parse_arguments()
     logging.info(f'Database path set to: "{database_path}"')
 
-    db_con = sqlite3.connect(database_path)
+    db_con = database.connect(database_path)
 
     create_tables(db_con)
 
+    if rebuild_search:
+        rebuild_search_index(db_con)
+        return
+
+    if reingest:
+        reingest_feeds(db_con)
+        return
+
+    if reclean:
+        reclean_articles(db_con)
+        return
+
+    if bulk_import_paths:
+        if feeds_file is not None:
+            initialize_feeds(db_con, feeds_file)
+        bulk_import(db_con, site, bulk_import_paths, workers)
+        return
+
     feeds = initialize_feeds(db_con, feeds_file)
     logging.info(f'Monitoring sites: {list(feeds.keys())}')
 
+    prefetcher = None
+    if image_cache is not None:
+        logging.info(f'Prefetching images into: "{image_cache}"')
+        prefetcher = images.ImagePrefetcher(images.ImageCache(image_cache))
+        prefetch_icons(db_con, prefetcher)
+
     # Run update once then exit
     if single_run:
-        db_connection = sqlite3.connect(database_path)
+        db_connection = database.connect(database_path)
         logging.info('Updating feeds.')
-        success = update_feeds(db_connection, feeds)
+        success = update_feeds(db_connection, feeds, concurrency, workers=workers, prefetcher=prefetcher,
+                               host_interval=host_interval)
         log_update_feeds(db_connection, success)
+        remove_old_feed_runs(db_connection)
+        maintain_articles(db_connection, archive_after, retention)
+        database.maintain(db_connection)
+        if prefetcher is not None:
+            prefetcher.close()
         logging.info('Updating feeds complete, exiting...')
         return
 
     stop_event = threading.Event()
-    update_thread = threading.Thread(target=update_feeds_loop, args=(database_path, feeds, update_interval, stop_event))
+    update_thread = threading.Thread(target=update_feeds_loop, args=(database_path, feeds_file, feeds, update_interval,
+                                                                     concurrency, workers, host_interval,
+                                                                     archive_after, retention, prefetcher, stop_event))
 
     logging.info('Starting update thread.')
     update_thread.start()
@@ -72,15 +158,63 @@ def main():
             logging.warning(f'Unknown command: "{text}"')
 
 
-def update_feeds_loop(db_path, feeds, interval: float, stop_event: threading.Event):
-    db_connection = sqlite3.connect(db_path)
+def update_feeds_loop(db_path, feeds_file, feeds, interval: float, concurrency: int, workers: int,
+                      host_interval: float, archive_after: float, retention: float,
+                      prefetcher: images.ImagePrefetcher, stop_event: threading.Event):
+    """
+    Updates each feed whenever it is due according to its adaptive polling schedule.
+    Changes of the feeds file are picked up without restarting. With workers, the worker processes are started once and
+    kept for all updates.
+    """
+    db_connection = database.connect(db_path)
+    executor = worker_pool(workers) if workers > 0 else None
+
+    scheduler = Scheduler(interval)
+    scheduler.load(db_connection.cursor(), feeds.values())
+    last_maintenance = time.time()
+    feeds_modified = feeds_file_modified(feeds_file)
 
     while not stop_event.is_set():
-        logging.info('Updating feeds.')
-        success = update_feeds(db_connection, feeds)
-        log_update_feeds(db_connection, success)
-        logging.info('Updating feeds complete.')
-        stop_event.wait(interval)
+        modified = feeds_file_modified(feeds_file)
+        if modified is not None and modified != feeds_modified:
+            logging.info(f'"{feeds_file}" changed, reloading feeds.')
+            feeds_modified = modified
+            feeds = reload_feeds(db_connection, feeds_file, feeds, scheduler, prefetcher)
+
+        due = set(scheduler.due())
+        started = time.time()
+        if due:
+            logging.info(f'Updating {len(due)} feeds.')
+            due_feeds = {name: site_id for name, site_id in feeds.items() if site_id in due}
+            try:
+                success = update_feeds(db_connection, due_feeds, concurrency, scheduler, workers, prefetcher,
+                                       host_interval, executor)
+            except BrokenProcessPool as e:
+                logging.error(f'Worker process terminated abruptly, restarting worker processes: {e!r}')
+                executor.shutdown(wait=False)
+                executor = worker_pool(workers)
+                # Feeds of the shards which were not stored were taken from the schedule without being rescheduled.
+                # They are retried after a delay, so that a feed which crashes the workers does not restart them in a
+                # loop.
+                requeued = scheduler.requeue(db_connection.cursor(), due, started, time.time() + WORKER_RESTART_DELAY)
+                logging.info(f'Retrying {len(requeued)} feeds in {WORKER_RESTART_DELAY}s.')
+                success = False
+            log_update_feeds(db_connection, success)
+            logging.info('Updating feeds complete.')
+
+        if time.time() - last_maintenance >= database.MAINTENANCE_INTERVAL:
+            remove_old_feed_runs(db_connection)
+            maintain_articles(db_connection, archive_after, retention)
+            database.maintain(db_connection)
+            last_maintenance = time.time()
+
+        stop_event.wait(min(scheduler.time_until_next(), FEEDS_RELOAD_INTERVAL))
+
+    database.maintain(db_connection)
+    if executor is not None:
+        executor.shutdown()
+    if prefetcher is not None:
+        prefetcher.close(wait=False)
 
 
 def parse_arguments():
@@ -89,23 +223,92 @@ def parse_arguments():
     parser.add_argument('-d', '--database-path', help='Path to the database file.', type=str, default='articles.db')
     parser.add_argument('-l', '--log-level', help='Log level for logging messages.', type=str, default='INFO',
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'])
-    parser.add_argument('-i', '--update-interval', help='Interval between checking for news feed updates in seconds.',
+    parser.add_argument('-i', '--update-interval',
+                        help='Initial interval between checking for news feed updates in seconds, which is then '
+                             'adapted to the update frequency of each feed.',
                         type=float, default=60 * 60)
+    parser.add_argument('-c', '--concurrency', help='Maximum number of feeds fetched at the same time.', type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Number of worker processes fetching and parsing feeds, 0 to fetch and parse in threads of '
+                             'the collector process.')
+    parser.add_argument('--host-interval', type=float, default=DEFAULT_HOST_INTERVAL,
+                        help='Minimum seconds between the starts of requests to the same host.')
+    parser.add_argument('--archive-after', type=float, default=0,
+                        help='Age in days after which articles are moved into monthly archive tables, 0 to never '
+                             'archive articles.')
+    parser.add_argument('--retention', type=float, default=0,
+                        help='Age in days after which articles are deleted, 0 to keep articles forever.')
+    parser.add_argument('--image-cache', type=str, default=None,
+                        help='Image cache directory of the API (default of the API: instance/images) into which the '
+                             'thumbnails of new articles and the site icons are fetched ahead of time.')
     parser.add_argument('--single-run', action='store_true', help='Update feeds only once, then exit.')
-    parser.add_argument('feeds', help='CSV file containing on each line the feed name and feed URL.')
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help='Rebuild the full-text search index from all stored articles, then exit.')
+    parser.add_argument('--reingest', action='store_true',
+                        help='Extract the articles of the last fetched body of every feed again, e.g. after changing '
+                             'the cleaning rules, then exit.')
+    parser.add_argument('--bulk-import', nargs='+', metavar='PATH', default=[],
+                        help='Store the articles of saved feed bodies of the site given with --site, given as files or '
+                             'directories of files which may be gzip compressed, then exit. Stored articles are '
+                             'overwritten. Uses the worker processes of --workers.')
+    parser.add_argument('--site', type=str, help='Name of the site whose feed bodies are imported with --bulk-import.')
+    parser.add_argument('--reclean', action='store_true',
+                        help='Apply the cleaning rules to the summaries of all stored articles again, e.g. after '
+                             'adding trailing messages, then exit.')
+    parser.add_argument('feeds', nargs='?', help='CSV file containing on each line the feed name and feed URL.')
 
     args = parser.parse_args()
 
+    if args.bulk_import and args.site is None:
+        parser.error('--bulk-import requires --site')
+    if (args.feeds is None and not args.rebuild_search_index and not args.reingest and not args.reclean
+            and not args.bulk_import):
+        parser.error('the following arguments are required: feeds')
+
     loglevel = getattr(logging, args.log_level)
-    logging.basicConfig(level=loglevel, format='%(asctime)s - %(levelname)s - %(message)s')
+    configure_logging(loglevel)
     logging.info(f'Set log level to: {logging.getLevelName(loglevel)}')
 
-    return args.database_path, args.feeds, args.update_interval, args.single_run
+    return (args.database_path, args.feeds, args.update_interval, args.single_run, args.concurrency, args.workers,
+            args.rebuild_search_index, args.reingest, args.archive_after, args.retention,
+            args.image_cache, args.host_interval, args.bulk_import, args.site, args.reclean)
+
+
+def configure_logging(loglevel):
+    logging.basicConfig(level=loglevel, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
 def create_tables(db_connection):
+    """
+    Brings the schema up to date by running the migrations the database has not seen yet. The number of applied
+    migrations is stored as the schema version in PRAGMA user_version, so an up to date database is not probed at all.
+    """
     cursor = db_connection.cursor()
+    version, = cursor.execute('PRAGMA user_version').fetchone()
+    if version > len(SCHEMA_MIGRATIONS):
+        logging.warning(f'Database schema version {version} is newer than the latest known version '
+                        f'{len(SCHEMA_MIGRATIONS)}.')
+        return
+
+    for number, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        logging.info(f'Migrating database schema to version {number}: {migration.__name__}')
+        start = time.perf_counter()
+        # Each migration is applied together with its version number in one transaction
+        cursor.execute('BEGIN')
+        migration(db_connection, cursor)
+        # Pragmas take no parameters
+        cursor.execute(f'PRAGMA user_version = {number:d}')
+        db_connection.commit()
+        logging.info(f'Migrating database schema to version {number} complete after '
+                     f'{time.perf_counter() - start:.1f}s.')
+
 
+def create_schema(db_connection, cursor):
+    """
+    Creates the tables, indexes and triggers, or whatever is missing of them in databases created before the schema was
+    versioned, which may have any of the earlier schemas.
+    """
     if not table_exists(cursor, SITE):
         logging.info(f'{SITE} table not created yet. Creating {SITE} table.')
         cursor.execute('CREATE TABLE site ('
@@ -117,6 +320,11 @@ def create_tables(db_connection):
                        'modified TEXT'
                        ')')
 
+    for column, definition in SITE_SCHEDULE_COLUMNS:
+        if not column_exists(cursor, SITE, column):
+            logging.info(f'{SITE}.{column} column not created yet. Creating {SITE}.{column} column.')
+            cursor.execute(f'ALTER TABLE {SITE} ADD COLUMN {column} {definition}')
+
     if not table_exists(cursor, ARTICLE):
         logging.info(f'{ARTICLE} table not created yet. Creating {ARTICLE} table.')
         cursor.execute('CREATE TABLE article ('
@@ -131,10 +339,28 @@ def create_tables(db_connection):
                        'author TEXT'
                        ')')
 
+    if not column_exists(cursor, ARTICLE, 'content_hash'):
+        logging.info(f'{ARTICLE}.content_hash column not created yet. Creating {ARTICLE}.content_hash column.')
+        cursor.execute(f'ALTER TABLE {ARTICLE} ADD COLUMN content_hash TEXT')
+
+    # Oldest article of the group of near-duplicates an article belongs to
+    for table in [ARTICLE] + [table for table, _, _ in archive.archive_tables(cursor)]:
+        if not column_exists(cursor, table, 'duplicate_of'):
+            logging.info(f'{table}.duplicate_of column not created yet. Creating {table}.duplicate_of column.')
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN duplicate_of INTEGER')
+
     if not index_exists(cursor, ARTICLE_INDEX):
         logging.info(f'{ARTICLE_INDEX} index not created yet. Creating {ARTICLE_INDEX} index.')
         cursor.execute('CREATE INDEX idx_article_published ON article (published)')
 
+    if not index_exists(cursor, ARTICLE_ORIGINAL_INDEX):
+        logging.info(f'{ARTICLE_ORIGINAL_INDEX} index not created yet. Creating {ARTICLE_ORIGINAL_INDEX} index.')
+        cursor.execute('CREATE UNIQUE INDEX idx_article_site_original ON article (site_id, original_id)')
+
+    if not index_exists(cursor, ARTICLE_SITE_INDEX):
+        logging.info(f'{ARTICLE_SITE_INDEX} index not created yet. Creating {ARTICLE_SITE_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_article_site_published ON article (site_id, published)')
+
     if not table_exists(cursor, SYSTEM):
         logging.info(f'{SYSTEM} table not created yet. Creating {SYSTEM} table.')
         cursor.execute('CREATE TABLE system ('
@@ -142,46 +368,470 @@ def create_tables(db_connection):
                        'success INTEGER'
                        ')')
 
-    db_connection.commit()
+    if not table_exists(cursor, FEED_BODY):
+        logging.info(f'{FEED_BODY} table not created yet. Creating {FEED_BODY} table.')
+        # Last raw body of each feed, to skip parsing it again if unchanged and to re-ingest it offline
+        cursor.execute('CREATE TABLE feed_body ('
+                       'site_id INTEGER PRIMARY KEY REFERENCES site (id), '
+                       'hash TEXT, '
+                       'body BLOB, '  # zlib compressed
+                       'headers TEXT, '  # JSON object of the response headers
+                       'update_time INTEGER'
+                       ')')
+
+    if not table_exists(cursor, ARTICLE_SIGNATURE):
+        logging.info(f'{ARTICLE_SIGNATURE} table not created yet. Creating {ARTICLE_SIGNATURE} table.')
+        # SimHash signatures of recent articles for near-duplicate detection
+        cursor.execute('CREATE TABLE article_signature ('
+                       'article_id INTEGER PRIMARY KEY, '
+                       'site_id INTEGER, '
+                       'simhash INTEGER, '
+                       'created INTEGER'
+                       ')')
+
+    if not index_exists(cursor, ARTICLE_SIGNATURE_INDEX):
+        logging.info(f'{ARTICLE_SIGNATURE_INDEX} index not created yet. Creating {ARTICLE_SIGNATURE_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_article_signature_created ON article_signature (created)')
+
+    if not table_exists(cursor, ARTICLE_LSH):
+        logging.info(f'{ARTICLE_LSH} table not created yet. Creating {ARTICLE_LSH} table.')
+        # Locality-sensitive hashing buckets of the signatures
+        cursor.execute('CREATE TABLE article_lsh ('
+                       'band_key INTEGER, '
+                       'article_id INTEGER'
+                       ')')
+
+    if not index_exists(cursor, ARTICLE_LSH_INDEX):
+        logging.info(f'{ARTICLE_LSH_INDEX} index not created yet. Creating {ARTICLE_LSH_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_article_lsh_band ON article_lsh (band_key)')
+
+    if not index_exists(cursor, ARTICLE_LSH_ARTICLE_INDEX):
+        logging.info(f'{ARTICLE_LSH_ARTICLE_INDEX} index not created yet. Creating {ARTICLE_LSH_ARTICLE_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_article_lsh_article ON article_lsh (article_id)')
+
+    if not table_exists(cursor, FEED_RUN):
+        logging.info(f'{FEED_RUN} table not created yet. Creating {FEED_RUN} table.')
+        cursor.execute('CREATE TABLE feed_run ('
+                       'id INTEGER PRIMARY KEY, '
+                       'site_id INTEGER REFERENCES site (id), '
+                       'update_time INTEGER, '
+                       'status INTEGER, '  # HTTP status, NULL if the feed could not be fetched
+                       'bytes INTEGER, '
+                       'fetch_time REAL, '  # Seconds spent on the network
+                       'parse_time REAL, '
+                       'extract_time REAL, '  # Including clean_time
+                       'clean_time REAL, '
+                       'store_time REAL, '
+                       'commit_time REAL, '  # Duration of the commit which stored the run
+                       'new_articles INTEGER, '
+                       'duplicate_articles INTEGER, '
+                       'error TEXT'
+                       ')')
+
+    if not index_exists(cursor, FEED_RUN_INDEX):
+        logging.info(f'{FEED_RUN_INDEX} index not created yet. Creating {FEED_RUN_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_feed_run_site_time ON feed_run (site_id, update_time)')
+
+    if not index_exists(cursor, FEED_RUN_TIME_INDEX):
+        logging.info(f'{FEED_RUN_TIME_INDEX} index not created yet. Creating {FEED_RUN_TIME_INDEX} index.')
+        cursor.execute('CREATE INDEX idx_feed_run_time ON feed_run (update_time)')
+
+    if not table_exists(cursor, ARTICLE_SEARCH):
+        logging.info(f'{ARTICLE_SEARCH} table not created yet. Creating {ARTICLE_SEARCH} table.')
+        # External content full-text index, which only stores the index and reads the text from the article table
+        cursor.execute("CREATE VIRTUAL TABLE article_fts USING fts5("
+                       "title, summary, author, "
+                       "content='article', content_rowid='id', "
+                       "tokenize='porter unicode61 remove_diacritics 2'"
+                       ")")
+        cursor.execute("INSERT INTO article_fts (article_fts, rank) VALUES ('rank', ?)", (ARTICLE_SEARCH_RANK,))
+        # Part of the migration transaction, which is committed together with the schema version
+        rebuild_search_index(db_connection, commit=False)
+
+    for trigger, definition in ARTICLE_SEARCH_TRIGGERS.items():
+        if not trigger_exists(cursor, trigger):
+            logging.info(f'{trigger} trigger not created yet. Creating {trigger} trigger.')
+            cursor.execute(f'CREATE TRIGGER {trigger} {definition}')
+
+
+def add_site_name_index(db_connection, cursor):
+    """
+    Makes site names unique, so that sites can be registered by name in one upsert.
+    """
+    cursor.execute(f'CREATE UNIQUE INDEX {SITE_NAME_INDEX} ON site (name)')
+
+
+def add_fetch_failures(db_connection, cursor):
+    """
+    Adds the circuit breaker state of each site and the number of retries of each feed update.
+    """
+    cursor.execute('ALTER TABLE site ADD COLUMN circuit_failures INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE site ADD COLUMN circuit_open_until INTEGER')
+    cursor.execute('ALTER TABLE feed_run ADD COLUMN retries INTEGER')
+
+
+def add_timeline(db_connection, cursor):
+    """
+    Adds the timeline of the newest articles, filled from the stored articles.
+    """
+    timeline.create_timeline(cursor)
+
+
+def add_bulk_checkpoints(db_connection, cursor):
+    """
+    Adds the checkpoints of bulk jobs, which let an interrupted job resume where it stopped.
+    """
+    cursor.execute(f'CREATE TABLE {BULK_CHECKPOINT} ('
+                   'job TEXT, '
+                   'item TEXT, '  # File or table the checkpoint belongs to
+                   'position INTEGER, '  # Last processed ID of a table
+                   'PRIMARY KEY (job, item)'
+                   ')')
+
+
+def add_duplicate_index(db_connection, cursor):
+    """
+    Indexes the groups of near-duplicates in the article and archive tables, which are looked up to collapse them.
+    """
+    for table in [ARTICLE] + [table for table, _, _ in archive.archive_tables(cursor)]:
+        cursor.execute(f'CREATE INDEX idx_{table}_duplicate_of ON {table} (duplicate_of) '
+                       'WHERE duplicate_of IS NOT NULL')
+
+
+# Applied in order, each bringing the schema to the version of its position in the list. New migrations are appended
+# and never change once released. Migrations altering the article table also need to alter the archive tables.
+SCHEMA_MIGRATIONS = [create_schema, add_site_name_index, add_fetch_failures, add_timeline, add_bulk_checkpoints,
+                     add_duplicate_index]
+
+
+def rebuild_search_index(db_connection, commit=True):
+    """
+    Rebuilds the full-text search index from the article and archive tables, e.g. to index articles stored before it
+    existed. With commit unset, the rebuild is left to the transaction of the caller, e.g. a schema migration.
+    """
+    logging.info('Rebuilding search index.')
+    start = time.perf_counter()
+    cursor = db_connection.cursor()
+    cursor.execute("INSERT INTO article_fts (article_fts) VALUES ('rebuild')")
+    for table, _, _ in archive.archive_tables(cursor):
+        archive.add_to_search_index(cursor, table)
+    if commit:
+        db_connection.commit()
+    logging.info(f'Rebuilding search index complete after {time.perf_counter() - start:.1f}s.')
+
+
+def reingest_feeds(db_connection):
+    """
+    Extracts the articles of the stored raw body of every feed again without fetching it, storing missing articles and
+    overwriting stored ones.
+    """
+    logging.info('Re-ingesting stored feed bodies.')
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT name, site_id, body, headers FROM feed_body JOIN site ON site.id = site_id')
+    for name, site_id, body, headers in cursor.fetchall():
+        try:
+            articles = extract_articles(name, parse_raw(body, json.loads(headers)))
+        except (AttributeError, ValueError) as e:
+            # E.g. unparseable dates, which must not stop the remaining feeds from being re-ingested
+            logging.error(f'Encountered {type(e).__name__} while re-ingesting "{name}": {e}')
+            continue
+
+        inserted, updated = overwrite_articles(db_connection.cursor(), site_id, articles)
+        db_connection.commit()
+        logging.info(f'Re-ingested "{name}": inserted {inserted} and updated {updated} articles.')
+
+
+def overwrite_articles(cursor, site_id, articles):
+    """
+    Stores the given ArticleRecords of a site, inserting missing articles and overwriting stored ones even if their
+    entries did not change. Archived articles are not updated. Returns the numbers of inserted and updated articles.
+    """
+    archived = archived_article_ids(cursor, site_id, articles)
+    articles = [article.row(site_id) for article in articles if article.original_id not in archived]
+    # Forget the content hashes, so that articles are updated even though their entries did not change
+    cursor.executemany('UPDATE article SET content_hash=NULL WHERE site_id=? AND original_id=?',
+                       [(site_id, article[0]) for article in articles])
+    inserted = insert_articles(cursor, articles)
+    updated = update_articles(cursor, articles)
+    return inserted, updated
+
+
+def log_progress(description, done, total, start):
+    """
+    Logs the progress of a bulk job which completed done of total items, estimating the remaining time.
+    """
+    elapsed = time.perf_counter() - start
+    remaining = elapsed / done * (total - done) if done else 0
+    logging.info(f'{description}, {done}/{total} done, {remaining:.0f}s remaining.')
+
+
+def bulk_files(paths):
+    """
+    Returns the files given as files or directories, which are searched recursively, in sorted order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.extend(os.path.join(directory, name) for name in names)
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            logging.error(f'"{path}" does not exist.')
+    return sorted(files)
+
+
+def file_checkpoint(path):
+    """
+    Returns the checkpoint item of a file, which changes when the file changes.
+    """
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def extract_file(name, path):
+    """
+    Reads a saved feed body, which may be gzip compressed, and returns its cleaned ArticleRecords and None, or None and
+    the error if it cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.startswith(GZIP_MAGIC):
+            data = gzip.decompress(data)
+        return extract_articles(name, parse_body(data, {})), None
+    except (OSError, EOFError, AttributeError, ValueError) as e:
+        return None, e
+
+
+def extract_files(name, paths, workers):
+    """
+    Yields the results of extract_file for the given files in order. With workers, files are parsed in that many worker
+    processes, which only parse a few files ahead of the files consumed.
+    """
+    if workers <= 0:
+        for path in paths:
+            yield extract_file(name, path)
+        return
+
+    with worker_pool(workers) as executor:
+        futures = deque()
+        for path in paths:
+            futures.append(executor.submit(extract_file, name, path))
+            if len(futures) >= workers * IMPORT_FILES_AHEAD:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def bulk_import(db_connection, name, paths, workers):
+    """
+    Stores the articles of saved feed bodies of a site, e.g. the history of a new site, overwriting stored articles.
+    Files are parsed in worker processes and their articles are written in large transactions with relaxed
+    durability. Written files are checkpointed together with their articles, so that an interrupted import skips them
+    when it is run again. Returns whether all files were imported.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT id FROM site WHERE name=?', (name,))
+    result = cursor.fetchone()
+    if result is None:
+        logging.error(f'Site "{name}" is not registered, add it to the feeds file first.')
+        return False
+    site_id, = result
+
+    job = f'import:{site_id}'
+    cursor.execute(f'SELECT item FROM {BULK_CHECKPOINT} WHERE job=?', (job,))
+    imported = {item for item, in cursor.fetchall()}
+    all_files = [(path, file_checkpoint(path)) for path in bulk_files(paths)]
+    files = [(path, item) for path, item in all_files if item not in imported]
+    logging.info(f'Importing {len(files)} files of "{name}", skipping {len(all_files) - len(files)} files imported '
+                 'before.')
+
+    start = time.perf_counter()
+    last_report = start
+    success = True
+    n_articles = 0
+    uncommitted = 0
+    with database.bulk_writes(db_connection):
+        results = extract_files(name, [path for path, _ in files], workers)
+        for done, ((path, item), (articles, error)) in enumerate(zip(files, results), start=1):
+            if error is not None:
+                logging.error(f'Encountered error while importing "{path}": {error!r}')
+                success = False
+                continue
+            overwrite_articles(cursor, site_id, articles)
+            cursor.execute(f'INSERT OR REPLACE INTO {BULK_CHECKPOINT} (job, item) VALUES (?, ?)', (job, item))
+            n_articles += len(articles)
+            uncommitted += len(articles)
+            if uncommitted >= BULK_TRANSACTION_SIZE:
+                db_connection.commit()
+                uncommitted = 0
+            if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.perf_counter()
+                log_progress(f'Importing "{name}": {n_articles} articles '
+                             f'({n_articles / (last_report - start):.0f}/s) from files', done, len(files), start)
+
+        # Checkpoints are only kept to resume an import which did not complete
+        if success:
+            cursor.execute(f'DELETE FROM {BULK_CHECKPOINT} WHERE job=?', (job,))
+        db_connection.commit()
+    # Cached pages and ETags of the web server are only renewed by a new row of the system table
+    if n_articles:
+        log_update_feeds(db_connection, True)
+    database.maintain(db_connection)
+    logging.info(f'Importing "{name}" complete after {time.perf_counter() - start:.1f}s, stored {n_articles} articles.')
+    return success
+
+
+def reclean_articles(db_connection):
+    """
+    Applies the cleaning rules which work on plain text to the summaries of all stored and archived articles again,
+    e.g. after adding trailing messages. Articles are read in batches by ID and changed summaries are written in large
+    transactions with relaxed durability. The last checked ID of each table is checkpointed together with the changes,
+    so that an interrupted run resumes where it stopped.
+    """
+    cursor = db_connection.cursor()
+    tables = [ARTICLE] + [table for table, _, _ in archive.archive_tables(cursor)]
+    cursor.execute(f"SELECT item, position FROM {BULK_CHECKPOINT} WHERE job='reclean'")
+    positions = dict(cursor.fetchall())
+    total = 0
+    for table in tables:
+        cursor.execute(f'SELECT count(*) FROM {table} WHERE id > ?', (positions.get(table, 0),))
+        total += cursor.fetchone()[0]
+    logging.info(f'Re-cleaning {total} articles.')
+
+    start = time.perf_counter()
+    last_report = start
+    checked = 0
+    updated = 0
+    uncommitted = 0
+    with database.bulk_writes(db_connection):
+        for table in tables:
+            last_id = positions.get(table, 0)
+            while True:
+                cursor.execute(f'SELECT id, title, summary, author FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                               (last_id, RECLEAN_BATCH_SIZE))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                changed = [(article_id, title, summary, cleaned, author)
+                           for article_id, title, summary, author in rows
+                           if summary is not None and (cleaned := reclean_summary(summary)) != summary]
+                cursor.executemany(f'UPDATE {table} SET summary=? WHERE id=?',
+                                   [(cleaned, article_id) for article_id, _, _, cleaned, _ in changed])
+                if table != ARTICLE:
+                    # Only the article table has triggers which keep the search index up to date
+                    cursor.executemany("INSERT INTO article_fts (article_fts, rowid, title, summary, author) "
+                                       "VALUES ('delete', ?, ?, ?, ?)",
+                                       [(article_id, title, summary, author)
+                                        for article_id, title, summary, _, author in changed])
+                    cursor.executemany('INSERT INTO article_fts (rowid, title, summary, author) VALUES (?, ?, ?, ?)',
+                                       [(article_id, title, cleaned, author)
+                                        for article_id, title, _, cleaned, author in changed])
+                cursor.execute(f"INSERT OR REPLACE INTO {BULK_CHECKPOINT} (job, item, position) "
+                               "VALUES ('reclean', ?, ?)", (table, last_id))
+                checked += len(rows)
+                updated += len(changed)
+                uncommitted += len(rows)
+                if uncommitted >= BULK_TRANSACTION_SIZE:
+                    db_connection.commit()
+                    uncommitted = 0
+                if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.perf_counter()
+                    log_progress(f'Re-cleaning: changed {updated} articles, checked '
+                                 f'{checked / (last_report - start):.0f}/s', checked, total, start)
+
+        cursor.execute(f"DELETE FROM {BULK_CHECKPOINT} WHERE job='reclean'")
+        db_connection.commit()
+    if updated:
+        log_update_feeds(db_connection, True)
+    database.maintain(db_connection)
+    logging.info(f'Re-cleaning complete after {time.perf_counter() - start:.1f}s, changed {updated} of {checked} '
+                 'articles.')
 
 
 def initialize_feeds(db_connection, feeds_file):
     logging.info(f'Reading feeds from: "{feeds_file}"')
 
-    with open(feeds_file) as f:
-        reader = csv.reader(f)
-        feeds = {name: get_site_id(db_connection, name, feed, icon) for (name, feed, icon) in reader}
+    with open(feeds_file, newline='') as f:
+        sites = [(name, feed, icon) for (name, feed, icon) in csv.reader(f)]
+
+    return sync_sites(db_connection, sites)
 
-    return feeds
+
+def feeds_file_modified(feeds_file):
+    """
+    Returns the modification time of the feeds file, or None if it cannot be read.
+    """
+    try:
+        return os.stat(feeds_file).st_mtime_ns
+    except OSError:
+        return None
 
 
-def get_site_id(db_connection, name, feed, icon):
+def reload_feeds(db_connection, feeds_file, feeds, scheduler, prefetcher):
     """
-    Returns internal site ID.
-    Creates database entry if it does not yet exist and updates icon URL if it has been changed.
+    Registers the sites of a changed feeds file and adds or removes them from the scheduler, which keeps the schedule
+    of the other sites. Returns the new dict of site names to site IDs, or the current one if the file is invalid.
     """
-    if not icon:
-        icon = None
+    try:
+        new_feeds = initialize_feeds(db_connection, feeds_file)
+    except (OSError, ValueError, csv.Error) as e:
+        logging.error(f'Could not reload feeds from "{feeds_file}", keeping the current feeds: {e}')
+        return feeds
+
+    removed = set(feeds.values()) - set(new_feeds.values())
+    scheduler.remove(removed)
+    added = scheduler.load(db_connection.cursor(), new_feeds.values())
+    logging.info(f'Reloaded feeds: added {added} and removed {len(removed)} sites.')
+    if prefetcher is not None:
+        prefetch_icons(db_connection, prefetcher)
+    return new_feeds
+
+
+def prefetch_icons(db_connection, prefetcher):
     cursor = db_connection.cursor()
-    # Check if site already inserted
-    cursor.execute("SELECT id, icon FROM site WHERE name=?", (name,))
-    results = cursor.fetchall()
+    cursor.execute('SELECT DISTINCT icon FROM site WHERE icon IS NOT NULL')
+    for icon, in cursor.fetchall():
+        prefetcher.prefetch(icon, 'icon')
 
-    if len(results) > 0:
-        site_id, current_icon = results[0]
-        if current_icon != icon:
-            logging.info(f'Updating "{name}" site icon from "{current_icon}" to "{icon}"')
-            cursor.execute("UPDATE site SET icon=? WHERE id=?", (icon, site_id))
-            db_connection.commit()
-        return site_id
 
-    logging.info(f'Site "{name}" not yet in database, will be inserted with feed: "{feed}"')
-    cursor.execute("INSERT INTO site (name, feed, icon) VALUES (?, ?, ?)", (name, feed, icon))
-    site_id = cursor.lastrowid
+def sync_sites(db_connection, sites):
+    """
+    Registers (name, feed, icon) sites in one transaction, inserting new sites and updating the feed and icon URLs of
+    changed ones. Returns a dict of the site names to their internal site IDs.
+    """
+    sites = {name: (feed, icon or None) for name, feed, icon in sites}
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT name, feed, icon FROM site')
+    stored = {name: (feed, icon) for name, feed, icon in cursor.fetchall()}
+
+    changed = []
+    for name, (feed, icon) in sites.items():
+        if name not in stored:
+            logging.info(f'Site "{name}" not yet in database, will be inserted with feed: "{feed}"')
+        elif stored[name] != (feed, icon):
+            current_feed, current_icon = stored[name]
+            if current_feed != feed:
+                logging.info(f'Updating "{name}" feed from "{current_feed}" to "{feed}"')
+            if current_icon != icon:
+                logging.info(f'Updating "{name}" site icon from "{current_icon}" to "{icon}"')
+        else:
+            continue
+        changed.append((name, feed, icon))
 
-    db_connection.commit()
+    if changed:
+        # The ETag and last modified date belong to the previous feed URL
+        cursor.executemany('INSERT INTO site (name, feed, icon) VALUES (?, ?, ?) '
+                           'ON CONFLICT (name) DO UPDATE SET feed=excluded.feed, icon=excluded.icon, '
+                           'etag=CASE WHEN feed=excluded.feed THEN etag END, '
+                           'modified=CASE WHEN feed=excluded.feed THEN modified END', changed)
+        db_connection.commit()
 
-    return site_id
+    cursor.execute('SELECT name, id FROM site')
+    site_ids = dict(cursor.fetchall())
+    return {name: site_ids[name] for name in sites}
 
 
 def db_object_exists(cursor, type_, name):
@@ -198,178 +848,434 @@ def index_exists(cursor, index):
     return db_object_exists(cursor, 'index', index)
 
 
-def fetch_feed(feed, etag: str = None, modified=None):
-    return feedparser.parse(feed, etag=etag, modified=modified)
+def trigger_exists(cursor, trigger):
+    return db_object_exists(cursor, 'trigger', trigger)
 
 
-def update_feeds(db_connection, feeds):
-    success = True
+def column_exists(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+def update_feeds(db_connection, feeds, concurrency: int = DEFAULT_CONCURRENCY, scheduler: Scheduler = None,
+                 workers: int = 0, prefetcher: images.ImagePrefetcher = None,
+                 host_interval: float = DEFAULT_HOST_INTERVAL, executor: ProcessPoolExecutor = None):
+    """
+    Fetches all feeds concurrently and stores new articles.
+    Fetching and parsing happen on worker threads, or in worker processes if workers is positive, while all database
+    writes happen on the calling thread. The worker processes are taken from the given pool of worker_pool, or started
+    for this update only if none is given.
+    Feeds whose site failed too often in a row are skipped until their circuit closes again.
+    If a scheduler is given, the next update of each feed is scheduled based on the outcome.
+    If a prefetcher is given, the thumbnails of new and changed articles are fetched into the image cache.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute("SELECT id, feed, etag, modified, hash FROM site LEFT JOIN feed_body ON site_id = id")
+    sites = {site_id: (feed_url, etag, modified, body_hash)
+             for (site_id, feed_url, etag, modified, body_hash) in cursor.fetchall()}
+
+    open_circuits = circuit.open_circuits(cursor)
+    jobs = []
     for name, site_id in feeds.items():
+        if site_id in open_circuits:
+            logging.info(f'Skipping "{name}" until {time.strftime("%H:%M", time.localtime(open_circuits[site_id]))} '
+                         'after repeated failures.')
+            if scheduler is not None:
+                scheduler.defer(cursor, site_id, open_circuits[site_id])
+            continue
         logging.info(f'Fetching articles for "{name}".')
-        cursor = db_connection.cursor()
-        try:
-            update_feed(cursor, name, site_id)
-        except AttributeError as e:
-            logging.error(f'Encountered attribute error: {e}')
-            db_connection.rollback()
-            success = False
-        except RemoteDisconnected as e:
-            logging.error(f'Encountered remote disconnected: {e}')
-            db_connection.rollback()
+        jobs.append(((name, site_id), *sites[site_id]))
+    db_connection.commit()
+
+    if workers > 0:
+        if executor is None:
+            with worker_pool(workers) as executor:
+                return update_feeds_in_workers(db_connection, jobs, executor, workers, concurrency, scheduler,
+                                               prefetcher, host_interval)
+        return update_feeds_in_workers(db_connection, jobs, executor, workers, concurrency, scheduler, prefetcher,
+                                       host_interval)
+
+    success = True
+    for (name, site_id), feed, error in FetchEngine(concurrency, host_interval=host_interval).fetch_all(jobs):
+        new_articles = 0
+        metrics = {}
+        failure = circuit.failed(feed, error)
+        if error is not None:
+            logging.error(f'Encountered error while fetching "{name}": {error!r}')
             success = False
         else:
-            db_connection.commit()
+            metrics.update(feed['metrics'])
+            cursor = db_connection.cursor()
+            # Only the writes of this feed are undone on errors, not the pending commit time of the previous feed run.
+            # The savepoint is released by the commit after recording the run.
+            cursor.execute('SAVEPOINT update_feed')
+            try:
+                new_articles = update_feed(cursor, name, site_id, feed, metrics, prefetcher)
+            except (AttributeError, ValueError) as e:
+                logging.error(f'Encountered {type(e).__name__} while reading "{name}": {e}')
+                cursor.execute('ROLLBACK TO update_feed')
+                success = False
+                error = e
+
+        circuit.record_update(db_connection.cursor(), name, site_id, failure)
+
+        if scheduler is not None:
+            scheduler.reschedule(db_connection.cursor(), site_id, feed, new_articles, error)
+        run_id = record_feed_run(db_connection.cursor(), site_id, metrics, new_articles, error)
+        commit_and_record(db_connection, [run_id])
 
     return success
 
 
-def log_update_feeds(db_connection, success):
-    current_time = int(time.time())
-    cursor = db_connection.cursor()
-    cursor.execute("INSERT INTO system (update_time, success) VALUES (?, ?)", (current_time, success))
-    db_connection.commit()
-
-
-def ensure_https(link: str):
+def record_feed_run(cursor, site_id, metrics, new_articles, error):
     """
-    Converts HTTP links into HTTPS links.
+    Stores the outcome and timings of updating a feed in the feed_run table and returns the ID of the run.
     """
-    if link.startswith('http:'):
-        return 'https' + link[4:]
-    return link
+    cursor.execute('INSERT INTO feed_run (site_id, update_time, status, bytes, fetch_time, parse_time, extract_time, '
+                   'clean_time, store_time, new_articles, duplicate_articles, retries, error) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (site_id, int(time.time()), metrics.get('status'), metrics.get('bytes'), metrics.get('fetch_time'),
+                    metrics.get('parse_time'), metrics.get('extract_time'), metrics.get('clean_time'),
+                    metrics.get('store_time'), new_articles, metrics.get('duplicate_articles'), metrics.get('retries'),
+                    repr(error) if error is not None else None))
+    return cursor.lastrowid
 
 
-def try_get_thumbnail(article):
-    # Check for media content
-    if 'media_content' in article:
-        for content in article.media_content:
-            return ensure_https(content['url'])
+def commit_and_record(db_connection, run_ids):
+    """
+    Commits and records the duration of the commit for the given feed runs.
+    The duration itself is committed with the next transaction.
+    """
+    start = time.perf_counter()
+    db_connection.commit()
+    commit_time = time.perf_counter() - start
+    qs = ', '.join(['?' for _ in run_ids])
+    db_connection.execute(f'UPDATE feed_run SET commit_time=? WHERE id IN ({qs})', (commit_time, *run_ids))
 
-    # Check for media thumbnail
-    if 'media_thumbnail' in article:
-        for content in article.media_thumbnail:
-            return ensure_https(content['url'])
 
-    # Check in links
-    if 'links' in article:
-        for link in article.links:
-            if link.type.startswith('image'):
-                return ensure_https(link.href)
+def remove_old_feed_runs(db_connection):
+    db_connection.execute('DELETE FROM feed_run WHERE update_time < ?', (int(time.time()) - FEED_RUN_RETENTION,))
+    db_connection.commit()
 
-    # Check in summary
-    matches = IMAGE_URL_REGEX.findall(article.summary)
-    if len(matches) > 0:
-        return ensure_https(matches[0])
 
-    return None
+def maintain_articles(db_connection, archive_after, retention):
+    """
+    Archives and deletes old articles if configured and compacts the database after articles were moved.
+    Also removes signatures which are too old for near-duplicate detection.
+    The timeline is filled up again if articles were moved out of it.
+    """
+    duplicates.remove_old_signatures(db_connection)
+    changed = 0
+    if archive_after > 0:
+        changed += archive.archive_articles(db_connection, archive_after)
+    if retention > 0:
+        changed += archive.remove_expired_articles(db_connection, retention)
+    if changed:
+        timeline.rebuild(db_connection.cursor())
+        db_connection.commit()
+        archive.compact(db_connection)
 
 
-def remove_html_tags(text):
-    # If there are no HTML tags in the original text, it is possible that the tags are HTML escaped
-    if not HTML_TAG_REGEX.search(text):
-        # Unescape HTML before any substitutions
-        text = html.unescape(text)
-    # Remove figure tags
-    text = HTML_FIGURE_REGEX.sub('', text)
-    # Replace change of p environment with space
-    text = HTML_P_REGEX.sub(' ', text)
-    # Remove remaining tags
-    text = HTML_TAG_REGEX.sub('', text)
-    return html.unescape(text)
+def log_update_feeds(db_connection, success):
+    current_time = int(time.time())
+    cursor = db_connection.cursor()
+    cursor.execute("INSERT INTO system (update_time, success) VALUES (?, ?)", (current_time, success))
+    db_connection.commit()
 
 
-def remove_extra_spaces(text):
-    # Remove newlines
-    text = text.replace('\n', ' ')
-    # Remove tabs
-    text = text.replace('\t', ' ')
-    # Remove duplicate spaces
-    text = EXTRA_SPACE_REGEX.sub(' ', text)
-    # Remove leading and trailing spaces
-    return text.strip()
+def existing_article_hashes(cursor, site_id, article_ids, table=ARTICLE):
+    """
+    Returns a dict of the given publisher article IDs which are already stored for the site to their content hash.
+    """
+    return dict(database.query_in_chunks(cursor, f'SELECT original_id, content_hash FROM {table} '
+                                                 'WHERE site_id=? AND original_id', article_ids, (site_id,)))
 
 
-def remove_trailing_message(text: str):
+def archived_article_ids(cursor, site_id, articles):
     """
-    Removes unrelated trailing messages.
+    Returns the publisher IDs of the given ArticleRecords which are stored in the archive table of their month.
     """
-    for regex, replacement in TRAILING_REPLACEMENTS:
-        text = regex.sub(replacement, text)
+    tables = {table for table, _, _ in archive.archive_tables(cursor)}
+    by_table = {}
+    for article in articles:
+        table = archive.archive_table(article.published)
+        if table in tables:
+            by_table.setdefault(table, []).append(article.original_id)
 
-    return text
+    archived = set()
+    for table, article_ids in by_table.items():
+        archived.update(existing_article_hashes(cursor, site_id, article_ids, table))
+    return archived
 
 
-def article_exists(cursor, article_id):
-    cursor.execute('SELECT original_id FROM article WHERE original_id=?', (article_id,))
-    results = cursor.fetchall()
-    return len(results) > 0
+def stored_article_hashes(cursor, site_id, articles):
+    """
+    Returns a dict of the publisher IDs of the given ArticleRecords which are already stored for the site to their
+    content hash. Archived articles are never updated, so they are returned with their current content hash.
+    """
+    stored = existing_article_hashes(cursor, site_id, [article.original_id for article in articles])
+    missing = [article for article in articles if article.original_id not in stored]
+    if missing:
+        archived = archived_article_ids(cursor, site_id, missing)
+        stored.update((article.original_id, article.content_hash) for article in missing
+                      if article.original_id in archived)
+    return stored
 
 
-def insert_article(cursor, article_id, site_id, title, summary, link, thumbnail, published, author):
-    cursor.execute('INSERT INTO article (original_id, site_id, title, summary, link, thumbnail, published, author) '
-                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                   (article_id, site_id, title, summary, link, thumbnail, published, author))
+def insert_articles(cursor, articles):
+    """
+    Inserts (article_id, site_id, title, summary, link, thumbnail, published, author, content_hash) tuples, skipping
+    articles which already exist. Returns the number of inserted articles.
+    The timeline is trimmed back to its size after articles were inserted.
+    """
+    cursor.executemany('INSERT OR IGNORE INTO article '
+                       '(original_id, site_id, title, summary, link, thumbnail, published, author, content_hash) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', articles)
+    inserted = cursor.rowcount
+    if inserted:
+        timeline.trim(cursor)
+    return inserted
 
 
-def update_feed(cursor, name, site_id):
-    # Get etag or last modified date
-    cursor.execute("SELECT feed, etag, modified FROM site WHERE id=?", (site_id,))
-    (feed_url, etag, modified) = cursor.fetchall()[0]
+def update_articles(cursor, articles):
+    """
+    Updates the stored articles of the given insert_articles tuples whose content hash differs, keeping their
+    publication date so that their position in the feed does not change. Returns the number of updated articles.
+    """
+    cursor.executemany('UPDATE article SET title=?, summary=?, link=?, thumbnail=?, author=?, content_hash=? '
+                       'WHERE site_id=? AND original_id=? AND content_hash IS NOT ?',
+                       [(title, summary, link, thumbnail, author, content_hash, site_id, article_id, content_hash)
+                        for (article_id, site_id, title, summary, link, thumbnail, _, author, content_hash)
+                        in articles])
+    return cursor.rowcount
 
-    feed = fetch_feed(feed_url, etag, modified)
 
-    # Check response status
-    if feed.status == 304:
-        logging.info(f'No new articles for "{name}".')
-        return
+def not_modified(feed):
+    """
+    Returns whether a fetched feed or its summary has not changed since it was last stored.
+    """
+    return feed.get('status') == 304 or feed.get('unchanged', False)
+
 
+def summarize_feed(feed):
+    """
+    Returns the parts of a fetched feed other than its entries which are needed to store and schedule it.
+    """
+    channel = feed.get('feed', {})
+    return {
+        'status': feed.get('status'),
+        'etag': feed.get('etag'),
+        'modified': feed.get('modified'),
+        'headers': dict(feed.get('headers', {})),
+        'feed': {key: channel[key] for key in FEED_SCHEDULE_KEYS if key in channel},
+        'metrics': dict(feed.get('metrics', {})),
+        'unchanged': feed.get('unchanged', False),
+        'raw': feed.get('raw'),
+    }
+
+
+def extract_articles(name, records, existing=None, metrics=None):
+    """
+    Returns the cleaned ArticleRecords of all records of a feed which are new or changed.
+    If given, existing is called with lists of records and returns a dict of the publisher IDs of those which are already
+    stored to their content hash. Reading then stops once KNOWN_RECORDS_BEFORE_STOP consecutive records are stored unchanged
+    and all records so far were ordered from newest to oldest, as the rest of the feed was seen by earlier updates.
+    If a metrics dict is given, the time spent parsing, extracting and cleaning and the number of skipped entries are
+    added.
+    """
+    start = time.perf_counter()
+    parse_time = 0
+    clean_time = 0
+    read = 0
+    seen = set()
+    new_articles = []
+    known = 0
+    newest_first = True
+    previous = None
+    records = iter(records)
+
+    while True:
+        parse_start = time.perf_counter()
+        chunk = list(itertools.islice(records, RECORD_CHUNK_SIZE))
+        parse_time += time.perf_counter() - parse_start
+        if not chunk:
+            break
+        read += len(chunk)
+        stored = existing(chunk) if existing is not None else {}
+
+        for article in chunk:
+            if article.original_id in seen:
+                continue
+            seen.add(article.original_id)
+            newest_first = newest_first and (previous is None or article.published <= previous)
+            previous = article.published
+            if stored.get(article.original_id) == article.content_hash:
+                known += 1
+                continue
+            known = 0
+
+            # Unescape HTML entities from title (required for Polygon)
+            article.title = html.unescape(article.title)
+            clean_start = time.perf_counter()
+            article.summary = clean_summary(article.summary)
+            clean_time += time.perf_counter() - clean_start
+            new_articles.append(article)
+
+        if existing is not None and newest_first and known >= KNOWN_RECORDS_BEFORE_STOP:
+            break
+
+    if metrics is not None:
+        metrics['parse_time'] = metrics.get('parse_time', 0) + parse_time
+        metrics['extract_time'] = time.perf_counter() - start - parse_time
+        metrics['clean_time'] = clean_time
+        metrics['duplicate_articles'] = read - len(new_articles)
+    return new_articles
+
+
+def store_feed(cursor, name, site_id, summary, articles, metrics=None, prefetcher=None):
+    """
+    Stores the etag, last modified date, raw body and the given new or changed ArticleRecords of a feed summarized with
+    summarize_feed. Returns the number of new articles. If a prefetcher is given, the thumbnails of the articles are
+    fetched into the image cache.
+    """
+    start = time.perf_counter()
     etag_or_modified = False
 
-    if 'etag' in feed:
+    if summary['etag'] is not None:
         etag_or_modified = True
-        cursor.execute('UPDATE site SET etag=? WHERE id=?', (feed.etag, site_id))
+        cursor.execute('UPDATE site SET etag=? WHERE id=?', (summary['etag'], site_id))
 
-    if 'modified' in feed:
+    if summary['modified'] is not None:
         etag_or_modified = True
-        cursor.execute('UPDATE site SET modified=? WHERE id=?', (feed.modified, site_id))
+        cursor.execute('UPDATE site SET modified=? WHERE id=?', (summary['modified'], site_id))
 
     if not etag_or_modified:
         logging.warning(f'"{name}" does not support etag or last modified date.')
 
-    new_article = False
+    raw = summary['raw']
+    if raw is not None:
+        cursor.execute('INSERT OR REPLACE INTO feed_body (site_id, hash, body, headers, update_time) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (site_id, raw['hash'], raw['body'], json.dumps(raw['headers']), int(time.time())))
+
+    for article in articles:
+        logging.info(f'Storing "{name}" article "{article.title}".')
+
+    if prefetcher is not None:
+        for article in articles:
+            if article.thumbnail is not None:
+                prefetcher.prefetch(article.thumbnail, 'thumbnail')
+
+    inserted = 0
+    if articles:
+        records = articles
+        articles = [article.row(site_id) for article in records]
+        inserted = insert_articles(cursor, articles)
+        updated = update_articles(cursor, articles)
+        if updated:
+            logging.info(f'Updated {updated} changed "{name}" articles.')
+        near_duplicates = duplicates.detect_duplicates(cursor, site_id, records)
+        if near_duplicates:
+            logging.info(f'Found {near_duplicates} "{name}" articles which were already published by other sites.')
+    else:
+        logging.info(f'No new articles for "{name}".')
 
-    for article in feed.entries:
-        article_id = article.id
+    if metrics is not None:
+        metrics['store_time'] = time.perf_counter() - start
+    return inserted
 
-        if article_exists(cursor, article_id):
-            continue
 
-        # Unescape HTML entities from title (required for Polygon)
-        title = html.unescape(article.title)
-        link = article.link
-        summary = remove_trailing_message(remove_extra_spaces(remove_html_tags(article.summary)))
+def update_feed(cursor, name, site_id, feed, metrics=None, prefetcher=None):
+    """
+    Stores the etag, last modified date and new articles of a fetched feed.
+    Returns the number of new articles. If a metrics dict is given, the timings of the update are added.
+    """
+    # Check response status
+    if feed.status == 304:
+        logging.info(f'No new articles for "{name}".')
+        return 0
 
-        date = article.published_parsed if 'published_parsed' in article else article.modified_parsed
-        if date is not None:
-            published = calendar.timegm(date)
-        else:
-            logging.warning(f'No parsed date in "{name}" article "{title}".')
-            # Add four hours because the only current source without parseable date is in UTC-5 for standard time and
-            # UTC-4 for daylight saving time and adding four hours has a less noticeable impact
-            published = calendar.timegm((dateparser.parse(article.published) + timedelta(hours=4)).timetuple())
-        thumbnail = try_get_thumbnail(article)
+    # The same body as last time still updates the etag and last modified date
+    if not_modified(feed):
+        return store_feed(cursor, name, site_id, summarize_feed(feed), [], metrics)
 
-        author = article.author if 'author' in article else None
+    articles = extract_articles(name, feed['records'],
+                                lambda records: stored_article_hashes(cursor, site_id, records), metrics)
+    return store_feed(cursor, name, site_id, summarize_feed(feed), articles, metrics, prefetcher)
 
-        logging.info(f'Inserting "{name}" article "{title}".')
 
-        insert_article(cursor, article_id, site_id, title, summary, link, thumbnail, published, author)
+def process_shard(database_path, jobs, concurrency, host_interval=DEFAULT_HOST_INTERVAL):
+    """
+    Fetches a shard of feeds in a worker process and extracts their new articles.
+    Returns a list of (key, summary, articles, error) tuples, where summary and articles are None on errors.
+    """
+    results = []
+    db_connection = database.connect_read_only(database_path)
+    for (name, site_id), feed, error in FetchEngine(concurrency, host_interval=host_interval).fetch_all(jobs):
+        if error is None:
+            try:
+                if not_modified(feed):
+                    results.append(((name, site_id), summarize_feed(feed), [], None))
+                    continue
+                summary = summarize_feed(feed)
+                articles = extract_articles(
+                    name, feed['records'],
+                    lambda records: stored_article_hashes(db_connection.cursor(), site_id, records),
+                    summary['metrics'])
+                results.append(((name, site_id), summary, articles, None))
+                continue
+            except (AttributeError, ValueError) as e:
+                error = e
+        results.append(((name, site_id), None, None, error))
+    db_connection.close()
+    return results
+
+
+def worker_pool(workers):
+    """
+    Returns a pool of worker processes for fetching and parsing feeds. Starting the processes and importing the
+    collector in each of them takes a while, so a pool is meant to be kept across updates.
+    """
+    # Forking while the main thread waits for input would deadlock the workers on the inherited stdin lock
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=configure_logging,
+                               initargs=(logging.getLogger().level,))
 
-        # Set flag to indicate that new articles have been inserted
-        new_article = True
 
-    if not new_article:
-        logging.info(f'No new articles for "{name}".')
+def update_feeds_in_workers(db_connection, jobs, executor: ProcessPoolExecutor, workers: int, concurrency: int,
+                            scheduler: Scheduler = None, prefetcher: images.ImagePrefetcher = None,
+                            host_interval: float = DEFAULT_HOST_INTERVAL):
+    """
+    Fetches and parses feeds in the given pool of worker processes, each handling shards of feeds grouped by host.
+    The new articles of each shard are written and committed in one batch.
+    """
+    database_path = db_connection.execute('PRAGMA database_list').fetchone()[2]
+    # More shards than workers so that results arrive while other shards are still being fetched
+    shards = shard_jobs(jobs, workers * SHARDS_PER_WORKER)
+
+    success = True
+    futures = [executor.submit(process_shard, database_path, shard, concurrency, host_interval) for shard in shards]
+    for future in as_completed(futures):
+        cursor = db_connection.cursor()
+        run_ids = []
+        for (name, site_id), summary, articles, error in future.result():
+            new_articles = 0
+            metrics = summary['metrics'] if summary is not None else {}
+            circuit.record_update(cursor, name, site_id, circuit.failed(summary, error))
+            if error is not None:
+                logging.error(f'Encountered error while updating "{name}": {error!r}')
+                success = False
+            elif summary['status'] == 304:
+                logging.info(f'No new articles for "{name}".')
+            else:
+                new_articles = store_feed(cursor, name, site_id, summary, articles, metrics, prefetcher)
+
+            if scheduler is not None:
+                scheduler.reschedule(cursor, site_id, summary, new_articles, error)
+            run_ids.append(record_feed_run(cursor, site_id, metrics, new_articles, error))
+        commit_and_record(db_connection, run_ids)
+
+    return success
 
 
 if __name__ == '__main__':
@@ -2,12 +2,33 @@ import os
 
 from flask import Flask
 
+from images import DEFAULT_CACHE_SIZE as DEFAULT_IMAGE_CACHE_SIZE
+from plate.serialization import JSONProvider
+
 
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    app.json = JSONProvider(app)
     app.config.from_mapping(
         SECRET_KEY='dev',
-        DATABASE='articles.db'
+        DATABASE='articles.db',
+        COLLAPSE_DUPLICATES=True,
+        IMAGE_PROXY=True,
+        IMAGE_CACHE=os.path.join(app.instance_path, 'images'),
+        IMAGE_CACHE_SIZE=DEFAULT_IMAGE_CACHE_SIZE,
+        # Request metrics of each server process, from which the metrics endpoint sums those of all processes
+        METRICS_DIRECTORY=os.path.join(app.instance_path, 'metrics'),
+        # Article pages with more articles are streamed instead of being built and cached in memory
+        JSON_STREAM_THRESHOLD=1000,
+        # Number of newest matches ranked together by search, and number of such windows searched per request
+        SEARCH_WINDOW=2000,
+        SEARCH_MAX_WINDOWS=20,
+        # Event streams and long polls served at a time per process, each of which holds a server thread
+        STREAM_MAX_CONNECTIONS=8,
+        # Feeds file of the collector to which OPML imports add sites and the bearer token required for imports, which
+        # are disabled unless both are set
+        FEEDS_FILE=None,
+        OPML_IMPORT_TOKEN=None,
     )
 
     # Load config
@@ -25,10 +46,17 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
-    from . import articles, sites, feed, system
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import articles, sites, feed, system, search, stream, export, images as image_proxy
     app.register_blueprint(articles.bp)
     app.register_blueprint(sites.bp)
     app.register_blueprint(feed.bp)
     app.register_blueprint(system.bp)
+    app.register_blueprint(search.bp)
+    app.register_blueprint(stream.bp)
+    app.register_blueprint(export.bp)
+    app.register_blueprint(image_proxy.bp)
 
     return app
@@ -1,9 +1,24 @@
-from flask import Blueprint, abort
+import heapq
+import itertools
 
-from plate.db import get_db
+from flask import Blueprint, abort, current_app, request, stream_with_context
+
+import archive
+import timeline
+from plate.cache import LRUCache, latest_update
+from plate.db import get_tuple_cursor
+from plate.responses import conditional
 
 bp = Blueprint('articles', __name__, url_prefix='/articles')
 
+# Fields of the article rows, in the order of the columns of query_articles
+ARTICLE_FIELDS = ('id', 'site', 'title', 'summary', 'link', 'thumbnail', 'author', 'published', 'icon')
+PUBLISHED = ARTICLE_FIELDS.index('published')
+# Articles encoded at a time when streaming a response
+STREAM_BATCH_SIZE = 200
+
+article_cache = LRUCache(maxsize=256)
+
 
 def parse_sites(sites):
     if sites == 'all':
@@ -15,10 +30,10 @@ def parse_sites(sites):
         except ValueError:
             abort(400)
         qs = ', '.join(['?' for _ in parts])
-        return f's.id IN ({qs}) ', tuple(parts)
+        return f'a.site_id IN ({qs}) ', tuple(parts)
 
 
-def assemble_where(sites_term, sites_values, last_article_published):
+def assemble_where(sites_term, sites_values, last_article_published, last_article_id=None):
     if len(sites_values) == 0 and last_article_published is None:
         return '', ()
     else:
@@ -31,27 +46,146 @@ def assemble_where(sites_term, sites_values, last_article_published):
         if last_article_published is not None:
             if len(values) > 0:
                 term += 'AND '
-            term += 'a.published < ? '
-            values += (last_article_published,)
+            if last_article_id is not None:
+                # Keyset pagination which does not skip or repeat articles published at the same time
+                term += '(a.published, a.id) < (?, ?) '
+                values += (last_article_published, last_article_id)
+            else:
+                term += 'a.published < ? '
+                values += (last_article_published,)
 
         return term, values
 
 
-def retrieve_articles(sites, n_articles, last_article_published=None):
-    sites_term, sites_values = parse_sites(sites)
-    where_term, where_values = assemble_where(sites_term, sites_values, last_article_published)
+def collapse_duplicates(where_term, where_values, sites_term, sites_values, tables):
+    """
+    Extends a WHERE clause to leave out near-duplicates of older articles of the given sites, so that only the oldest
+    article of each group of near-duplicates among them is kept. The older articles are looked up in the given tables,
+    since the oldest article of a group, which all others refer to, may be archived or belong to another site.
+    """
+    duplicate_sites = 'AND ' + sites_term.replace('a.site_id', 'd.site_id') if len(sites_values) > 0 else ''
+    older = ' OR '.join(f'EXISTS (SELECT 1 FROM {table} d '
+                        'WHERE (d.id = a.duplicate_of OR d.duplicate_of = a.duplicate_of AND d.id < a.id) '
+                        f'{duplicate_sites})' for table in tables)
+    term = f'(a.duplicate_of IS NULL OR NOT ({older})) '
+    values = sites_values * len(tables)
+    if where_term:
+        return where_term + 'AND ' + term, where_values + values
+    return 'WHERE ' + term, values
+
 
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('SELECT name AS site, title, summary, link, thumbnail, author, published, icon '
-                   'FROM article a JOIN site s on s.id = a.site_id '
+def query_articles(table, where_term, where_values, n_articles):
+    """
+    Returns an iterator over the rows of the newest articles of a table, as tuples of ARTICLE_FIELDS.
+    """
+    cursor = get_tuple_cursor()
+    cursor.execute('SELECT a.id, name AS site, title, summary, link, thumbnail, author, published, icon '
+                   f'FROM {table} a JOIN site s on s.id = a.site_id '
                    f'{where_term}'
-                   'ORDER BY published DESC LIMIT ?', where_values + (n_articles,))
-    return [dict(row) for row in cursor.fetchall()]
+                   'ORDER BY a.published DESC, a.id DESC LIMIT ?', where_values + (n_articles,))
+    return cursor
+
+
+def query_archive_articles(tables, where_term, where_values, n_articles):
+    # Archive tables only hold articles published in their month, so reading them newest first yields ordered rows,
+    # and a table is only queried once all newer rows are used
+    for table in tables:
+        yield from query_articles(table, where_term, where_values, n_articles)
+
+
+def query_timeline(archive_tables, where_term, where_values, n_articles, last_article_published):
+    """
+    Returns the rows of a page from the timeline of the newest articles, or None if the timeline may not hold all of
+    them, e.g. for pages further back or pages of sites which published little recently.
+    """
+    if n_articles > timeline.TIMELINE_SIZE:
+        return None
+    cursor = get_tuple_cursor()
+    floor = timeline.floor(cursor)
+    if last_article_published is not None and last_article_published < floor:
+        return None
+    # Archive tables might hold articles newer than the floor
+    if archive_tables and archive_tables[0][2] > floor:
+        return None
+
+    cursor.execute('SELECT a.id, site, title, summary, link, thumbnail, author, published, icon '
+                   f'FROM timeline a {where_term}'
+                   'ORDER BY a.published DESC, a.id DESC LIMIT ?', where_values + (n_articles,))
+    rows = cursor.fetchall()
+    # Before the timeline is trimmed for the first time, it holds all articles
+    if len(rows) < n_articles and floor > 0:
+        return None
+    return rows
+
+
+def article_rows(sites, n_articles, last_article_published=None, last_article_id=None, collapse=False):
+    """
+    Returns an iterator over the rows of the newest articles of the given sites published before the given cursor, as
+    tuples of ARTICLE_FIELDS. Pages of recent articles are read from the timeline. Otherwise, rows are read from the
+    database as they are consumed, merging the article table with the archive tables once the page reaches past its
+    articles.
+    """
+    sites_term, sites_values = parse_sites(sites)
+    where_term, where_values = assemble_where(sites_term, sites_values, last_article_published, last_article_id)
+    archive_tables = archive.archive_tables(get_tuple_cursor())
+    if collapse:
+        where_term, where_values = collapse_duplicates(where_term, where_values, sites_term, sites_values,
+                                                       ['article'] + [table for table, _, _ in archive_tables])
+
+    rows = query_timeline(archive_tables, where_term, where_values, n_articles, last_article_published)
+    if rows is not None:
+        return iter(rows)
+
+    tables = [table for table, start, _ in archive_tables
+              if last_article_published is None or start <= last_article_published]
+    rows = heapq.merge(query_articles('article', where_term, where_values, n_articles),
+                       query_archive_articles(tables, where_term, where_values, n_articles),
+                       key=lambda row: (row[PUBLISHED], row[0]), reverse=True)
+    return itertools.islice(rows, n_articles)
+
+
+def retrieve_articles(sites, n_articles, last_article_published=None, last_article_id=None, collapse=False):
+    """
+    Returns the newest articles of the given sites published before the given cursor as a list of dicts.
+    If collapse is set, only the oldest article of each group of near-duplicates among the given sites is kept.
+    Results are cached until the collector completes its next update.
+    """
+    key = (sites, n_articles, last_article_published, last_article_id, collapse)
+
+    version = latest_update()
+    rows = article_cache.get(version, key)
+    if rows is None:
+        rows = list(article_rows(sites, n_articles, last_article_published, last_article_id, collapse))
+        article_cache.put(version, key, rows)
+
+    return [dict(zip(ARTICLE_FIELDS, row)) for row in rows]
+
+
+def stream_articles(rows):
+    """
+    Yields the JSON of an articles response in parts, so that large pages are never held in memory as a whole.
+    """
+    encode = current_app.json.encode
+    separator = b''
+    yield b'{"articles":['
+    while True:
+        batch = list(itertools.islice(rows, STREAM_BATCH_SIZE))
+        if not batch:
+            break
+        yield separator + b','.join(encode(dict(zip(ARTICLE_FIELDS, row))) for row in batch)
+        separator = b','
+    yield b']}\n'
 
 
 @bp.route("/<sites>/<int:n_articles>")
 @bp.route("/<sites>/<int:n_articles>/<int:last_article_published>")
-def request_articles(sites, n_articles, last_article_published=None):
-    articles = retrieve_articles(sites, n_articles, last_article_published)
+@bp.route("/<sites>/<int:n_articles>/<int:last_article_published>/<int:last_article_id>")
+@conditional()
+def request_articles(sites, n_articles, last_article_published=None, last_article_id=None):
+    collapse = request.args.get('collapse', '0') not in ('0', 'false')
+    if n_articles > current_app.config['JSON_STREAM_THRESHOLD']:
+        rows = article_rows(sites, n_articles, last_article_published, last_article_id, collapse)
+        return current_app.response_class(stream_with_context(stream_articles(rows)),
+                                          mimetype=current_app.json.mimetype)
+    articles = retrieve_articles(sites, n_articles, last_article_published, last_article_id, collapse)
     return {'articles': articles}
@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from plate.db import get_db
+
+# Latest update by database path, together with the file signature it was read at
+_latest_updates = {}
+
+
+def database_signature(path):
+    """
+    Returns the modification time and size of the database files, which change whenever anything is committed.
+    """
+    signature = ()
+    for file in (path, path + '-wal'):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        signature += (stat.st_mtime_ns, stat.st_size)
+    return signature
+
+
+def latest_update():
+    """
+    Returns the ID and update time of the latest row in the system table, which changes whenever the collector
+    completes an update. The system table is only queried if the database files changed since the last call.
+    """
+    path = current_app.config['DATABASE']
+    signature = database_signature(path)
+    cached = _latest_updates.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    cursor = get_db().cursor()
+    cursor.execute('SELECT rowid, update_time FROM system ORDER BY rowid DESC LIMIT 1')
+    result = cursor.fetchone()
+    update = (result[0], result[1]) if result is not None else (None, None)
+    _latest_updates[path] = (signature, update)
+    return update
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache whose entries belong to a version, e.g. the latest update.
+    All entries are dropped as soon as a different version is used.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, version, key, default=None):
+        with self.lock:
+            self._check_version(version)
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, version, key, value):
+        with self.lock:
+            self._check_version(version)
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
@@ -2,20 +2,32 @@ import sqlite3
 
 from flask import g, current_app
 
+import database
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE'])
+        g.db = database.get_pool(current_app.config['DATABASE']).acquire()
         g.db.row_factory = sqlite3.Row
 
     return g.db
 
 
+def get_tuple_cursor():
+    """
+    Returns a cursor of the request's connection which returns rows as plain tuples, for queries whose rows are
+    converted or serialized right away.
+    """
+    cursor = get_db().cursor()
+    cursor.row_factory = None
+    return cursor
+
+
 def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        database.get_pool(current_app.config['DATABASE']).release(db)
 
 
 def init_app(app):
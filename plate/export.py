@@ -0,0 +1,221 @@
+import datetime
+import itertools
+import re
+from email.utils import format_datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import Blueprint, current_app, request, stream_with_context
+
+from plate.articles import ARTICLE_FIELDS, STREAM_BATCH_SIZE, article_rows, parse_sites
+from plate.cache import LRUCache, latest_update
+from plate.db import get_tuple_cursor
+from plate.responses import conditional
+
+bp = Blueprint('export', __name__, url_prefix='/export')
+
+DEFAULT_EXPORT_ARTICLES = 50
+# Larger selections are cut to this many articles, as every rendered document is cached
+MAX_EXPORT_ARTICLES = 1000
+TITLE = 'NewsFeeder'
+# Characters which are not allowed in XML 1.0 documents
+INVALID_XML_REGEX = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# Rendered documents by request URL
+export_cache = LRUCache(maxsize=64)
+
+
+def xml_text(value):
+    return escape(INVALID_XML_REGEX.sub('', value or ''))
+
+
+def xml_attribute(value):
+    return quoteattr(INVALID_XML_REGEX.sub('', value or ''))
+
+
+def article_id(article):
+    """
+    Returns the globally unique ID of an exported article, which is its link if it has one.
+    """
+    return article['link'] or f'urn:newsfeeder:article:{article["id"]}'
+
+
+def utc_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def feed_title(sites):
+    """
+    Returns the title of an exported feed, which names the selected sites unless all sites are selected.
+    """
+    sites_term, sites_values = parse_sites(sites)
+    if not sites_values:
+        return TITLE
+    cursor = get_tuple_cursor()
+    cursor.execute(f'SELECT name FROM site WHERE {sites_term.replace("a.site_id", "id")}ORDER BY name', sites_values)
+    return f'{TITLE}: {", ".join(name for name, in cursor)}'
+
+
+def export_articles(sites, n_articles):
+    """
+    Returns an iterator over the newest articles of the given sites as dicts, read from the database as they are
+    consumed.
+    """
+    rows = article_rows(sites, n_articles, collapse=current_app.config['COLLAPSE_DUPLICATES'])
+    return (dict(zip(ARTICLE_FIELDS, row)) for row in rows)
+
+
+def render_rss_item(article):
+    permalink = 'true' if article['link'] else 'false'
+    item = (f'<item><title>{xml_text(article["title"])}</title>'
+            f'<guid isPermaLink="{permalink}">{xml_text(article_id(article))}</guid>'
+            f'<pubDate>{format_datetime(utc_time(article["published"]), usegmt=True)}</pubDate>'
+            f'<category>{xml_text(article["site"])}</category>')
+    if article['link']:
+        item += f'<link>{xml_text(article["link"])}</link>'
+    if article['summary']:
+        item += f'<description>{xml_text(article["summary"])}</description>'
+    if article['author']:
+        item += f'<dc:creator>{xml_text(article["author"])}</dc:creator>'
+    if article['thumbnail']:
+        item += f'<media:thumbnail url={xml_attribute(article["thumbnail"])}/>'
+    return item + '</item>'
+
+
+def render_rss(title, updated, articles):
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" '
+           'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:media="http://search.yahoo.com/mrss/"><channel>'
+           f'<title>{xml_text(title)}</title><link>{xml_text(request.url_root)}</link>'
+           f'<description>{xml_text(title)}</description>'
+           f'<lastBuildDate>{format_datetime(utc_time(updated), usegmt=True)}</lastBuildDate>'
+           f'<atom:link href={xml_attribute(request.url)} rel="self" type="application/rss+xml"/>')
+    yield from map(render_rss_item, articles)
+    yield '</channel></rss>\n'
+
+
+def render_atom_entry(article):
+    published = utc_time(article['published']).isoformat()
+    entry = (f'<entry><title>{xml_text(article["title"])}</title><id>{xml_text(article_id(article))}</id>'
+             f'<published>{published}</published><updated>{published}</updated>'
+             f'<category term={xml_attribute(article["site"])}/>')
+    if article['link']:
+        entry += f'<link rel="alternate" href={xml_attribute(article["link"])}/>'
+    if article['summary']:
+        entry += f'<summary type="text">{xml_text(article["summary"])}</summary>'
+    if article['author']:
+        entry += f'<author><name>{xml_text(article["author"])}</name></author>'
+    if article['thumbnail']:
+        entry += f'<media:thumbnail url={xml_attribute(article["thumbnail"])}/>'
+    return entry + '</entry>'
+
+
+def render_atom(title, updated, articles):
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:media="http://search.yahoo.com/mrss/">'
+           f'<title>{xml_text(title)}</title><id>{xml_text(request.base_url)}</id>'
+           f'<updated>{utc_time(updated).isoformat()}</updated><author><name>{TITLE}</name></author>'
+           f'<link rel="self" href={xml_attribute(request.url)}/>'
+           f'<link rel="alternate" href={xml_attribute(request.url_root)}/>')
+    yield from map(render_atom_entry, articles)
+    yield '</feed>\n'
+
+
+def json_feed_item(article):
+    item = {
+        'id': article_id(article),
+        'title': article['title'],
+        'content_text': article['summary'] or '',
+        'date_published': utc_time(article['published']).isoformat(),
+        'tags': [article['site']],
+    }
+    if article['link']:
+        item['url'] = article['link']
+    if article['author']:
+        item['authors'] = [{'name': article['author']}]
+    if article['thumbnail']:
+        item['image'] = article['thumbnail']
+    return item
+
+
+def render_json_feed(title, updated, articles):
+    encode = current_app.json.encode
+    header = {
+        'version': 'https://jsonfeed.org/version/1.1',
+        'title': title,
+        'home_page_url': request.url_root,
+        'feed_url': request.url,
+    }
+    # Leave the object open for the items
+    yield encode(header).rstrip()[:-1].decode() + ',"items":['
+    separator = ''
+    for article in articles:
+        yield separator + encode(json_feed_item(article)).decode()
+        separator = ','
+    yield ']}\n'
+
+
+# Renderer and mimetype by format
+FORMATS = {
+    'rss': (render_rss, 'application/rss+xml'),
+    'atom': (render_atom, 'application/atom+xml'),
+    'json': (render_json_feed, 'application/feed+json'),
+}
+
+
+def batched(parts):
+    """
+    Joins the parts of a document into UTF-8 encoded chunks of up to STREAM_BATCH_SIZE parts.
+    """
+    parts = iter(parts)
+    while batch := ''.join(itertools.islice(parts, STREAM_BATCH_SIZE)):
+        yield batch.encode()
+
+
+def export_response(export_format, sites, n_articles):
+    """
+    Streams a feed document of the newest articles of the given sites as it is rendered from the database cursor.
+    The rendered document is cached until the collector completes its next update, so that later requests for the same
+    selection are answered from memory.
+    """
+    render, mimetype = FORMATS[export_format]
+    version = latest_update()
+    key = request.full_path
+    body = export_cache.get(version, key)
+    if body is not None:
+        return current_app.response_class(body, mimetype=mimetype)
+
+    title = feed_title(sites)
+
+    def generate():
+        chunks = []
+        articles = export_articles(sites, min(n_articles, MAX_EXPORT_ARTICLES))
+        for chunk in batched(render(title, version[1] or 0, articles)):
+            chunks.append(chunk)
+            yield chunk
+        export_cache.put(version, key, b''.join(chunks))
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
+
+
+@bp.route("/rss")
+@bp.route("/rss/<sites>")
+@bp.route("/rss/<sites>/<int:n_articles>")
+@conditional()
+def export_rss(sites='all', n_articles=DEFAULT_EXPORT_ARTICLES):
+    return export_response('rss', sites, n_articles)
+
+
+@bp.route("/atom")
+@bp.route("/atom/<sites>")
+@bp.route("/atom/<sites>/<int:n_articles>")
+@conditional()
+def export_atom(sites='all', n_articles=DEFAULT_EXPORT_ARTICLES):
+    return export_response('atom', sites, n_articles)
+
+
+@bp.route("/json")
+@bp.route("/json/<sites>")
+@bp.route("/json/<sites>/<int:n_articles>")
+@conditional()
+def export_json_feed(sites='all', n_articles=DEFAULT_EXPORT_ARTICLES):
+    return export_response('json', sites, n_articles)
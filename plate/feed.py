@@ -1,15 +1,27 @@
 import re
 import time
 import datetime
+import uuid
 
-from flask import Blueprint, render_template
+from flask import Blueprint, current_app, render_template
+from markupsafe import Markup
 
 from plate.articles import retrieve_articles
+from plate.cache import LRUCache, latest_update
+from plate.images import proxy_icon, proxy_thumbnail
+from plate.responses import conditional
 
 EMAIL_REGEX = re.compile(r'(?P<email>.*@.*)\s\((?P<name>.*)\)')
+# Placeholder for the time since publication in cached article fragments
+SINCE_MARKER = uuid.uuid4().hex
+# Seconds for which a rendered page is reused, which is the resolution of its time since publication
+PAGE_TTL = 60
 
 bp = Blueprint('feed', __name__)
 
+# Rendered article fragments by article ID and whether images are included
+fragment_cache = LRUCache(maxsize=4096)
+
 
 def format_time_delta(delta):
     """Formats time delta in seconds."""
@@ -37,40 +49,80 @@ def format_time_delta(delta):
                f'{f", {minutes_string}" if minutes > 0 else ""}'
 
 
-@bp.route('/')
-@bp.route("/<sites>")
-@bp.route("/<sites>/<int:n_articles>")
-@bp.route("/<sites>/<int:n_articles>/<int:last_article_published>")
-def get_feed(sites='all', n_articles=35, last_article_published=None, include_images=True):
-    articles = retrieve_articles(sites, n_articles, last_article_published)
+def prepare_article(article):
+    """
+    Formats the parts of an article which do not depend on the time of the request.
+    """
+    published = datetime.datetime.fromtimestamp(article['published'], datetime.timezone.utc)
+    article['published'] = published.strftime('%d.%m.%Y %H:%M (UTC)')
+    summary = article['summary']
+    max_length = 500
+    if len(summary) > max_length:
+        article['summary'] = summary[:max_length] + '...'
+    article['thumbnail'] = proxy_thumbnail(article['id'], article['thumbnail'])
+    article['icon'] = proxy_icon(article['icon'])
+    # Author
+    if article['author'] is not None:
+        email_match = EMAIL_REGEX.match(article['author'])
+        if email_match is not None:
+            article['author'] = email_match.group('name')
+            article['author_email'] = email_match.group('email')
+        else:
+            article['author_email'] = None
+
+
+def render_article(article, include_images):
+    """
+    Renders an article as the HTML before and after its time since publication, which is filled in per request.
+    """
+    prepare_article(article)
+    template = current_app.jinja_env.get_template('article.html')
+    rendered = template.render(article=article, include_images=include_images, published_since=SINCE_MARKER)
+    before, after = rendered.split(SINCE_MARKER)
+    return Markup(before), Markup(after)
+
+
+def render_feed(sites, n_articles, last_article_published, last_article_id, include_images):
+    articles = retrieve_articles(sites, n_articles, last_article_published, last_article_id,
+                                 current_app.config['COLLAPSE_DUPLICATES'])
+    version = latest_update()
     current_time = time.time()
 
-    last = min([article['published'] for article in articles])
+    # Articles are ordered newest first, so the last article is the cursor for the next page
+    last, last_id = (articles[-1]['published'], articles[-1]['id']) if articles else (None, None)
 
+    rendered_articles = []
     for article in articles:
-        pub_time = article['published']
-        article['published_since'] = format_time_delta(current_time - pub_time)
-        published = datetime.datetime.fromtimestamp(article['published'], datetime.timezone.utc)
-        article['published'] = published.strftime('%d.%m.%Y %H:%M (UTC)')
-        summary = article['summary']
-        max_length = 500
-        if len(summary) > max_length:
-            article['summary'] = summary[:max_length] + '...'
-        # Author
-        if article['author'] is not None:
-            email_match = EMAIL_REGEX.match(article['author'])
-            if email_match is not None:
-                article['author'] = email_match.group('name')
-                article['author_email'] = email_match.group('email')
-            else:
-                article['author_email'] = None
-
-    return render_template('base.html', articles=articles, sites=sites, n_articles=n_articles, last=last, include_images=include_images)
+        published_since = format_time_delta(current_time - article['published'])
+
+        key = (article['id'], include_images)
+        fragments = fragment_cache.get(version, key)
+        if fragments is None:
+            fragments = render_article(article, include_images)
+            fragment_cache.put(version, key, fragments)
+
+        before, after = fragments
+        rendered_articles.append(before + published_since + after)
+
+    return render_template('base.html', articles=rendered_articles, sites=sites, n_articles=n_articles, last=last,
+                           last_id=last_id, include_images=include_images)
+
+
+@bp.route('/')
+@bp.route("/<sites>")
+@bp.route("/<sites>/<int:n_articles>")
+@bp.route("/<sites>/<int:n_articles>/<int:last_article_published>")
+@bp.route("/<sites>/<int:n_articles>/<int:last_article_published>/<int:last_article_id>")
+@conditional(ttl=PAGE_TTL)
+def get_feed(sites='all', n_articles=35, last_article_published=None, last_article_id=None):
+    return render_feed(sites, n_articles, last_article_published, last_article_id, include_images=True)
 
 
 @bp.route('/text')
 @bp.route("/text/<sites>")
 @bp.route("/text/<sites>/<int:n_articles>")
 @bp.route("/text/<sites>/<int:n_articles>/<int:last_article_published>")
-def get_text_only_feed(sites='all', n_articles=35, last_article_published=None):
-    return get_feed(sites, n_articles, last_article_published, include_images=False)
+@bp.route("/text/<sites>/<int:n_articles>/<int:last_article_published>/<int:last_article_id>")
+@conditional(ttl=PAGE_TTL)
+def get_text_only_feed(sites='all', n_articles=35, last_article_published=None, last_article_id=None):
+    return render_feed(sites, n_articles, last_article_published, last_article_id, include_images=False)
@@ -0,0 +1,95 @@
+from flask import Blueprint, abort, current_app, redirect, send_file, url_for
+
+import archive
+import images
+from plate.db import get_db
+
+bp = Blueprint('images', __name__, url_prefix='/images')
+
+# Proxied image links contain a hash of the image URL, so their responses never change
+IMAGE_MAX_AGE = 365 * 24 * 3600
+# Proxied responses are never rendered as documents, even if a browser opens them directly
+PROXY_HEADERS = {
+    'Content-Security-Policy': "default-src 'none'; sandbox",
+    'X-Content-Type-Options': 'nosniff',
+}
+
+# Image caches by cache directory
+_caches = {}
+
+
+def get_image_cache():
+    root = current_app.config['IMAGE_CACHE']
+    if root not in _caches:
+        _caches[root] = images.ImageCache(root, current_app.config['IMAGE_CACHE_SIZE'])
+    return _caches[root]
+
+
+def proxy_thumbnail(article_id, url):
+    """
+    Returns the link of the proxied thumbnail of an article, or the thumbnail URL if the proxy is disabled.
+    """
+    if url is None or not current_app.config['IMAGE_PROXY']:
+        return url
+    return url_for('images.thumbnail', article_id=article_id, key=images.url_key(url))
+
+
+def proxy_icon(url):
+    """
+    Returns the link of a proxied site icon, or the icon URL if the proxy is disabled.
+    """
+    if url is None or not current_app.config['IMAGE_PROXY']:
+        return url
+    return url_for('images.icon', key=images.url_key(url))
+
+
+def serve_image(url, variant):
+    try:
+        path = get_image_cache().fetch(url, variant)
+    except images.NotAnImageError:
+        # Neither served nor redirected to, as the URL might be internal to the network of the server
+        abort(404)
+    if path is None:
+        # Let the browser try the publisher instead
+        response = redirect(url)
+        response.cache_control.max_age = images.FAILURE_TTL
+        return response
+
+    mimetype = images.mimetype(path)
+    if mimetype is None:
+        # Cached before its type was rejected, e.g. an SVG image
+        abort(404)
+    response = send_file(path, mimetype=mimetype, max_age=IMAGE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.after_request
+def add_proxy_headers(response):
+    response.headers.update(PROXY_HEADERS)
+    return response
+
+
+@bp.route('/thumbnail/<int:article_id>/<key>')
+def thumbnail(article_id, key):
+    cursor = get_db().cursor()
+    for table in ['article'] + [table for table, _, _ in archive.archive_tables(cursor)]:
+        cursor.execute(f'SELECT thumbnail FROM {table} WHERE id=?', (article_id,))
+        result = cursor.fetchone()
+        if result is not None:
+            break
+    # Only images of stored articles are proxied
+    if result is None or result[0] is None or images.url_key(result[0]) != key:
+        abort(404)
+    return serve_image(result[0], 'thumbnail')
+
+
+@bp.route('/icon/<key>')
+def icon(key):
+    cursor = get_db().cursor()
+    cursor.execute('SELECT DISTINCT icon FROM site WHERE icon IS NOT NULL')
+    for url, in cursor.fetchall():
+        if images.url_key(url) == key:
+            return serve_image(url, 'icon')
+    abort(404)
@@ -0,0 +1,161 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import current_app, g, request
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# Seconds between writes of the request metrics of a process to the metrics directory
+FLUSH_INTERVAL = 5
+
+
+class Histogram:
+    """
+    Thread safe histogram of observations by label, e.g. request latencies by endpoint, with cumulative buckets as
+    used by Prometheus.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+        self.pid = os.getpid()
+
+    def observe(self, label, value):
+        with self.lock:
+            # Forked worker processes count their own observations
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.series = {}
+            if label not in self.series:
+                # Counts per bucket, with a last bucket for values above all bounds, followed by the sum of values
+                self.series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts, _ = series = self.series[label]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def counts(self):
+        """
+        Returns a copy of the series as a dict of label to [counts per bucket, sum].
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return {}
+            return {label: [list(counts), total] for label, (counts, total) in self.series.items()}
+
+    def snapshot(self, series=None):
+        """
+        Returns a dict of label to (cumulative bucket counts, count, sum), where the bucket counts are (bound, count)
+        pairs ending with the "+Inf" bucket. Covers the given series as returned by counts, or those of the histogram.
+        """
+        if series is None:
+            series = self.counts()
+
+        result = {}
+        for label, (counts, total) in series.items():
+            cumulative = []
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                count += bucket_count
+                cumulative.append((bound, count))
+            result[label] = (cumulative, count, total)
+        return result
+
+
+class SharedHistogram:
+    """
+    Shares a histogram of each server process with the other processes through a directory holding one file per
+    process, so that any process can report the totals of all of them. Files of exited processes are kept, so that
+    the totals never decrease while the server restarts its processes.
+    """
+
+    def __init__(self, directory, histogram):
+        self.directory = directory
+        self.histogram = histogram
+        self.lock = threading.Lock()
+        self.pid = None
+        self.path = None
+        self.flushed = 0.
+
+    def flush(self, force=False):
+        """
+        Writes the series of this process to its file, at most every FLUSH_INTERVAL seconds unless forced.
+        """
+        if not force and time.monotonic() - self.flushed < FLUSH_INTERVAL:
+            return
+        # Writes of other threads may not be overtaken by older series
+        if not self.lock.acquire(blocking=force):
+            return
+        try:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                # Process IDs are reused, e.g. after restarting the server
+                self.path = os.path.join(self.directory, f'{self.pid}-{uuid.uuid4().hex}.json')
+            self.flushed = time.monotonic()
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.histogram.counts(), f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error(f'Could not write request metrics to "{self.directory}": {e}')
+        finally:
+            self.lock.release()
+
+    def totals(self):
+        """
+        Returns the snapshot of the series summed over all processes.
+        """
+        self.flush(force=True)
+        series = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    process_series = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for label, (counts, total) in process_series.items():
+                summed = series.setdefault(label, [[0] * len(counts), 0.0])
+                summed[0] = [a + b for a, b in zip(summed[0], counts)]
+                summed[1] += total
+        return self.histogram.snapshot(series)
+
+
+request_latency = Histogram(LATENCY_BUCKETS)
+
+# Shared request latencies by metrics directory
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_request_latency():
+    directory = current_app.config['METRICS_DIRECTORY']
+    with _shared_lock:
+        if directory not in _shared:
+            _shared[directory] = SharedHistogram(directory, request_latency)
+        return _shared[directory]
+
+
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+def record_latency(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # Requests without a matching route are grouped together
+        request_latency.observe(request.endpoint or 'unmatched', time.perf_counter() - start)
+        shared_request_latency().flush()
+    return response
+
+
+def init_app(app):
+    app.before_request(start_timer)
+    app.after_request(record_latency)
@@ -0,0 +1,102 @@
+import csv
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from fetcher import feed_url
+from plate.export import TITLE, xml_attribute
+
+try:
+    from defusedxml.ElementTree import ParseError, fromstring
+except ImportError:
+    from xml.etree.ElementTree import ParseError, fromstring
+
+# Largest OPML document accepted for import, in bytes
+MAX_OPML_SIZE = 1024 * 1024
+# Feeds which the collector may fetch, other schemes like file: would let an import read local files
+FEED_URL_REGEX = re.compile(r'^(?:feed:)?https?://|^feed://', re.IGNORECASE)
+
+# Serializes imports of the server process, as each one rewrites the feeds file
+_feeds_file_lock = threading.Lock()
+
+
+def render_opml(sites):
+    """
+    Yields the parts of an OPML document listing the given sites, given as (name, feed) tuples. Feeds are given with
+    plain HTTP URLs, as readers of OPML do not expect the "feed:" URI scheme.
+    """
+    yield (f'<?xml version="1.0" encoding="utf-8"?>\n'
+           f'<opml version="2.0"><head><title>{TITLE}</title></head><body>')
+    for name, feed in sites:
+        yield (f'<outline type="rss" text={xml_attribute(name)} title={xml_attribute(name)} '
+               f'xmlUrl={xml_attribute(feed_url(feed))}/>')
+    yield '</body></opml>\n'
+
+
+def parse_opml(data):
+    """
+    Returns the sites of an OPML document as (name, feed) tuples, including those in nested outlines. Outlines whose
+    feed is not an HTTP(S) URL, optionally with the "feed:" URI scheme, are skipped.
+    Raises ValueError if the document is invalid.
+    """
+    try:
+        root = fromstring(data)
+    except ParseError as e:
+        raise ValueError(f'Invalid OPML: {e}') from e
+    if root.tag != 'opml':
+        raise ValueError('Invalid OPML: the root element is not "opml"')
+
+    sites = []
+    for outline in root.iter('outline'):
+        feed = (outline.get('xmlUrl') or '').strip()
+        if not feed:
+            continue
+        if not FEED_URL_REGEX.match(feed):
+            logging.warning(f'Skipping OPML outline with unsupported feed URL: "{feed}"')
+            continue
+        name = (outline.get('text') or outline.get('title') or feed).strip()
+        sites.append((name, feed))
+    return sites
+
+
+def add_to_feeds_file(feeds_file, sites):
+    """
+    Appends the given (name, feed) sites to the feeds file, leaving out sites whose name or feed is already in it.
+    The file is replaced at once, so that the collector never reads it half written. Returns the added sites.
+    """
+    with _feeds_file_lock:
+        with open(feeds_file, newline='', encoding='utf-8') as f:
+            content = f.read()
+        rows = list(csv.reader(io.StringIO(content)))
+        names = {row[0] for row in rows if row}
+        feeds = {feed_url(row[1]) for row in rows if len(row) > 1}
+
+        added = []
+        for name, feed in sites:
+            if name in names or feed_url(feed) in feeds:
+                continue
+            names.add(name)
+            feeds.add(feed_url(feed))
+            added.append((name, feed))
+        if not added:
+            return added
+
+        new_rows = io.StringIO()
+        writer = csv.writer(new_rows, lineterminator='\n')
+        writer.writerows((name, feed, '') for name, feed in added)
+        if content and not content.endswith('\n'):
+            content += '\n'
+
+        directory = os.path.dirname(os.path.abspath(feeds_file))
+        with tempfile.NamedTemporaryFile('w', dir=directory, newline='', encoding='utf-8', delete=False) as f:
+            f.write(content + new_rows.getvalue())
+        try:
+            os.chmod(f.name, os.stat(feeds_file).st_mode)
+            os.replace(f.name, feeds_file)
+        except OSError:
+            os.unlink(f.name)
+            raise
+        return added
@@ -0,0 +1,104 @@
+import functools
+import gzip
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, request
+
+from plate.cache import LRUCache, latest_update
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 500
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/rss+xml',
+                          'application/atom+xml', 'application/feed+json', 'text/x-opml'}
+
+# Encoded response bodies by ETag and content encoding
+response_cache = LRUCache(maxsize=512)
+
+
+def encode(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    elif encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def accepted_encoding(size, mimetype):
+    if size < MIN_COMPRESS_SIZE or mimetype not in COMPRESSIBLE_MIMETYPES:
+        return None
+    if brotli is not None and 'br' in request.accept_encodings:
+        return 'br'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return None
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return request.if_modified_since >= last_modified
+    return False
+
+
+def conditional(max_age=60, ttl=None):
+    """
+    Adds ETag, Last-Modified and Cache-Control headers derived from the latest update and the request URL, answers
+    matching conditional requests with 304 Not Modified and compresses the response body if the client accepts it.
+
+    Encoded bodies are cached until the next update. Views which depend on the current time, like the "N minutes ago"
+    of the feed pages, pass a ttl in seconds after which their cached responses become stale.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            update_id, update_time = latest_update()
+            version = (update_id, int(time.time() // ttl) if ttl else None)
+
+            etag = hashlib.blake2b(f'{version}:{request.full_path}'.encode(), digest_size=16).hexdigest()
+            last_modified_time = max(update_time or 0, version[1] * ttl if ttl else 0) or None
+            last_modified = datetime.fromtimestamp(last_modified_time, timezone.utc) if last_modified_time else None
+
+            if not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                accepted = {encoding for encoding in ('br', 'gzip') if encoding in request.accept_encodings}
+                cached = response_cache.get(version, (etag, frozenset(accepted)))
+                if cached is not None:
+                    body, encoding, content_type = cached
+                    response = current_app.response_class(body, content_type=content_type)
+                else:
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    if response.is_streamed:
+                        # Streamed bodies are too large to be held in memory, so they are neither compressed nor cached
+                        encoding = None
+                    else:
+                        body = response.get_data()
+                        encoding = accepted_encoding(len(body), response.mimetype)
+                        body = encode(body, encoding)
+                        response.set_data(body)
+                        response_cache.put(version, (etag, frozenset(accepted)),
+                                           (body, encoding, response.content_type))
+                if encoding is not None:
+                    response.content_encoding = encoding
+
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = min(max_age, ttl) if ttl else max_age
+            response.vary.add('Accept-Encoding')
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,146 @@
+import sqlite3
+import sys
+
+from flask import Blueprint, abort, current_app
+
+import archive
+from plate.articles import ARTICLE_FIELDS, parse_sites
+from plate.cache import LRUCache, latest_update
+from plate.db import get_tuple_cursor
+from plate.responses import conditional
+
+bp = Blueprint('search', __name__, url_prefix='/search')
+
+# Fields of the search result rows
+SEARCH_FIELDS = ARTICLE_FIELDS + ('rank',)
+# Rank below all ranks, which starts a page at the best match of a window
+FIRST_RANK = -sys.float_info.max
+
+search_cache = LRUCache(maxsize=256)
+
+
+def match_window(cursor, query, window, size):
+    """
+    Returns the highest and lowest ID and the number of the newest size articles matching the full-text query whose ID
+    is at most window, or of the newest matching articles if window is None.
+    """
+    window_term, window_values = ('AND rowid <= ? ', (window,)) if window is not None else ('', ())
+    cursor.execute('SELECT max(rowid), min(rowid), count(*) FROM ('
+                   'SELECT rowid FROM article_fts '
+                   f'WHERE article_fts MATCH ? {window_term}'
+                   'ORDER BY rowid DESC LIMIT ?'
+                   ')', (query,) + window_values + (size,))
+    return cursor.fetchone()
+
+
+def window_tables(cursor, newest, oldest):
+    """
+    Returns the article table and the archive tables which hold articles with IDs between oldest and newest.
+    Archived articles keep their ID, so each archive table holds a range of IDs.
+    """
+    tables = ['article']
+    for table, _, _ in archive.archive_tables(cursor):
+        # Separate subqueries, as SQLite only looks up a single min() or max() in the index
+        cursor.execute(f'SELECT (SELECT min(id) FROM {table}), (SELECT max(id) FROM {table})')
+        lowest, highest = cursor.fetchone()
+        if lowest is not None and lowest <= newest and highest >= oldest:
+            tables.append(table)
+    return tables
+
+
+def rank_window(cursor, query, window, size, tables, sites_term, sites_values, last_rank, last_article_id, n_articles):
+    """
+    Returns the rows of the articles of the given sites among the newest size articles matching the full-text query
+    whose ID is at most window, ordered by rank and ID and starting after the given rank and ID. The articles are
+    looked up in the given tables.
+    """
+    where_term = 'WHERE ' + sites_term if len(sites_values) > 0 else ''
+    where_values = sites_values
+    if last_rank is not None and last_article_id is not None:
+        where_term += ('AND ' if where_term else 'WHERE ') + '(a.rank, a.id) > (?, ?) '
+        where_values += (last_rank, last_article_id)
+
+    matches = ' UNION ALL '.join('SELECT t.id, site_id, title, summary, link, thumbnail, author, published, c.rank '
+                                 f'FROM candidates c JOIN {table} t ON t.id = c.id' for table in tables)
+    cursor.execute('WITH candidates AS MATERIALIZED ('
+                   'SELECT rowid AS id, rank FROM article_fts '
+                   'WHERE article_fts MATCH ? AND rowid <= ? '
+                   'ORDER BY rowid DESC LIMIT ?'
+                   f'), matches AS ({matches}) '
+                   'SELECT a.id, name AS site, title, summary, link, thumbnail, author, published, icon, a.rank '
+                   'FROM matches a JOIN site s ON s.id = a.site_id '
+                   f'{where_term}'
+                   'ORDER BY a.rank, a.id LIMIT ?',
+                   (query, window, size) + where_values + (n_articles,))
+    return cursor.fetchall()
+
+
+def search_articles(query, sites, n_articles, last_rank=None, last_article_id=None, window=None):
+    """
+    Returns the articles of the given sites matching the full-text query and the cursor of the next page, or None if
+    there are no further matches.
+
+    Archived articles are searched as well. Matching articles are ranked in windows of the newest SEARCH_WINDOW matches, which keeps queries for common terms
+    fast regardless of the size of the archive. Pages start with the best matches of the newest window and continue
+    with older windows, up to SEARCH_MAX_WINDOWS windows per request. The cursor holds the highest ID of the window of
+    the last article together with its rank and ID, and is passed to retrieve the next page.
+    """
+    sites_term, sites_values = parse_sites(sites)
+    if n_articles <= 0:
+        return [], None
+    key = (query, sites_values, n_articles, last_rank, last_article_id, window)
+
+    version = latest_update()
+    cached = search_cache.get(version, key)
+    if cached is None:
+        size = current_app.config['SEARCH_WINDOW']
+        cursor = get_tuple_cursor()
+        rows = []
+        next_page = None
+        try:
+            for _ in range(current_app.config['SEARCH_MAX_WINDOWS']):
+                newest, oldest, count = match_window(cursor, query, window, size)
+                if count == 0:
+                    next_page = None
+                    break
+                window = newest
+                tables = window_tables(cursor, newest, oldest)
+                rows += rank_window(cursor, query, window, size, tables, sites_term, sites_values, last_rank,
+                                    last_article_id, n_articles - len(rows))
+                if len(rows) == n_articles:
+                    next_page = (rows[-1][-1], rows[-1][0], window)
+                    break
+                if count < size:
+                    # The oldest window is used up
+                    next_page = None
+                    break
+                # Continue with the best matches of the next older window
+                window, last_rank, last_article_id = oldest - 1, None, None
+                next_page = (FIRST_RANK, 0, window)
+        except sqlite3.OperationalError:
+            # Invalid full-text query syntax
+            abort(400)
+        cached = (rows, next_page)
+        search_cache.put(version, key, cached)
+
+    rows, next_page = cached
+    return [dict(zip(SEARCH_FIELDS, row)) for row in rows], next_page
+
+
+@bp.route("/<query>")
+@bp.route("/<query>/<sites>/<int:n_articles>")
+@bp.route("/<query>/<sites>/<int:n_articles>/<last_rank>/<int:last_article_id>")
+@bp.route("/<query>/<sites>/<int:n_articles>/<last_rank>/<int:last_article_id>/<int:window>")
+@conditional()
+def request_search(query, sites='all', n_articles=35, last_rank=None, last_article_id=None, window=None):
+    # Ranks are passed as plain strings, as Flask's float converter does not accept exponents
+    if last_rank is not None:
+        try:
+            last_rank = float(last_rank)
+        except ValueError:
+            abort(400)
+    articles, next_page = search_articles(query, sites, n_articles, last_rank, last_article_id, window)
+    if next_page is not None:
+        next_rank, next_article_id, next_window = next_page
+        next_page = {'rank': next_rank, 'id': next_article_id, 'window': next_window}
+    return {'articles': articles, 'next': next_page}
@@ -0,0 +1,48 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    JSON provider which serializes with orjson if it is installed, otherwise with the json module like Flask's default
+    provider. Output is compact, or indented in debug mode, and keys are sorted either way.
+    """
+
+    def _orjson_options(self, indent):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def _indent(self):
+        return (self.compact is None and self._app.debug) or self.compact is False
+
+    def encode(self, obj) -> bytes:
+        """
+        Returns the JSON of an object as UTF-8 bytes, formatted like the responses of the provider.
+        """
+        if orjson is not None:
+            return orjson.dumps(obj, default=self.default, option=self._orjson_options(self._indent()))
+        if self._indent():
+            return super().dumps(obj, indent=2).encode()
+        return super().dumps(obj, separators=(',', ':')).encode()
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_options(False)).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj) + b'\n', mimetype=self.mimetype)
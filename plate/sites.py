@@ -1,13 +1,68 @@
-from flask import Blueprint
+import hmac
 
-from plate.db import get_db
+from flask import Blueprint, abort, current_app, request
+
+from plate.db import get_tuple_cursor
+from plate.opml import MAX_OPML_SIZE, add_to_feeds_file, parse_opml, render_opml
+from plate.responses import conditional
 
 bp = Blueprint('sites', __name__, url_prefix='/sites')
 
 
 @bp.route("/")
+@conditional()
 def request_sites():
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('SELECT name AS site, id FROM site')
-    return {'sites': [dict(row) for row in cursor.fetchall()]}
+    cursor = get_tuple_cursor()
+    cursor.execute('SELECT name, id FROM site')
+    return {'sites': [{'site': name, 'id': site_id} for name, site_id in cursor]}
+
+
+@bp.route("/opml")
+@conditional()
+def export_opml():
+    cursor = get_tuple_cursor()
+    cursor.execute('SELECT name, feed FROM site ORDER BY name')
+    return current_app.response_class(''.join(render_opml(cursor)), mimetype='text/x-opml')
+
+
+def read_upload(limit):
+    """
+    Returns the uploaded form file named opml or the request body. Requests larger than limit bytes are rejected before
+    anything is read.
+    """
+    if request.content_length is None:
+        abort(411)
+    if request.content_length > limit:
+        abort(413)
+    upload = request.files.get('opml') if request.mimetype == 'multipart/form-data' else None
+    stream = upload.stream if upload is not None else request.stream
+    data = stream.read(limit + 1)
+    if len(data) > limit:
+        abort(413)
+    return data
+
+
+def authorized(token):
+    authorization = request.headers.get('Authorization', '')
+    return authorization.startswith('Bearer ') and hmac.compare_digest(authorization[7:].encode(), token.encode())
+
+
+@bp.route("/opml", methods=['POST'])
+def import_opml():
+    """
+    Adds the sites of an uploaded OPML document to the feeds file, from which the collector registers them within its
+    next reload. Only available if FEEDS_FILE and OPML_IMPORT_TOKEN are configured, and the token has to be sent as
+    a bearer token.
+    """
+    feeds_file = current_app.config['FEEDS_FILE']
+    token = current_app.config['OPML_IMPORT_TOKEN']
+    if feeds_file is None or not token:
+        abort(404)
+    if not authorized(token):
+        abort(403)
+    try:
+        sites = parse_opml(read_upload(MAX_OPML_SIZE))
+    except ValueError:
+        abort(400)
+    added = add_to_feeds_file(feeds_file, sites)
+    return {'added': [{'site': name, 'feed': feed} for name, feed in added]}
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from flask import Blueprint, Response, abort, current_app, request
+
+import database
+from plate.articles import parse_sites
+from plate.cache import database_signature
+
+bp = Blueprint('stream', __name__, url_prefix='/articles/stream')
+
+# Seconds between checks of the database files for changes
+POLL_INTERVAL = 2
+# Seconds after which a comment is sent to keep idle event streams open
+HEARTBEAT_INTERVAL = 15
+LONG_POLL_TIMEOUT = 30
+# Number of newest articles kept in memory for subscribers which are behind
+RECENT_ARTICLES = 1000
+# Seconds after which clients turned away because all stream connections are taken may try again
+STREAM_RETRY_AFTER = 30
+
+
+class ArticleWatcher:
+    """
+    Watches the database for new articles on a single background thread per process and hands them out to all waiting
+    subscribers, so that the number of subscribers does not affect the number of queries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.condition = threading.Condition()
+        self.recent = deque(maxlen=RECENT_ARTICLES)
+        self.last_id = None
+        self.thread = None
+        self.pid = None
+        self.subscribers = 0
+
+    def start(self):
+        with self.condition:
+            # Threads do not survive forking into worker processes
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            connection = database.connect_read_only(self.path)
+            self.last_id = connection.execute('SELECT coalesce(max(id), 0) FROM article').fetchone()[0]
+            self.recent.clear()
+            self.subscribers = 0
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, args=(connection,), name='article-watcher', daemon=True)
+            self.thread.start()
+
+    def run(self, connection):
+        signature = database_signature(self.path)
+        while True:
+            time.sleep(POLL_INTERVAL)
+            current_signature = database_signature(self.path)
+            if current_signature == signature:
+                continue
+            signature = current_signature
+
+            try:
+                cursor = connection.execute('SELECT a.id, site_id, name AS site, title, summary, link, thumbnail, '
+                                            'author, published, icon '
+                                            'FROM article a JOIN site s ON s.id = a.site_id '
+                                            'WHERE a.id > ? ORDER BY a.id', (self.last_id,))
+                columns = [column[0] for column in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                logging.error(f'Encountered error while watching for new articles: {e}')
+                continue
+
+            if rows:
+                with self.condition:
+                    self.recent.extend(rows)
+                    self.last_id = rows[-1]['id']
+                    self.condition.notify_all()
+
+    def subscribe(self, limit):
+        """
+        Registers a subscriber, which holds a server thread while it waits, unless limit subscribers are registered
+        already. Returns whether the subscriber was registered.
+        """
+        with self.condition:
+            if self.subscribers >= limit:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def wait(self, after_id, site_ids, timeout):
+        """
+        Waits until articles of the given sites newer than after_id are available or the timeout in seconds passes.
+        Returns the new articles, oldest first, and the ID to wait after next time.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                articles = [{key: value for key, value in article.items() if key != 'site_id'}
+                            for article in self.recent
+                            if article['id'] > after_id and (not site_ids or article['site_id'] in site_ids)]
+                if articles:
+                    return articles, articles[-1]['id']
+                # Articles of other sites do not have to be looked at again
+                after_id = max(after_id, self.last_id)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], after_id
+                self.condition.wait(remaining)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher():
+    path = current_app.config['DATABASE']
+    with _watchers_lock:
+        if path not in _watchers:
+            _watchers[path] = ArticleWatcher(path)
+        watcher = _watchers[path]
+    watcher.start()
+    return watcher
+
+
+def event_stream(watcher, after_id, site_ids):
+    yield 'retry: 10000\n\n'
+    while True:
+        articles, after_id = watcher.wait(after_id, site_ids, HEARTBEAT_INTERVAL)
+        if not articles:
+            yield ': heartbeat\n\n'
+        for article in articles:
+            yield f'id: {article["id"]}\nevent: article\ndata: {json.dumps(article)}\n\n'
+
+
+@bp.route("")
+@bp.route("/<sites>")
+@bp.route("/<sites>/<int:last_article_id>")
+def stream_articles(sites='all', last_article_id=None):
+    """
+    Pushes new articles as server-sent events if the client accepts them, otherwise waits up to LONG_POLL_TIMEOUT
+    seconds for new articles and returns them as JSON.
+    Both hold a server thread while they wait, so at most STREAM_MAX_CONNECTIONS of them are served per process at a
+    time, leaving the remaining threads to the other endpoints. Further requests are answered with 503 and Retry-After.
+    """
+    _, site_ids = parse_sites(sites)
+    site_ids = set(site_ids)
+    watcher = get_watcher()
+
+    if last_article_id is None:
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        last_article_id = int(last_event_id) if last_event_id.isdigit() else watcher.last_id
+
+    if not watcher.subscribe(current_app.config['STREAM_MAX_CONNECTIONS']):
+        abort(503, retry_after=STREAM_RETRY_AFTER)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        response = Response(event_stream(watcher, last_article_id, site_ids), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Keep nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        # Also called if the stream is never started
+        response.call_on_close(watcher.unsubscribe)
+        return response
+
+    try:
+        articles, last_article_id = watcher.wait(last_article_id, site_ids, LONG_POLL_TIMEOUT)
+    finally:
+        watcher.unsubscribe()
+    return {'articles': articles, 'last_article_id': last_article_id}
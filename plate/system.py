@@ -1,13 +1,21 @@
+import time
 from datetime import datetime
 
-from flask import Blueprint
+from flask import Blueprint, Response
 
 from plate.db import get_db
+from plate.metrics import shared_request_latency
+from plate.responses import conditional
 
 bp = Blueprint('system', __name__, url_prefix='/system')
 
+# Seconds of feed update history aggregated by the metrics endpoint
+METRICS_WINDOW = 24 * 3600
+STAGES = ['fetch', 'parse', 'extract', 'clean', 'store', 'commit']
+
 
 @bp.route("/status")
+@conditional()
 def request_sites():
     db = get_db()
     cursor = db.cursor()
@@ -21,3 +29,162 @@ def request_sites():
         last_updated, success = results[0]
         last_updated_string = datetime.utcfromtimestamp(last_updated).strftime('%d.%m.%Y %H:%M (UTC)')
     return {'last_updated': last_updated, 'last_updated_string': last_updated_string, 'success': bool(success)}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricsWriter:
+    """
+    Writes metrics in the Prometheus text exposition format, declaring each metric before its first sample.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def sample(self, name, type_, help_, value, labels=None):
+        if value is None:
+            return
+        if name not in self.declared:
+            self.declared.add(name)
+            self.lines.append(f'# HELP {name} {help_}')
+            self.lines.append(f'# TYPE {name} {type_}')
+        self.lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def write_update_metrics(writer, cursor):
+    cursor.execute('SELECT update_time, success FROM system ORDER BY rowid DESC LIMIT 1')
+    row = cursor.fetchone()
+    if row is not None:
+        writer.sample('newsfeeder_last_update_timestamp_seconds', 'gauge',
+                      'Time at which the collector last completed an update.', row['update_time'])
+        writer.sample('newsfeeder_last_update_success', 'gauge',
+                      'Whether all feeds of the last update were updated successfully.', row['success'])
+
+    cursor.execute('SELECT max(id) FROM article')
+    writer.sample('newsfeeder_article_max_id', 'gauge', 'Highest article ID, a proxy for the number of articles.',
+                  cursor.fetchone()[0] or 0)
+
+
+def write_last_run_metrics(writer, cursor):
+    cursor.execute('SELECT s.name, s.update_interval, s.update_errors, s.circuit_open_until, r.update_time, r.status, '
+                   'r.bytes, r.fetch_time, r.parse_time, r.new_articles, r.duplicate_articles, r.retries '
+                   'FROM site s JOIN feed_run r ON r.id = ('
+                   'SELECT id FROM feed_run WHERE site_id = s.id ORDER BY update_time DESC, id DESC LIMIT 1'
+                   ') ORDER BY s.name')
+    for row in cursor.fetchall():
+        labels = {'site': row['name']}
+        writer.sample('newsfeeder_feed_last_run_timestamp_seconds', 'gauge', 'Time of the last update of the feed.',
+                      row['update_time'], labels)
+        writer.sample('newsfeeder_feed_last_status', 'gauge',
+                      'HTTP status of the last update of the feed, 0 if it could not be fetched.',
+                      row['status'] or 0, labels)
+        writer.sample('newsfeeder_feed_last_bytes', 'gauge', 'Bytes received in the last update of the feed.',
+                      row['bytes'], labels)
+        writer.sample('newsfeeder_feed_last_fetch_seconds', 'gauge',
+                      'Seconds spent downloading the feed in its last update.', row['fetch_time'], labels)
+        writer.sample('newsfeeder_feed_last_parse_seconds', 'gauge',
+                      'Seconds spent parsing the feed in its last update.', row['parse_time'], labels)
+        writer.sample('newsfeeder_feed_last_new_articles', 'gauge', 'New articles in the last update of the feed.',
+                      row['new_articles'], labels)
+        writer.sample('newsfeeder_feed_last_duplicate_articles', 'gauge',
+                      'Already stored articles in the last update of the feed.', row['duplicate_articles'], labels)
+        writer.sample('newsfeeder_feed_last_retries', 'gauge', 'Retried requests in the last update of the feed.',
+                      row['retries'] or 0, labels)
+        writer.sample('newsfeeder_feed_update_interval_seconds', 'gauge',
+                      'Current adaptive polling interval of the feed.', row['update_interval'], labels)
+        writer.sample('newsfeeder_feed_consecutive_errors', 'gauge', 'Consecutive failed updates of the feed.',
+                      row['update_errors'], labels)
+        writer.sample('newsfeeder_feed_circuit_open_until_timestamp_seconds', 'gauge',
+                      'Time until which the feed is not fetched after repeated failures, 0 if it is fetched.',
+                      row['circuit_open_until'] or 0, labels)
+
+
+def write_window_metrics(writer, cursor):
+    since = int(time.time()) - METRICS_WINDOW
+    window = f'{METRICS_WINDOW // 3600}h'
+
+    cursor.execute('SELECT status, count(*) AS runs FROM feed_run WHERE update_time >= ? GROUP BY status', (since,))
+    for row in cursor.fetchall():
+        writer.sample('newsfeeder_feed_runs', 'gauge', 'Feed updates within the window by HTTP status.', row['runs'],
+                      {'window': window, 'status': row['status'] if row['status'] is not None else 'error'})
+
+    stage_sums = ', '.join(f'sum(r.{stage}_time) AS {stage}_time' for stage in STAGES)
+    # 304 responses save the bytes of the full feed, estimated by the size of the latest full response before them
+    cursor.execute('SELECT s.name, count(*) AS runs, sum(r.error IS NOT NULL) AS errors, '
+                   'sum(r.status = 304) AS not_modified, sum(r.bytes) AS bytes, '
+                   'sum(r.new_articles) AS new_articles, sum(r.duplicate_articles) AS duplicate_articles, '
+                   f'{stage_sums}, '
+                   'sum(CASE WHEN r.status = 304 THEN ('
+                   'SELECT p.bytes FROM feed_run p WHERE p.site_id = r.site_id AND p.status = 200 '
+                   'AND p.update_time <= r.update_time ORDER BY p.update_time DESC LIMIT 1'
+                   ') END) AS bytes_saved '
+                   'FROM feed_run r JOIN site s ON s.id = r.site_id '
+                   'WHERE r.update_time >= ? GROUP BY r.site_id ORDER BY s.name', (since,))
+    for row in cursor.fetchall():
+        labels = {'site': row['name'], 'window': window}
+        writer.sample('newsfeeder_feed_window_runs', 'gauge', 'Updates of the feed within the window.', row['runs'],
+                      labels)
+        writer.sample('newsfeeder_feed_window_errors', 'gauge', 'Failed updates of the feed within the window.',
+                      row['errors'], labels)
+        writer.sample('newsfeeder_feed_window_not_modified', 'gauge',
+                      'Updates of the feed answered with 304 Not Modified within the window.', row['not_modified'],
+                      labels)
+        writer.sample('newsfeeder_feed_window_bytes', 'gauge', 'Bytes received for the feed within the window.',
+                      row['bytes'] or 0, labels)
+        writer.sample('newsfeeder_feed_window_bytes_saved', 'gauge',
+                      'Estimated bytes not transferred thanks to 304 responses within the window.',
+                      row['bytes_saved'] or 0, labels)
+        writer.sample('newsfeeder_feed_window_new_articles', 'gauge', 'New articles of the feed within the window.',
+                      row['new_articles'] or 0, labels)
+        writer.sample('newsfeeder_feed_window_duplicate_articles', 'gauge',
+                      'Already stored articles seen in the feed within the window.', row['duplicate_articles'] or 0,
+                      labels)
+        for stage in STAGES:
+            writer.sample('newsfeeder_feed_window_stage_seconds', 'gauge',
+                          'Seconds spent per update stage of the feed within the window.', row[f'{stage}_time'] or 0,
+                          {**labels, 'stage': stage})
+
+
+def write_request_metrics(writer):
+    name = 'newsfeeder_request_duration_seconds'
+    for endpoint, (buckets, count, total) in sorted(shared_request_latency().totals().items()):
+        if name not in writer.declared:
+            writer.declared.add(name)
+            writer.lines.append(f'# HELP {name} Latency of requests handled by all server processes by endpoint.')
+            writer.lines.append(f'# TYPE {name} histogram')
+        for bound, bucket_count in buckets:
+            writer.lines.append(f'{name}_bucket{format_labels({"endpoint": endpoint, "le": bound})} {bucket_count}')
+        writer.lines.append(f'{name}_count{format_labels({"endpoint": endpoint})} {count}')
+        writer.lines.append(f'{name}_sum{format_labels({"endpoint": endpoint})} {format_value(total)}')
+
+
+@bp.route("/metrics")
+def request_metrics():
+    """
+    Exposes feed update and request metrics in the Prometheus text format.
+    Request latencies are summed over all server processes, each of which writes its own to the metrics directory.
+    """
+    cursor = get_db().cursor()
+    writer = MetricsWriter()
+    write_update_metrics(writer, cursor)
+    write_last_run_metrics(writer, cursor)
+    write_window_metrics(writer, cursor)
+    write_request_metrics(writer)
+    return Response(writer.text(), mimetype='text/plain; version=0.0.4')
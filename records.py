@@ -0,0 +1,381 @@
+import calendar
+import functools
+import hashlib
+import logging
+import re
+import xml.etree.ElementTree as ElementTree
+from collections import deque
+from datetime import timedelta
+
+import feedparser
+from dateutil import parser as dateparser
+# Private feedparser helpers, used so that IDs, links and summaries match those stored by earlier versions
+from feedparser.datetimes import _parse_date
+from feedparser.sanitizer import _sanitize_html
+from feedparser.urls import _urljoin
+
+# Bytes handed to the XML parser at a time
+PARSE_CHUNK_SIZE = 16 * 1024
+RECORD_HASH_SIZE = 16
+# Channel elements used by the scheduler, by the name feedparser gives them
+CHANNEL_KEYS = {'ttl': 'ttl', 'sy:updatePeriod': 'sy_updateperiod', 'sy:updateFrequency': 'sy_updatefrequency'}
+ENTRY_TAGS = {'item', 'entry'}
+# Namespace prefixes of the elements which are read, elements of RSS 1.0 and Atom have no prefix like those of RSS 2.0
+NAMESPACES = {
+    'http://www.w3.org/2005/Atom': '',
+    'http://purl.org/atom/ns#': '',
+    'http://purl.org/rss/1.0/': '',
+    'http://backend.userland.com/rss2': '',
+    'http://search.yahoo.com/mrss/': 'media:',
+    'http://search.yahoo.com/mrss': 'media:',
+    'http://purl.org/dc/elements/1.1/': 'dc:',
+    'http://purl.org/rss/1.0/modules/content/': 'content:',
+    'http://purl.org/rss/1.0/modules/syndication/': 'sy:',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#': 'rdf:',
+    'http://www.w3.org/XML/1998/namespace': 'xml:',
+}
+PUBLISHED_TAGS = {'pubDate', 'published', 'issued'}
+UPDATED_TAGS = {'updated', 'modified', 'dc:date', 'dc:modified'}
+SUMMARY_TAGS = {'description', 'summary'}
+CONTENT_TAGS = {'content:encoded', 'content'}
+AUTHOR_TAGS = {'author', 'dc:creator'}
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+RDF_ABOUT = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+# Markup whose content is removed by feedparser's sanitizer rather than kept as text
+DANGEROUS_MARKUP_REGEX = re.compile(r'<(?:script|style|applet|object|iframe)', re.IGNORECASE)
+
+IMAGE_URL_REGEX = re.compile(r'"(https?://[^"]*\.(?:png|jpg))"', re.IGNORECASE)
+# Relative image URLs in summary markup, which feedparser resolves before the summary is searched for images
+RELATIVE_IMAGE_URL_REGEX = re.compile(r'"(https?://[^"]*\.(?:png|jpg))"|\b(?:src|href)\s*=\s*"([^":]*\.(?:png|jpg))"',
+                                      re.IGNORECASE)
+ATOM_NAMESPACES = {'http://www.w3.org/2005/Atom', 'http://purl.org/atom/ns#'}
+# Content types of summaries whose relative URIs feedparser resolves
+HTML_TYPES = {'html', 'xhtml', 'text/html', 'application/xhtml+xml'}
+
+
+class ArticleRecord:
+    """
+    The fields of a feed entry which are stored as an article.
+    The title and summary are raw until the record is cleaned for storing.
+    """
+    __slots__ = ('original_id', 'title', 'summary', 'link', 'thumbnail', 'published', 'author', 'content_hash')
+
+    def __init__(self, original_id, title, summary, link, thumbnail, published, author):
+        self.original_id = original_id
+        self.title = title
+        self.summary = summary
+        self.link = link
+        self.thumbnail = thumbnail
+        self.published = published
+        self.author = author
+        content = repr((original_id, title, summary, link, thumbnail, published, author))
+        self.content_hash = hashlib.blake2b(content.encode(), digest_size=RECORD_HASH_SIZE).hexdigest()
+
+    def row(self, site_id):
+        """
+        Returns the record as a tuple for main.insert_articles.
+        """
+        return (self.original_id, site_id, self.title, self.summary, self.link, self.thumbnail, self.published,
+                self.author, self.content_hash)
+
+
+def ensure_https(link: str):
+    """
+    Converts HTTP links into HTTPS links.
+    """
+    if link.startswith('http:'):
+        return 'https' + link[4:]
+    return link
+
+
+def summary_image(summary, base=None):
+    """
+    Returns the first image URL in the markup of a summary, or None. Relative URLs of images and links are resolved
+    against base if it is given.
+    """
+    if base is None:
+        matches = IMAGE_URL_REGEX.findall(summary)
+        if len(matches) > 0:
+            return ensure_https(matches[0])
+        return None
+
+    for absolute, relative in RELATIVE_IMAGE_URL_REGEX.findall(summary):
+        url = absolute or _urljoin(base, relative)
+        if url.startswith(('http:', 'https:')):
+            return ensure_https(url)
+    return None
+
+
+def markup_base(element, base):
+    """
+    Returns the base URI of the markup in a summary or content element, or None if the element holds plain text.
+    Atom elements hold plain text unless their type says otherwise, while RSS descriptions hold HTML.
+    """
+    namespace = element.tag[1:].split('}', 1)[0] if element.tag[0] == '{' else None
+    if element.get('type', 'text' if namespace in ATOM_NAMESPACES else 'html').lower() not in HTML_TYPES:
+        return None
+    return _urljoin(base, element.get(XML_BASE, ''))
+
+
+def published_timestamp(source, title, published, updated):
+    """
+    Returns the publication date of an entry as a UNIX timestamp, given its published and updated elements.
+    """
+    if published is not None:
+        date = _parse_date(published)
+    elif updated is not None:
+        date = _parse_date(updated)
+        if date is None:
+            raise AttributeError(f'"{source}" article "{title}" has no parseable publication date')
+    else:
+        raise AttributeError(f'"{source}" article "{title}" has no publication date')
+    if date is not None:
+        return calendar.timegm(date)
+
+    logging.warning(f'No parsed date in "{source}" article "{title}".')
+    # Add four hours because the only current source without parseable date is in UTC-5 for standard time and UTC-4
+    # for daylight saving time and adding four hours has a less noticeable impact
+    return calendar.timegm((dateparser.parse(published) + timedelta(hours=4)).timetuple())
+
+
+def record_from_entry(source, entry):
+    """
+    Converts an entry parsed by feedparser into an ArticleRecord.
+    """
+    thumbnail = None
+    # Check for media content, then media thumbnail, then links
+    for content in entry.get('media_content', []) + entry.get('media_thumbnail', []):
+        thumbnail = ensure_https(content['url'])
+        break
+    else:
+        for link in entry.get('links', []):
+            if link.type.startswith('image'):
+                thumbnail = ensure_https(link.href)
+                break
+        else:
+            thumbnail = summary_image(entry.summary)
+
+    return ArticleRecord(entry.id, entry.title, entry.summary, entry.link, thumbnail,
+                         published_timestamp(source, entry.title, entry.get('published'), entry.get('updated')),
+                         entry.get('author'))
+
+
+@functools.lru_cache(maxsize=256)
+def local_name(tag):
+    """
+    Returns the name of an element with the prefix of its namespace, e.g. "media:content".
+    """
+    if tag[0] != '{':
+        return tag
+    namespace, name = tag[1:].split('}', 1)
+    if namespace not in NAMESPACES:
+        return tag
+    return NAMESPACES[namespace] + name
+
+
+def element_text(element):
+    """
+    Returns the text of an element, or the text of its markup if it contains elements, e.g. Atom XHTML content.
+    """
+    if len(element) == 0:
+        return (element.text or '').strip()
+    return ''.join(element.itertext()).strip()
+
+
+def author_name(element):
+    if len(element) == 0:
+        return element_text(element) or None
+    parts = {local_name(child.tag): element_text(child) for child in element}
+    name, email = parts.get('name'), parts.get('email')
+    if name and email:
+        return f'{name} ({email})'
+    return name or email or None
+
+
+def record_from_element(source, element, base):
+    """
+    Converts an RSS item or Atom entry element into an ArticleRecord the way feedparser would read it.
+    """
+    original_id = title = summary = content = link = published = updated = author = None
+    summary_base = content_base = None
+    guid_is_link = True
+    image_link = None
+    for child in element:
+        name = local_name(child.tag)
+        if name in ('guid', 'id'):
+            if original_id is None:
+                original_id = element_text(child)
+                guid_is_link = child.get('isPermaLink', 'true').lower() != 'false'
+        elif name == 'title':
+            if title is None:
+                title = element_text(child)
+        elif name == 'link':
+            href = child.get('href')
+            if href is None:
+                if link is None:
+                    link = _urljoin(base, element_text(child))
+            elif child.get('type', '').startswith('image'):
+                image_link = image_link or _urljoin(base, href)
+            elif link is None and child.get('rel', 'alternate') == 'alternate':
+                link = _urljoin(base, href)
+        elif name == 'enclosure':
+            if child.get('type', '').startswith('image') and child.get('url'):
+                image_link = image_link or _urljoin(base, child.get('url'))
+        elif name in SUMMARY_TAGS:
+            if summary is None:
+                summary = element_text(child)
+                summary_base = markup_base(child, base)
+        elif name in CONTENT_TAGS:
+            if content is None:
+                content = element_text(child)
+                content_base = markup_base(child, base)
+        elif name in PUBLISHED_TAGS:
+            if published is None:
+                published = element_text(child)
+        elif name in UPDATED_TAGS:
+            if updated is None:
+                updated = element_text(child)
+        elif name in AUTHOR_TAGS:
+            if author is None:
+                author = author_name(child)
+
+    if original_id is None:
+        original_id = element.get(RDF_ABOUT)
+        if original_id is None:
+            raise AttributeError(f'"{source}" article has no ID')
+    elif original_id and guid_is_link:
+        original_id = _urljoin(base, original_id)
+    if link is None and guid_is_link:
+        link = original_id
+    if summary is None:
+        summary, summary_base = content, content_base
+    if title is None or link is None or summary is None:
+        raise AttributeError(f'"{source}" article "{original_id}" has no title, link or summary')
+    if DANGEROUS_MARKUP_REGEX.search(summary):
+        summary = _sanitize_html(summary, 'utf-8', 'text/html')
+
+    thumbnail = None
+    # Media elements may be nested in a media:group
+    for media in ('media:content', 'media:thumbnail'):
+        for child in element.iter():
+            if local_name(child.tag) == media and child.get('url'):
+                thumbnail = ensure_https(_urljoin(base, child.get('url')))
+                break
+        if thumbnail is not None:
+            break
+    if thumbnail is None:
+        thumbnail = ensure_https(image_link) if image_link else summary_image(summary, summary_base)
+
+    return ArticleRecord(original_id, title, summary, link, thumbnail,
+                         published_timestamp(source, title, published, updated), author)
+
+
+class FeedStream:
+    """
+    Parses the entries of a feed body incrementally into ArticleRecords while it is iterated, so that only the entry
+    being read is held in memory and reading can stop before the end of the feed.
+    Bodies which are not well-formed XML are parsed by feedparser instead.
+    """
+
+    def __init__(self, data, headers):
+        self.data = data
+        self.headers = headers
+        self.source = headers.get('content-location', '')
+        # Channel elements used by the scheduler, complete once the first entry is reached
+        self.channel = {}
+        # Entries parsed by feedparser if the body is not well-formed
+        self.entries = None
+        self.events = self._read_events()
+        self.pending = deque()
+        # Open elements with their base URI
+        self.stack = [(None, self.source)]
+        self.entry_depth = 0
+
+    def _read_events(self):
+        parser = ElementTree.XMLPullParser(('start', 'end'))
+        for i in range(0, len(self.data), PARSE_CHUNK_SIZE):
+            parser.feed(self.data[i:i + PARSE_CHUNK_SIZE])
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    def _parse_fallback(self, error):
+        logging.debug(f'"{self.source}" is not well-formed, parsing it with feedparser: {error}')
+        result = feedparser.parse(self.data, response_headers=self.headers)
+        for key in CHANNEL_KEYS.values():
+            if key in result.feed:
+                self.channel.setdefault(key, result.feed[key])
+        self.entries = result.entries
+
+    def read_channel(self):
+        """
+        Reads the feed up to its first entry, so that the channel elements are available.
+        """
+        try:
+            for event, element in self.events:
+                self.pending.append((event, element))
+                if event == 'start' and local_name(element.tag) in ENTRY_TAGS:
+                    return
+                self._read_element(*self.pending.popleft())
+        except ElementTree.ParseError as e:
+            self._parse_fallback(e)
+
+    def _read_element(self, event, element):
+        """
+        Keeps track of open elements and reads channel elements. Returns a record at the end of an entry.
+        """
+        name = local_name(element.tag)
+        if event == 'start':
+            self.stack.append((element, _urljoin(self.stack[-1][1], element.get(XML_BASE, ''))))
+            if name in ENTRY_TAGS:
+                self.entry_depth += 1
+            return None
+
+        _, base = self.stack.pop()
+        if name in ENTRY_TAGS:
+            self.entry_depth -= 1
+            if self.entry_depth == 0:
+                record = record_from_element(self.source, element, base)
+                # Drop the entry from the document tree
+                parent = self.stack[-1][0]
+                if parent is not None:
+                    parent.remove(element)
+                return record
+        elif self.entry_depth == 0 and name in CHANNEL_KEYS:
+            self.channel.setdefault(CHANNEL_KEYS[name], element_text(element))
+        return None
+
+    def _read_records(self, yielded):
+        while self.pending:
+            record = self._read_element(*self.pending.popleft())
+            if record is not None:
+                yielded.add(record.original_id)
+                yield record
+        for event, element in self.events:
+            record = self._read_element(event, element)
+            if record is not None:
+                yielded.add(record.original_id)
+                yield record
+
+    def __iter__(self):
+        yielded = set()
+        if self.entries is None:
+            try:
+                yield from self._read_records(yielded)
+                return
+            except ElementTree.ParseError as e:
+                self._parse_fallback(e)
+
+        for entry in self.entries:
+            record = record_from_entry(self.source, entry)
+            if record.original_id not in yielded:
+                yield record
+
+
+def parse_body(data, headers):
+    """
+    Returns a FeedStream of a feed body with its channel elements read.
+    """
+    stream = FeedStream(data, headers)
+    stream.read_channel()
+    return stream
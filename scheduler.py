@@ -0,0 +1,201 @@
+import heapq
+import logging
+import re
+import time
+from email.utils import parsedate_to_datetime
+
+MIN_INTERVAL = 5 * 60
+MAX_INTERVAL = 24 * 60 * 60
+# Weight of the latest observation when adapting the interval to the rate of new articles
+SMOOTHING = 0.5
+# Factor by which the interval grows when a feed had no new articles
+IDLE_GROWTH = 1.5
+MAX_BACKOFF_EXPONENT = 10
+
+SY_UPDATE_PERIODS = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+    'monthly': 30 * 24 * 60 * 60,
+    'yearly': 365 * 24 * 60 * 60,
+}
+MAX_AGE_REGEX = re.compile(r'(?:^|,)\s*(?:s-)?max-age\s*=\s*"?(\d+)', re.IGNORECASE)
+
+
+def parse_retry_after(value, now):
+    """
+    Returns the number of seconds to wait given a Retry-After header, which is either a number of seconds or a date.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError):
+        return None
+
+
+def publisher_interval(feed):
+    """
+    Returns the minimum polling interval in seconds requested by the publisher through the RSS ttl element, the
+    syndication module or the Cache-Control header, or None if there is no such request.
+    """
+    intervals = []
+
+    channel = feed.get('feed', {})
+    ttl = channel.get('ttl')
+    if ttl is not None and ttl.strip().isdigit():
+        intervals.append(int(ttl) * 60)
+
+    period = SY_UPDATE_PERIODS.get(channel.get('sy_updateperiod', '').strip().lower())
+    if period is not None:
+        frequency = channel.get('sy_updatefrequency', '1').strip()
+        frequency = int(frequency) if frequency.isdigit() and int(frequency) > 0 else 1
+        intervals.append(period / frequency)
+
+    cache_control = feed.get('headers', {}).get('cache-control', '')
+    max_age = MAX_AGE_REGEX.search(cache_control)
+    if max_age is not None and 'no-cache' not in cache_control.lower():
+        intervals.append(int(max_age.group(1)))
+
+    return max(intervals) if intervals else None
+
+
+class SiteSchedule:
+    __slots__ = ('site_id', 'interval', 'next_update', 'last_update', 'errors')
+
+    def __init__(self, site_id, interval, next_update, last_update, errors):
+        self.site_id = site_id
+        self.interval = interval
+        self.next_update = next_update
+        self.last_update = last_update
+        self.errors = errors
+
+
+class Scheduler:
+    """
+    Keeps track of when each site is due to be polled next.
+
+    The polling interval of each site adapts to the rate at which it publishes new articles, never goes below the
+    interval requested by the publisher and backs off exponentially on errors. The schedule is stored in the site table
+    so that it survives restarts.
+    """
+
+    def __init__(self, default_interval, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.default_interval = default_interval
+        self.min_interval = min(min_interval, default_interval)
+        self.max_interval = max(max_interval, default_interval)
+        self.sites = {}
+        self.queue = []
+
+    def load(self, cursor, site_ids):
+        """
+        Loads the stored schedule of the given sites which are not scheduled yet. Sites which were never polled are due
+        immediately. Returns the number of loaded sites.
+        """
+        site_ids = set(site_ids) - self.sites.keys()
+        if not site_ids:
+            return 0
+        now = time.time()
+        loaded = 0
+        cursor.execute('SELECT id, update_interval, next_update, last_update, update_errors FROM site')
+        for site_id, interval, next_update, last_update, errors in cursor.fetchall():
+            if site_id not in site_ids:
+                continue
+            schedule = SiteSchedule(site_id, interval or self.default_interval, next_update or now, last_update,
+                                    errors or 0)
+            self.sites[site_id] = schedule
+            heapq.heappush(self.queue, (schedule.next_update, site_id))
+            loaded += 1
+        return loaded
+
+    def remove(self, site_ids):
+        """
+        Stops scheduling the given sites. Their queue entries are skipped once they come up.
+        """
+        for site_id in site_ids:
+            self.sites.pop(site_id, None)
+
+    def due(self, now=None):
+        """
+        Removes and returns the IDs of all sites which are due to be polled.
+        """
+        now = time.time() if now is None else now
+        site_ids = []
+        while self.queue and self.queue[0][0] <= now:
+            next_update, site_id = heapq.heappop(self.queue)
+            # Skip entries of removed sites and entries left behind when a site was removed and loaded again
+            schedule = self.sites.get(site_id)
+            if schedule is not None and schedule.next_update == next_update:
+                site_ids.append(site_id)
+        return site_ids
+
+    def time_until_next(self, now=None):
+        now = time.time() if now is None else now
+        if not self.queue:
+            return self.default_interval
+        return max(0., self.queue[0][0] - now)
+
+    def next_interval(self, schedule, feed, new_articles, error, now):
+        if error is not None or (feed.get('status') or 200) >= 400:
+            # Exponential backoff starting from the regular interval
+            interval = min(self.max_interval, schedule.interval * 2 ** min(schedule.errors, MAX_BACKOFF_EXPONENT))
+            if feed is not None:
+                retry_after = parse_retry_after(feed.get('headers', {}).get('retry-after'), now)
+                if retry_after is not None:
+                    interval = max(interval, min(retry_after, self.max_interval))
+            return schedule.interval, interval, schedule.errors + 1
+
+        interval = schedule.interval
+        if new_articles > 0 and schedule.last_update is not None:
+            # Aim for about one new article per poll
+            observed = (now - schedule.last_update) / new_articles
+            interval = (1 - SMOOTHING) * interval + SMOOTHING * observed
+        elif new_articles == 0:
+            interval *= IDLE_GROWTH
+        interval = min(self.max_interval, max(self.min_interval, interval))
+
+        requested = publisher_interval(feed)
+        if requested is not None:
+            interval = max(interval, min(requested, self.max_interval))
+
+        return interval, interval, 0
+
+    def defer(self, cursor, site_id, next_update):
+        """
+        Postpones the next poll of a site which was due but not polled, e.g. because its circuit is open.
+        """
+        schedule = self.sites[site_id]
+        schedule.next_update = next_update
+        cursor.execute('UPDATE site SET next_update=? WHERE id=?', (int(next_update), site_id))
+        heapq.heappush(self.queue, (schedule.next_update, site_id))
+
+    def requeue(self, cursor, site_ids, since, next_update):
+        """
+        Schedules the given sites, which were returned as due, for next_update unless they were rescheduled or deferred
+        since then, e.g. because the update of some of them was aborted. Returns the IDs of the requeued sites.
+        """
+        requeued = []
+        for site_id in site_ids:
+            schedule = self.sites.get(site_id)
+            if schedule is not None and schedule.next_update <= since:
+                self.defer(cursor, site_id, next_update)
+                requeued.append(site_id)
+        return requeued
+
+    def reschedule(self, cursor, site_id, feed, new_articles, error, now=None):
+        """
+        Computes and stores the next polling time of a site after it has been polled.
+        """
+        now = time.time() if now is None else now
+        schedule = self.sites[site_id]
+        schedule.interval, delay, schedule.errors = self.next_interval(schedule, feed, new_articles, error, now)
+        schedule.last_update = now
+        schedule.next_update = now + delay
+        logging.debug(f'Next update of site {site_id} in {delay:.0f}s.')
+
+        cursor.execute('UPDATE site SET update_interval=?, next_update=?, last_update=?, update_errors=? WHERE id=?',
+                       (schedule.interval, int(schedule.next_update), int(now), schedule.errors, site_id))
+        heapq.heappush(self.queue, (schedule.next_update, site_id))
@@ -0,0 +1,87 @@
+import feedparser
+import pytest
+
+from cleaning import clean_summary
+from records import parse_body, record_from_entry
+
+HEADERS = {'content-location': 'https://example.org/feed'}
+
+RSS = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:media="http://search.yahoo.com/mrss/">
+<channel><title>Example</title><link>https://example.org/</link><ttl>60</ttl>
+<item>
+  <title>Media thumbnail</title><link>https://example.org/1</link><guid isPermaLink="false">item-1</guid>
+  <pubDate>Mon, 06 Jan 2025 10:00:00 GMT</pubDate><dc:creator>Jane Doe</dc:creator>
+  <description>&lt;p&gt;First &lt;b&gt;summary&lt;/b&gt;&lt;/p&gt;</description>
+  <media:content url="http://example.org/images/1.jpg" medium="image"/>
+</item>
+<item>
+  <title>Enclosure</title><link>https://example.org/2</link><guid>https://example.org/2</guid>
+  <pubDate>Mon, 06 Jan 2025 09:00:00 GMT</pubDate>
+  <description>Second summary</description>
+  <enclosure url="https://example.org/images/2.png" type="image/png" length="100"/>
+</item>
+<item>
+  <title>Relative image</title><link>https://example.org/3</link><guid>https://example.org/3</guid>
+  <pubDate>Mon, 06 Jan 2025 08:00:00 GMT</pubDate>
+  <description>&lt;img src="/images/3.jpg"&gt; Third summary</description>
+</item>
+<item>
+  <title>Protocol-relative image</title><link>https://example.org/4</link><guid>https://example.org/4</guid>
+  <pubDate>Mon, 06 Jan 2025 07:00:00 GMT</pubDate>
+  <description>&lt;img alt="4.jpg" src="//cdn.example.org/4.jpg"&gt; Fourth summary</description>
+</item>
+</channel></rss>
+'''
+
+ATOM = b'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="https://example.org/blog/">
+<title>Example</title><id>urn:example</id><updated>2025-01-06T10:00:00Z</updated>
+<entry>
+  <id>urn:example:1</id><title>Relative image</title><link rel="alternate" href="posts/1"/>
+  <published>2025-01-06T10:00:00Z</published><author><name>Jane Doe</name></author>
+  <summary type="html">&lt;p&gt;First &lt;img src="images/1.png"&gt;&lt;/p&gt;</summary>
+</entry>
+<entry xml:base="https://static.example.org/">
+  <id>urn:example:2</id><title>Entry base</title><link href="https://example.org/blog/posts/2"/>
+  <updated>2025-01-06T09:00:00Z</updated>
+  <content type="html">&lt;img src="2.jpg"&gt; Second</content>
+</entry>
+<entry>
+  <id>urn:example:3</id><title>Plain text summary</title><link href="posts/3"/>
+  <published>2025-01-06T08:00:00Z</published>
+  <summary>Third &lt;img src="images/3.png"&gt;</summary>
+</entry>
+<entry>
+  <id>urn:example:4</id><title>Image link</title><link href="posts/4"/>
+  <link rel="enclosure" type="image/jpeg" href="images/4.jpg"/>
+  <published>2025-01-06T07:00:00Z</published>
+  <summary type="html">Fourth</summary>
+</entry>
+</feed>
+'''
+
+
+def fields(record):
+    return (record.original_id, record.title, clean_summary(record.summary), record.link, record.thumbnail,
+            record.published, record.author)
+
+
+@pytest.mark.parametrize('data', [RSS, ATOM], ids=['rss', 'atom'])
+def test_stream_reads_entries_like_feedparser(data):
+    expected = [fields(record_from_entry('', entry))
+                for entry in feedparser.parse(data, response_headers=HEADERS).entries]
+    assert [fields(record) for record in parse_body(data, HEADERS)] == expected
+
+
+def test_relative_summary_images_are_resolved():
+    thumbnails = [record.thumbnail for record in parse_body(ATOM, HEADERS)]
+    assert thumbnails == ['https://example.org/blog/images/1.png', 'https://static.example.org/2.jpg', None,
+                          'https://example.org/blog/images/4.jpg']
+
+
+def test_malformed_feeds_fall_back_to_feedparser():
+    data = RSS.replace(b'</channel>', b'<unclosed></channel>')
+    expected = [fields(record_from_entry('', entry))
+                for entry in feedparser.parse(data, response_headers=HEADERS).entries]
+    assert [fields(record) for record in parse_body(data, HEADERS)] == expected
@@ -0,0 +1,100 @@
+TIMELINE = 'timeline'
+TIMELINE_STATE = 'timeline_state'
+TIMELINE_INDEX = 'idx_timeline_published'
+# Number of newest articles kept in the timeline
+TIMELINE_SIZE = 1000
+TIMELINE_COLUMNS = 'id, site_id, site, title, summary, link, thumbnail, author, published, icon, duplicate_of'
+# Rows of new or changed articles, given as "new", with the name and icon of their site, given as "s"
+_TIMELINE_VALUES = ('new.id, new.site_id, s.name, new.title, new.summary, new.link, new.thumbnail, new.author, '
+                    'new.published, s.icon, new.duplicate_of')
+TIMELINE_TRIGGERS = {
+    'timeline_insert': 'AFTER INSERT ON article '
+                       'WHEN new.published >= (SELECT floor FROM timeline_state) BEGIN '
+                       f'INSERT INTO timeline ({TIMELINE_COLUMNS}) '
+                       f'SELECT {_TIMELINE_VALUES} FROM site s WHERE s.id = new.site_id; '
+                       'END',
+    'timeline_update': 'AFTER UPDATE OF site_id, title, summary, link, thumbnail, author, published, duplicate_of '
+                       'ON article BEGIN '
+                       'DELETE FROM timeline WHERE id = old.id; '
+                       f'INSERT INTO timeline ({TIMELINE_COLUMNS}) '
+                       f'SELECT {_TIMELINE_VALUES} FROM site s '
+                       'WHERE s.id = new.site_id AND new.published >= (SELECT floor FROM timeline_state); '
+                       'END',
+    'timeline_delete': 'AFTER DELETE ON article BEGIN '
+                       'DELETE FROM timeline WHERE id = old.id; '
+                       'END',
+    'timeline_site_update': 'AFTER UPDATE OF name, icon ON site BEGIN '
+                            'UPDATE timeline SET site = new.name, icon = new.icon WHERE site_id = new.id; '
+                            'END',
+}
+
+
+def create_timeline(cursor):
+    """
+    Creates the timeline, which holds copies of the newest articles joined with their site, so that the latest pages
+    are read from a small table without a join.
+
+    The timeline holds every article of the article table published at or after its floor. Triggers on the article
+    and site tables keep it up to date, and trim moves the floor up as newer articles arrive.
+    """
+    cursor.execute('CREATE TABLE timeline ('
+                   'id INTEGER PRIMARY KEY, '  # ID of the article
+                   'site_id INTEGER, '
+                   'site TEXT, '  # Name of the site
+                   'title TEXT, '
+                   'summary TEXT, '
+                   'link TEXT, '
+                   'thumbnail TEXT, '
+                   'author TEXT, '
+                   'published INTEGER, '
+                   'icon TEXT, '
+                   'duplicate_of INTEGER'
+                   ')')
+    cursor.execute(f'CREATE INDEX {TIMELINE_INDEX} ON timeline (published)')
+    cursor.execute('CREATE TABLE timeline_state (floor INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO timeline_state (floor) VALUES (0)')
+    for trigger, definition in TIMELINE_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER {trigger} {definition}')
+    rebuild(cursor)
+
+
+def nth_newest(cursor, table, n):
+    """
+    Returns the publication date of the n-th newest article of a table, or None if it has fewer articles.
+    """
+    cursor.execute(f'SELECT published FROM {table} ORDER BY published DESC LIMIT 1 OFFSET ?', (n - 1,))
+    result = cursor.fetchone()
+    return result[0] if result is not None else None
+
+
+def floor(cursor):
+    """
+    Returns the publication date from which on the timeline holds all articles.
+    """
+    cursor.execute('SELECT floor FROM timeline_state')
+    return cursor.fetchone()[0]
+
+
+def rebuild(cursor, size=TIMELINE_SIZE):
+    """
+    Fills the timeline with the newest articles of the article table, e.g. after many of them were removed.
+    """
+    new_floor = nth_newest(cursor, 'article', size) or 0
+    cursor.execute('DELETE FROM timeline')
+    cursor.execute(f'INSERT INTO timeline ({TIMELINE_COLUMNS}) '
+                   'SELECT a.id, a.site_id, s.name, a.title, a.summary, a.link, a.thumbnail, a.author, a.published, '
+                   's.icon, a.duplicate_of FROM article a JOIN site s ON s.id = a.site_id WHERE a.published >= ?',
+                   (new_floor,))
+    cursor.execute('UPDATE timeline_state SET floor=?', (new_floor,))
+
+
+def trim(cursor, size=TIMELINE_SIZE):
+    """
+    Removes the articles beyond the newest size articles from the timeline. Articles published at the same time as the
+    last kept article are kept as well, so that the timeline still holds all articles from its floor on.
+    """
+    new_floor = nth_newest(cursor, TIMELINE, size)
+    if new_floor is None:
+        return
+    cursor.execute('DELETE FROM timeline WHERE published < ?', (new_floor,))
+    cursor.execute('UPDATE timeline_state SET floor=? WHERE floor < ?', (new_floor, new_floor))